@@ -3,6 +3,7 @@
 
 from ctypes import *
 import logging
+import multiprocessing
 import sys
 
 import time
@@ -14,6 +15,7 @@ from scipy import *
 from coxlab_eyetracker.util import *
 
 from coxlab_eyetracker.image_processing import *
+from coxlab_eyetracker.image_processing import TilePool
 from coxlab_eyetracker.camera import *
 from coxlab_eyetracker.led import *
 from coxlab_eyetracker.motion import *
@@ -235,47 +237,62 @@ class EyeTrackerController(object):
         nworkers = int(global_settings.get('nworkers', 0))
         logging.info("starting with N workers %s" % nworkers)
 
-        self.radial_ff = None
-        self.starburst_ff = None
+        backend = global_settings.get('image_processing_backend', 'woven')
+        logging.info("using image processing backend: %s" % backend)
 
-        if nworkers != 0:
+        motion_model = global_settings.get('motion_model', 'none')
+        logging.info("using motion model: %s" % motion_model)
 
-            self.feature_finder = PipelinedFeatureFinder(nworkers)
-            workers = self.feature_finder.workers
+        # threads each feature finder (in each worker, if any) spreads its
+        # compiled image processing over; by default the cores are shared
+        # out among the workers
+        n_threads = int(global_settings.get('image_processing_threads', 0))
+        if n_threads <= 0 and nworkers > 0:
+            n_threads = max(1, multiprocessing.cpu_count() / nworkers)
+        TilePool.set_default_threads(n_threads)
+        logging.info("image processing threads: %s" % (n_threads or 'all'))
 
-            self.rffs = []
-            self.sbffs = []
-            for worker in workers:
+        self.radial_ff = None
+        self.starburst_ff = None
 
-                fr_ff = worker.FastRadialFeatureFinder()  # in worker process
-                sb_ff = worker.StarBurstEyeFeatureFinder()  # in worker process
+        if nworkers != 0:
 
-                #self.radial_ff = fr_ff
-                #self.starburst_ff = sb_ff
-                self.rffs.append(fr_ff)
-                self.sbffs.append(sb_ff)
-                # self.radial_symmetry_feature_finder_adaptor.addFeatureFinder(fr_ff)
-                # self.starburst_feature_finder_adaptor.addFeatureFinder(sb_ff)
+            max_latency = float(global_settings.get('pipeline_max_latency_ms',
+                                                    0)) / 1000.
+            if max_latency <= 0:
+                max_latency = None
+            logging.info("pipeline max latency: %s" % max_latency)
 
-                comp_ff = worker.FrugalCompositeEyeFeatureFinder(fr_ff, sb_ff)
-                # self.composite_feature_finder_adaptor.addFeatureFinder(comp_ff)
+            propagate_seeds = global_settings.get('pipeline_propagate_seeds',
+                                                  False)
 
-                worker.set_main_feature_finder(comp_ff)  # create in worker process
+            # the feature finders are created inside the worker processes
+            self.feature_finder = PipelinedFeatureFinder(nworkers,
+                    backend=backend, radial_params=rff_params,
+                    starburst_params=sbff_params, max_latency=max_latency,
+                    propagate_seeds=propagate_seeds,
+                    motion_model=motion_model)
 
-            self.radial_ff = ParamExpose(self.rffs, rff_params)
-            self.starburst_ff = ParamExpose(self.sbffs, sbff_params)
+            self.radial_ff = self.feature_finder.radial_ff
+            self.starburst_ff = self.feature_finder.starburst_ff
             self.feature_finder.start()  # start the worker loops
         else:
-            sb_ff = SubpixelStarburstEyeFeatureFinder()
-            fr_ff = FastRadialFeatureFinder()
+            sb_ff = SubpixelStarburstEyeFeatureFinder(backend=backend)
+            fr_ff = FastRadialFeatureFinder(backend=backend)
 
-            comp_ff = FrugalCompositeEyeFeatureFinder(fr_ff, sb_ff)
+            comp_ff = FrugalCompositeEyeFeatureFinder(fr_ff, sb_ff,
+                                                      motion_model=motion_model)
 
             self.radial_ff = fr_ff
             self.starburst_ff = sb_ff
 
             self.feature_finder = comp_ff
 
+        fitting_algorithm = global_settings.get('fitting_algorithm', None)
+        if fitting_algorithm is not None:
+            logging.info("using fitting algorithm: %s" % fitting_algorithm)
+            self.starburst_ff.set_param('fitting_algorithm', fitting_algorithm)
+
         if self.enable_save_to_disk and self.image_save_dir is not None:
             logging.info('Enabling save to disk...')
             self.feature_finder = ImageSaveDummyFeatureFinder(self.feature_finder, self.image_save_dir)
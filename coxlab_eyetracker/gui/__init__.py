@@ -312,9 +312,12 @@ class EyeTrackerGUI:
             attr='alpha',
             )
 
+        # (the finder computes the transform over the whole frame only when
+        # it is shown, and otherwise over just the part it searches)
         self.radial_ff_bar.add_var('show_transform', label='Show Transform',
-                                   vtype=atb.TW_TYPE_BOOL8, target=self,
-                                   attr='show_feature_map')
+                                   vtype=atb.TW_TYPE_BOOL8,
+                                   getter=self.get_show_transform,
+                                   setter=self.set_show_transform)
 
         self.radial_ff_bar.add_var('Albino/albino_mode_enable',
                                    label='Mode Enabled',
@@ -457,12 +460,15 @@ class EyeTrackerGUI:
 
         fit_algos = {0: 'circle_least_squares',
                      1: 'circle_least_squares_ransac',
-                     2: 'ellipse_least_squares'}
+                     2: 'ellipse_least_squares',
+                     3: 'circle_taubin',
+                     4: 'ellipse_direct'}
 
         fit_algos_rev = dict([(val, key) for (key, val) in fit_algos.items()])
 
         FittingAlgorithm = atb.enum('FittingAlgorithm', {'circle lst sq': 0,
-                                    'circle ransac': 1, 'ellipse lst sq': 2})
+                                    'circle ransac': 1, 'ellipse lst sq': 2,
+                                    'circle taubin': 3, 'ellipse direct': 4})
         self.sb_ff_bar.add_var('Fitting/circle_fit', label='circle fit method',
                                vtype=FittingAlgorithm, getter=lambda: \
                                fit_algos_rev[sb_ff.fitting_algorithm],
@@ -750,6 +756,13 @@ class EyeTrackerGUI:
         # self.controller.save_calibration(cal_path)
         self.refresh_calibration_file_list()
 
+    def get_show_transform(self):
+        return bool(self.show_feature_map)
+
+    def set_show_transform(self, value):
+        self.show_feature_map = c_bool(value)
+        self.controller.radial_ff.show_transform = bool(value)
+
     def update_tracker_view(self):
         if (self.controller is None) or (self.controller.camera_device is None):
             return
@@ -767,7 +780,7 @@ class EyeTrackerGUI:
         if self.show_feature_map:
             transform_im = features['transform']
             if transform_im is not None:
-                transform_im -= min(ravel(transform_im))
+                transform_im = transform_im - min(ravel(transform_im))
                 transform_im = transform_im * 255 / max(ravel(transform_im))
                 # ravelled = ravel(transform_im)
                 self.tracker_view.im_array = transform_im.astype(uint8)
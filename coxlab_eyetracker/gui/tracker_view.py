@@ -347,9 +347,9 @@ class TrackerView:
         cr_rays_end = starburst['cr_rays_end']
         cr_boundary = starburst['cr_boundary']
 
-        if pupil_rays_start == None or pupil_rays_end == None or pupil_boundary \
-            == None or cr_rays_start == None or cr_rays_end == None \
-            or cr_boundary == None:
+        if pupil_rays_start is None or pupil_rays_end is None \
+            or pupil_boundary is None or cr_rays_start is None \
+            or cr_rays_end is None or cr_boundary is None:
             return
 
         if len(pupil_rays_start) == 0 and len(pupil_rays_end) == 0 \
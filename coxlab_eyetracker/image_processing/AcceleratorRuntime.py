@@ -0,0 +1,283 @@
+#
+#  AcceleratorRuntime.py
+#  EyeTracker
+#
+#  What the OpenCL and CUDA kernels (OpenCLImageProcessing, cuda_convolution)
+#  have in common: their exceptions and alignment helpers, and the caches of
+#  compiled programs and of device buffers they all draw on.
+#
+
+import os
+import hashlib
+import logging
+import collections
+import numpy
+
+default_cache_dir = '~/.eyetracker/kernels'
+
+
+class NoProgramToFreezeException(Exception):
+
+    def __str__(self):
+        return 'No cl program to freeze'
+
+
+class KernelMustUseFloat32Exception(Exception):
+
+    def __str__(self):
+        return 'This kernel only operates on float32 data'
+
+
+class UnknownArrayShapeException(Exception):
+
+    def __str__(self):
+        return 'Array shape unknown for OpenCL buffer object'
+
+
+# Helper functions for computing alignment...
+
+def int_div_up(a, b):
+    # Round a / b to nearest higher integer value
+    a = numpy.int32(a)
+    b = numpy.int32(b)
+    return (a / b + 1 if a % b != 0 else a / b)
+
+
+def int_div_down(a, b):
+    # Round a / b to nearest lower integer value
+    a = numpy.int32(a)
+    b = numpy.int32(b)
+    return a / b
+
+
+def int_align_up(a, b):
+    # Align a to nearest higher multiple of b
+    a = numpy.int32(a)
+    b = numpy.int32(b)
+    return (a - a % b + b if a % b != 0 else a)
+
+
+def int_align_down(a, b):
+    # Align a to nearest lower multiple of b
+    a = numpy.int32(a)
+    b = numpy.int32(b)
+    return a - a % b
+
+
+def gaussian_kernel(width=17, sigma=4.0):
+    assert width == numpy.floor(width), 'argument width should be an integer!'
+    radius = (width - 1) / 2.0
+    x = numpy.linspace(-radius, radius, width)
+    x = numpy.float32(x)
+    sigma = numpy.float32(sigma)
+    filterx = x * x / (2 * sigma * sigma)
+    filterx = numpy.exp(-1 * filterx)
+    assert filterx.sum() > 0, \
+        'something very wrong if gaussian kernel sums to zero!'
+    filterx /= filterx.sum()
+    return filterx
+
+
+class ProgramCache(object):
+    """ Compiled programs, by device and by the configuration they were
+        generated for (e.g. the kernel, dtype, image shape and kernel
+        radii), so that each is built once per process.
+
+        The runtime of a device (OpenCLImageProcessing.OpenCLRuntime,
+        cuda_convolution.CUDARuntime) builds programs from source and
+        hands back their binaries, which are kept in cache_dir, named for
+        the device (and driver) and the source; later processes on the same
+        host load them instead of building again.  A binary that can't be
+        loaded (e.g. after a driver update) is built over.
+    """
+
+    def __init__(self, cache_dir=default_cache_dir):
+        self.cache_dir = cache_dir
+        self.programs = {}
+        self.builds = 0
+        self.loads = 0
+
+    def get(self, runtime, key):
+        """ The program already built for key on runtime's device, or None
+        """
+
+        return self.programs.get((runtime.device_key(), key))
+
+    def build(self, runtime, key, source):
+        """ Build source on runtime's device (or load the binary saved for
+            it) as the program for key
+        """
+
+        path = self._path(runtime, source)
+
+        program = None
+        binary = self._load(path)
+        if binary is not None:
+            try:
+                program = runtime.load(binary)
+                self.loads += 1
+            except Exception, e:
+                logging.info('Rebuilding cached program %s (%s)' % (path, e))
+                program = None
+
+        if program is None:
+            (program, binary) = runtime.build(source)
+            self.builds += 1
+            if binary is not None:
+                self._save(path, binary)
+
+        self.programs[(runtime.device_key(), key)] = program
+        return program
+
+    def clear(self):
+        self.programs.clear()
+
+    def _path(self, runtime, source):
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1((runtime.device_name() + '\n'
+                              + source).encode('utf-8')).hexdigest()
+        return os.path.join(os.path.expanduser(self.cache_dir), digest
+                            + '.bin')
+
+    def _load(self, path):
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            f = open(path, 'rb')
+            binary = f.read()
+            f.close()
+            return binary
+        except IOError, e:
+            logging.warning('Unable to read cached program %s (%s)' % (path,
+                            e))
+            return None
+
+    def _save(self, path, binary):
+        # (written beside the cache, and moved over it in one go, since
+        # several processes may be building at once)
+        if path is None:
+            return
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            temporary = '%s.%d' % (path, os.getpid())
+            f = open(temporary, 'wb')
+            f.write(binary)
+            f.close()
+            os.rename(temporary, path)
+        except (IOError, OSError), e:
+            logging.warning('Unable to save cached program %s (%s)' % (path,
+                            e))
+
+
+class BufferPool(object):
+    """ Device buffers (and pinned host arrays to stage transfers through),
+        handed out again whenever the same owner asks for the same (name,
+        shape, dtype) on the same device, up to capacity bytes in all; past
+        that, the least recently used are let go (a buffer still referenced
+        elsewhere lives on until it is released there).
+    """
+
+    def __init__(self, capacity=256 * 1024 * 1024):
+        self.capacity = capacity
+        self.buffers = collections.OrderedDict()
+        self.nbytes = 0
+        self.bytes_allocated = 0
+
+    def get(self, runtime, owner, name, shape, dtype, pinned=False):
+        shape = tuple([int(n) for n in shape])
+        dtype = numpy.dtype(dtype)
+        key = (runtime.device_key(), owner, name, shape, dtype.str, pinned)
+
+        entry = self.buffers.pop(key, None)
+        if entry is None:
+            nbytes = int(numpy.prod(shape)) * dtype.itemsize
+            if pinned:
+                entry = (runtime.allocate_pinned(shape, dtype), nbytes)
+            else:
+                entry = (runtime.allocate(shape, dtype), nbytes)
+            self.nbytes += nbytes
+            self.bytes_allocated += nbytes
+        self.buffers[key] = entry
+
+        # least recently used first
+        while self.nbytes > self.capacity and len(self.buffers) > 1:
+            (stale, (buf, nbytes)) = self.buffers.popitem(last=False)
+            self.nbytes -= nbytes
+
+        return entry[0]
+
+    def clear(self):
+        self.buffers.clear()
+        self.nbytes = 0
+
+
+# shared by every kernel in the process
+program_cache = ProgramCache()
+buffer_pool = BufferPool()
+
+
+class AcceleratorKernel(object):
+    """ The part of a kernel (e.g. OpenCLImageProcessing.MetaKernel) that
+        doesn't depend on the device API: its programs come from a
+        ProgramCache and its buffers from a BufferPool (by default, the ones
+        shared by the whole process), through runtime, which stands for the
+        device they run on.
+    """
+
+    def __init__(self, runtime, programs=None, buffers=None):
+        self.runtime = runtime
+        self.program_cache = programs or program_cache
+        self.buffer_pool = buffers or buffer_pool
+        self.last_program = None
+        self.frozen_program = None
+
+    def __call__(self, *args, **kwargs):
+        return
+
+    def freeze(self):
+        if self.last_program == None:
+            raise NoProgramToFreezeException
+        self.frozen_program = self.last_program
+
+    def thaw(self):
+        self.frozen_program = None
+
+    def cached_program(self, key):
+        """ The program already built for configuration key (of this kind
+            of kernel), or None
+        """
+
+        program = self.program_cache.get(self.runtime, (self.__class__.__name__,
+                                    key))
+        if program is not None:
+            self.last_program = program
+        return program
+
+    def cache_program(self, key, source):
+        """ Build (or load) source as the program for configuration key
+        """
+
+        program = self.program_cache.build(self.runtime, (self.__class__.__name__,
+                                      key), source)
+        self.last_program = program
+        return program
+
+    def buffer(self, name, shape, dtype=numpy.float32, cached=True):
+        """ This kernel's device buffer of that name, shape and dtype, from
+            the pool (or a new one, if not cached)
+        """
+
+        if not cached:
+            return self.runtime.allocate(shape, dtype)
+        return self.buffer_pool.get(self.runtime, id(self), name, shape, dtype)
+
+    def pinned(self, name, shape, dtype=numpy.float32):
+        """ This kernel's page-locked host array of that name, shape and
+            dtype, from the pool
+        """
+
+        return self.buffer_pool.get(self.runtime, id(self), name, shape,
+                                    dtype, pinned=True)
@@ -0,0 +1,334 @@
+#
+#  Autotuning.py
+#  EyeTracker
+#
+#  An image processing backend that hands each operation to whichever
+#  backend ran it fastest on an example frame.
+#
+
+from numpy import *
+from ImageProcessingBackend import *
+
+import os
+import json
+import time
+import socket
+import logging
+
+default_cache_path = '~/.eyetracker/autotune.json'
+
+
+class AutotunedBackend(ImageProcessingBackend):
+    """ Hands each operation (sobel3x3, separable_convolution2d,
+        fast_radial_transform, find_minmax, find_peaks, find_ray_boundaries)
+        to whichever of the candidate backends, and of their variants of it
+        (see ImageProcessingBackend.variants, e.g. FFT or separable
+        smoothing), ran it fastest on an example frame.
+
+        autotune(example_im, radii=...) times them all, unless the choices
+        for frames of that shape and type (and those radii) on this host
+        were saved in cache_path by an earlier run, and saves its choices
+        there.  Backends that can't be loaded here, or fail, are skipped;
+        until it is autotuned, everything goes to the vanilla backend.
+        Images of each shape it was tuned on go where they were found
+        fastest, and others where the last example was.
+
+        Select it as the 'auto' backend (see make_backend).
+    """
+
+    operations = ['sobel3x3', 'separable_convolution2d',
+                  'fast_radial_transform', 'find_minmax', 'find_peaks',
+                  'find_ray_boundaries']
+
+    def __init__(self, candidates=None, cache_path=default_cache_path,
+                 trials=3):
+        ImageProcessingBackend.__init__(self)
+
+        if candidates is None:
+            candidates = [name for name in sorted(available_backends)
+                          if name != 'auto']
+        self.candidates = candidates
+        self.cache_path = cache_path
+        self.trials = trials
+
+        # the candidates that could be loaded (or None), by name
+        self.backends = {}
+
+        # operation -> (backend name, variant), as chosen, and the backend
+        self.choices = {}
+        self.routes = {}
+        for operation in self.operations:
+            self._route(operation, 'vanilla', {})
+
+        # the routes for images of each shape autotuned on
+        self.shape_routes = {}
+
+    def autotune(self, example_im, **kwargs):
+        ImageProcessingBackend.autotune(self, example_im)
+
+        radii = kwargs.get('radii', None)
+        operations = list(self.operations)
+        if radii is None:
+            operations.remove('fast_radial_transform')
+
+        key = self._key(example_im, radii)
+        saved = self._load()
+        choices = saved.get(key, None)
+        # (choices saved before an operation was added are redone)
+        if choices is None or not all([operation in choices
+                                      and self._loaded(choices[operation][0])
+                                      for operation in operations]):
+            choices = self._benchmark(example_im, radii, operations)
+            saved[key] = choices
+            self._save(saved)
+
+        for operation in operations:
+            (name, variant) = choices[operation]
+            self._route(operation, name, variant)
+            logging.info('Autotuned %s: %s %s' % (operation, name, variant))
+        self.shape_routes[example_im.shape] = dict(self.routes)
+
+        # let the chosen backends set up for frames like this one
+        for backend in set([backend for (backend, variant) in
+                           self.routes.values()]):
+            backend.autotune(example_im)
+
+    def begin_frame(self):
+        for backend in self.backends.values():
+            if backend is not None:
+                backend.begin_frame()
+
+    def sobel3x3(self, im, **kwargs):
+        (backend, options) = self._options('sobel3x3', im, kwargs)
+        return backend.sobel3x3(im, **options)
+
+    def separable_convolution2d(self, im, row, col, **kwargs):
+        (backend, options) = self._options('separable_convolution2d', im,
+                kwargs)
+        return backend.separable_convolution2d(im, row, col, **options)
+
+    def fast_radial_transform(self, im, radii, alpha, **kwargs):
+        (backend, options) = self._options('fast_radial_transform', im,
+                kwargs)
+        return backend.fast_radial_transform(im, radii, alpha, **options)
+
+    def fast_radial_minmax(self, im, radii, alpha, region=None,
+                           keep_transform=True, **kwargs):
+        # a backend with a version of its own (e.g. OpenCL, which keeps the
+        # transform on the device) does it all if it is the one chosen for
+        # the transform; otherwise the transform and min/max go each to its
+        # own choice
+        (backend, options) = self._options('fast_radial_transform', im,
+                kwargs)
+        if getattr(backend.__class__, 'fast_radial_minmax') \
+            != ImageProcessingBackend.fast_radial_minmax:
+            return backend.fast_radial_minmax(im, radii, alpha, region,
+                    keep_transform, **options)
+        return ImageProcessingBackend.fast_radial_minmax(self, im, radii,
+                alpha, region, keep_transform, **kwargs)
+
+    def fast_radial_peaks(self, im, radii, alpha, region=None,
+                          keep_transform=True, n_peaks=1, separation=1.,
+                          subpixel=True, **kwargs):
+        # (as fast_radial_minmax)
+        (backend, options) = self._options('fast_radial_transform', im,
+                kwargs)
+        if getattr(backend.__class__, 'fast_radial_peaks') \
+            != ImageProcessingBackend.fast_radial_peaks:
+            return backend.fast_radial_peaks(im, radii, alpha, region,
+                    keep_transform, n_peaks, separation, subpixel, **options)
+        return ImageProcessingBackend.fast_radial_peaks(self, im, radii,
+                alpha, region, keep_transform, n_peaks, separation,
+                subpixel, **kwargs)
+
+    def find_minmax(self, im, **kwargs):
+        (backend, options) = self._options('find_minmax', im, kwargs)
+        return backend.find_minmax(im, **options)
+
+    def find_peaks(self, im, n_peaks=1, separation=1., region=None,
+                   subpixel=True, **kwargs):
+        (backend, options) = self._options('find_peaks', im, kwargs)
+        return backend.find_peaks(im, n_peaks, separation, region, subpixel,
+                                  **options)
+
+    def find_ray_boundaries(self, im, seed_point, rays, cutoff_index,
+                            threshold, exclusion_center=None,
+                            exclusion_radius=None):
+        (backend, options) = self._options('find_ray_boundaries', im, {})
+        return backend.find_ray_boundaries(im, seed_point, rays,
+                cutoff_index, threshold, exclusion_center, exclusion_radius)
+
+    def _options(self, operation, im, kwargs):
+        routes = self.shape_routes.get(getattr(im, 'shape', None),
+                                       self.routes)
+        (backend, variant) = routes[operation]
+        options = dict(variant)
+        options.update(kwargs)
+        return (backend, options)
+
+    def _route(self, operation, name, variant):
+        self.choices[operation] = (name, variant)
+        self.routes[operation] = (self._loaded(name), dict(variant))
+
+    def _loaded(self, name):
+        if name not in self.backends:
+            try:
+                self.backends[name] = make_backend(name, fallback=None)
+            except Exception, e:
+                logging.info('Not autotuning the %s backend (%s)' % (name,
+                             e))
+                self.backends[name] = None
+        return self.backends[name]
+
+    def _benchmark(self, example_im, radii, operations):
+        """ Time every variant of every candidate backend at each of
+            operations on example_im, and return the fastest of each, as
+            {operation: [backend name, variant]}
+        """
+
+        im = example_im
+        (rows, cols) = im.shape
+        kernel = exp(-arange(-3., 4.) ** 2 / 4.)
+
+        # a starburst ray pattern, cast from the middle of the frame
+        angles = linspace(0, 2 * pi, 20, endpoint=False)
+        steps = arange(0., 0.25 * min(rows, cols), 0.5)
+        rays = dstack([outer(cos(angles), steps), outer(sin(angles),
+                      steps)])
+        seed = array([rows / 2., cols / 2.])
+
+        arguments = {
+            'sobel3x3': (im, ),
+            'separable_convolution2d': (im, kernel, kernel),
+            'fast_radial_transform': (im, radii, 10.),
+            'find_minmax': (im, ),
+            'find_peaks': (im, 3, 0.1 * min(rows, cols)),
+            'find_ray_boundaries': (im, seed, rays, len(steps) // 4, 2.),
+            }
+
+        backends = []
+        for name in self.candidates:
+            backend = self._loaded(name)
+            if backend is None:
+                continue
+            try:
+                backend.autotune(im)
+                backends.append((name, backend))
+            except Exception, e:
+                logging.info('Not autotuning the %s backend (%s)' % (name,
+                             e))
+
+        choices = {}
+        for operation in operations:
+            timings = []
+            for (name, backend) in backends:
+                for variant in backend.variants(operation):
+                    elapsed = self._time(getattr(backend, operation),
+                            arguments[operation], variant)
+                    if elapsed is not None:
+                        timings.append((elapsed, name, variant))
+                        logging.debug('%s (%s %s): %f ms' % (operation, name,
+                                      variant, 1000. * elapsed))
+
+            # (backends without a version of an operation return None)
+            if len(timings) == 0:
+                timings = [(0., 'vanilla', {})]
+            (elapsed, name, variant) = sorted(timings, key=lambda t: \
+                    t[0])[0]
+            choices[operation] = [name, variant]
+
+        return choices
+
+    def _time(self, method, arguments, variant):
+        # the best of a few runs, after one to warm up (or compile), or None
+        # if the method fails or has nothing to offer
+        try:
+            if method(*arguments, **variant) is None:
+                return None
+            best = inf
+            for i in range(0, self.trials):
+                tic = time.time()
+                method(*arguments, **variant)
+                best = minimum(best, time.time() - tic)
+            return best
+        except Exception, e:
+            logging.debug('%s failed (%s)' % (method, e))
+            return None
+
+    def _key(self, example_im, radii):
+        key = '%s %dx%d %s' % (socket.gethostname(), example_im.shape[0],
+                               example_im.shape[1], example_im.dtype.str)
+        if radii is not None:
+            key += ' radii %s' % ','.join([str(int(n)) for n in radii])
+        return key
+
+    def _load(self):
+        path = os.path.expanduser(self.cache_path)
+        if not os.path.exists(path):
+            return {}
+        try:
+            return json.load(open(path))
+        except (IOError, ValueError), e:
+            logging.warning('Unable to read autotuning cache %s (%s)'
+                            % (path, e))
+            return {}
+
+    def _save(self, saved):
+        # (written beside the cache, and moved over it in one go, since
+        # several processes may be tuning at once)
+        path = os.path.expanduser(self.cache_path)
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            temporary = '%s.%d' % (path, os.getpid())
+            f = open(temporary, 'w')
+            json.dump(saved, f, indent=1, sort_keys=True)
+            f.close()
+            os.rename(temporary, path)
+        except (IOError, OSError), e:
+            logging.warning('Unable to save autotuning cache %s (%s)'
+                            % (path, e))
+
+
+def test_autotune():
+    """ Autotune on the bundled snapshot (with a temporary cache), check
+        that the tuned backend finds the same transform extrema as vanilla,
+        and that a second backend takes the choices from the cache
+    """
+
+    import tempfile
+    import PIL.Image
+    from VanillaBackend import VanillaBackend
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    im = asarray(PIL.Image.open(os.path.join(here, 'Snapshot.bmp')))
+    if im.ndim == 3:
+        im = mean(im, 2)
+    im = im.astype(float32)
+    radii = array([2, 4, 6, 9, 12, 15])
+
+    cache_path = os.path.join(tempfile.mkdtemp(), 'autotune.json')
+
+    tic = time.time()
+    b = AutotunedBackend(cache_path=cache_path)
+    b.autotune(im, radii=radii)
+    print 'Tuning: %f s' % (time.time() - tic)
+    for operation in b.operations:
+        print '\t%s: %s %s' % (operation, b.choices[operation][0],
+                               b.choices[operation][1])
+
+    S = b.fast_radial_transform(im, radii, 10.)
+    S_vanilla = VanillaBackend().fast_radial_transform(im, radii, 10.)
+    print 'Min/max (tuned): ', b.find_minmax(S)
+    print 'Min/max (vanilla): ', VanillaBackend().find_minmax(S_vanilla)
+
+    tic = time.time()
+    cached = AutotunedBackend(cache_path=cache_path)
+    cached.autotune(im, radii=radii)
+    print 'From the cache: %f s' % (time.time() - tic)
+    assert cached.choices == b.choices
+
+
+if __name__ == '__main__':
+    test_autotune()
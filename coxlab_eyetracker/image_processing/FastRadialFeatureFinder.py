@@ -5,17 +5,16 @@ import logging
 from numpy import *
 from EyeFeatureFinder import *
 from stopwatch import *
-from VanillaBackend import *
-from WovenBackend import *
+from ImageProcessingBackend import *
+from ImagePyramid import *
 
 
 class FastRadialFeatureFinder(EyeFeatureFinder):
 
-    def __init__(self):
+    def __init__(self, **kwargs):
 
-        # self.backend = VanillaBackend()
-        self.backend = WovenBackend()
-        # self.backend = OpenCLBackend()
+        # 'vanilla', 'woven', 'numba' or 'opencl'
+        self.backend = make_backend(kwargs.get('backend', 'woven'))
 
         self.target_kpixels = 80.0  # 8.0
         self.max_target_kpixels = 50.0
@@ -33,18 +32,41 @@ class FastRadialFeatureFinder(EyeFeatureFinder):
 
         self.correct_downsampling = False
 
+        # how the frame is downsampled by ds_factor: 'stride' (just taking
+        # every ds_factor-th pixel), 'box' or 'gaussian' (see ImagePyramid),
+        # from a pyramid that may be shared with other consumers of the
+        # downsampled frames (whose owner then starts it on each frame)
+        self.downsampling = kwargs.get('downsampling', 'box')
+        self.own_pyramid = ImagePyramid()
+        self.pyramid = kwargs.get('pyramid', None) or self.own_pyramid
+
         self.do_refinement_phase = 0
 
         self.return_sobel = 0
 
+        self.show_transform = False
+
         self.albino_mode = False
         self.albino_threshold = 10.
 
         self.cache_sobel = True
         self.cached_sobel = None
+
+        # a GradientCache shared with the other stages analyzing the same
+        # frames (see FrugalCompositeEyeFeatureFinder), if any
+        self.gradient_cache = kwargs.get('gradient_cache', None)
         self.compute_sobel_avg = True  # for autofocus
         self.sobel_avg = None
 
+        # besides the strongest, report up to n_candidates - 1 runners-up for
+        # the pupil and CR (the next strongest minima and maxima of the
+        # transform, at least candidate_separation times the largest radius
+        # from any stronger one), for a composite finder to fall back on;
+        # all of them refined to subpixel positions if subpixel_peaks is set
+        self.n_candidates = 1
+        self.candidate_separation = 1.
+        self.subpixel_peaks = True
+
         # Voting
         self.outlier_cutoff = 1.
         self.maxmin_consensus_votes = 1
@@ -62,22 +84,40 @@ class FastRadialFeatureFinder(EyeFeatureFinder):
         self.restrict_left = 0
         self.restrict_right = 164
 
+        # compute the transform only over the part of the frame being
+        # searched: a window reaching roi_margin times the largest radius
+        # (plus any 'roi_margin' in the guess, in image pixels, e.g. how far
+        # a motion model's prediction may be off) beyond the guessed pupil
+        # and CR, or else the restriction box.  The windows are roi_size on
+        # a side, or if that isn't enough, a multiple of roi_quantum pixels,
+        # so that the transform runs over crops of only a few shapes (for
+        # which the backend keeps its storage and tuning)
+        self.roi_search = True
+        self.roi_margin = 2.0
+        self.roi_quantum = 16
+        self.roi_size = None
+        self.cached_shape = None
+
     # analyze the image and return dictionary of features gleaned
     # from it
     # @clockit
     def analyze_image(self, image, guess=None, **kwargs):
         # print "fr"
-        im_array = image
+        self.backend.begin_frame()
+        if self.pyramid is self.own_pyramid:
+            self.pyramid.begin_frame(image)
+
         # im_array = image.astype(double)
-        im_array = im_array[::self.ds_factor, ::self.ds_factor]
+        ds = self.ds_factor
+        downsampled_shape = ((image.shape[0] - 1) // ds + 1, (image.shape[1]
+                             - 1) // ds + 1)
 
         if guess != None:
             features = guess
         else:
             features = {'pupil_size': None, 'cr_size': None}
 
-        if self.parameters_updated or self.backend.cached_shape \
-            != im_array.shape:
+        if self.parameters_updated or self.cached_shape != downsampled_shape:
             logging.debug('Recaching...')
             logging.debug('Target kPixels: %s' % self.target_kpixels)
             logging.debug('Max Radius Fraction: %s' % self.max_radius_fraction)
@@ -87,51 +127,89 @@ class FastRadialFeatureFinder(EyeFeatureFinder):
                                  * 1000)))
             if self.ds_factor <= 0:
                 self.ds_factor = 1
-            im_array = image[::self.ds_factor, ::self.ds_factor]
+            im_array = self.pyramid.level(image, self.ds_factor,
+                    self.downsampling)
 
-            self.backend.autotune(im_array)
+            self.cached_shape = im_array.shape
             self.parameters_updated = 0
 
             self.radiuses_to_try = linspace(ceil(self.min_radius_fraction
                     * im_array.shape[0]), ceil(self.max_radius_fraction
                     * im_array.shape[0]), self.radius_steps)
             self.radiuses_to_try = unique(self.radiuses_to_try.astype(int))
+
+            side = self._quantize(2 * (self.roi_margin + 1)
+                                  * max(self.radiuses_to_try))
+            self.roi_size = (side, side)
+
+            # (letting the backend pick how to smooth for these radii, over
+            # the whole frame and over the crops of windows of roi_size)
+            self.backend.autotune(im_array, radii=self.radiuses_to_try)
+            crop_side = side + 2 * self._border()
+            crop = im_array[0:crop_side, 0:crop_side]
+            if self.roi_search and crop.shape != im_array.shape:
+                self.backend.autotune(ascontiguousarray(crop),
+                                      radii=self.radiuses_to_try)
             logging.debug('Radiuses to try: %s' % self.radiuses_to_try)
             logging.debug('Downsampling factor: %s' % self.ds_factor)
 
         ds = self.ds_factor
-
-        S = self.backend.fast_radial_transform(im_array, self.radiuses_to_try,
-                self.alpha)
-
-        S[:, 0:self.restrict_left] = -1.
-        S[:, self.restrict_right:] = -1.
-        S[0:self.restrict_top, :] = -1.
-        S[self.restrict_bottom:, :] = -1.
-
-        if self.albino_mode:
-            (pupil_coords, cr_coords) = self.find_albino_features(S, im_array)
-        else:
-            (pupil_coords, cr_coords) = self.backend.find_minmax(S)
-
-        if pupil_coords == None:
-            pupil_coords = array([0., 0.])
-
-        if cr_coords == None:
-            cr_coords = array([0., 0.])
+        im_array = self.pyramid.level(image, ds, self.downsampling)
+
+        (rows, cols) = im_array.shape
+        box = (max(0, self.restrict_top), min(rows, self.restrict_bottom),
+               max(0, self.restrict_left), min(cols, self.restrict_right))
+
+        window = None
+        if self.roi_search and not self.show_transform:
+            window = self._guess_window(guess, box, ds)
+
+        found = None
+        if window is not None:
+            found = self._search(im_array, window)
+
+            # an extremum on an edge of the window that isn't an edge of the
+            # box may really lie outside it: search the whole box instead
+            (pupil_candidates, cr_candidates, S) = found
+            for candidates in (pupil_candidates, cr_candidates):
+                if len(candidates) == 0:
+                    found = None
+                    continue
+                coords = candidates[0]
+                if (coords[0] <= window[0] > box[0]) \
+                    or (coords[0] >= window[1] - 1 < box[1] - 1) \
+                    or (coords[1] <= window[2] > box[2]) \
+                    or (coords[1] >= window[3] - 1 < box[3] - 1):
+                    found = None
+
+        if found is None:
+            # the full transform is wanted for display
+            found = self._search(im_array, box,
+                                 whole_frame=self.show_transform)
+
+        (pupil_candidates, cr_candidates, S) = found
+
+        if len(pupil_candidates) == 0:
+            pupil_candidates = array([[0., 0.]])
+
+        if len(cr_candidates) == 0:
+            cr_candidates = array([[0., 0.]])
 
         if self.correct_downsampling:
-            features['pupil_position'] = array([pupil_coords[0],
-                    pupil_coords[1]]) * ds
-            features['cr_position'] = array([cr_coords[0], cr_coords[1]]) * ds
+            pupil_candidates = pupil_candidates * ds
+            cr_candidates = cr_candidates * ds
             features['dwnsmp_factor_coord'] = 1
         else:
-            features['pupil_position'] = array([pupil_coords[0],
-                    pupil_coords[1]])
-            features['cr_position'] = array([cr_coords[0], cr_coords[1]])
             features['dwnsmp_factor_coord'] = ds
 
-        features['transform'] = S
+        features['pupil_position'] = pupil_candidates[0].copy()
+        features['cr_position'] = cr_candidates[0].copy()
+        features['pupil_candidates'] = pupil_candidates
+        features['cr_candidates'] = cr_candidates
+
+        # (S may be the backend's storage, which the next frame reuses, while
+        # e.g. the GUI is still drawing it)
+        features['transform'] = S.copy() if S is not None else None
         features['im_array'] = im_array
         features['im_shape'] = im_array.shape
 
@@ -142,11 +220,140 @@ class FastRadialFeatureFinder(EyeFeatureFinder):
 
         if self.return_sobel:
             # this is very inefficient, and only for debugging
-            (m, x, y) = self.backend.sobel3x3(im_array)
+            (m, x, y) = self.backend.sobel3x3_cached(im_array,
+                    cached_sobel=self._cached_sobel(im_array, None))
             features['sobel'] = m
 
         self.result = features
 
+    def _guess_window(self, guess, box, ds):
+        """ The window (top, bottom, left, right) of the downsampled frame
+            around the pupil and CR positions in guess, moved inside box, or
+            None if there's no usable guess
+        """
+
+        if guess is None or guess.get('pupil_position') is None \
+            or guess.get('cr_position') is None:
+            return None
+
+        positions = array([guess['pupil_position'], guess['cr_position']],
+                          dtype=float) / ds
+
+        margin = self.roi_margin * max(self.radiuses_to_try) \
+            + guess.get('roi_margin', 0.) / ds
+        if not isfinite(margin) or not all(isfinite(positions)):
+            return None
+
+        window = []
+        for axis in (0, 1):
+            start = int(floor(positions[:, axis].min() - margin))
+            end = int(ceil(positions[:, axis].max() + margin)) + 1
+            (box_start, box_end) = box[2 * axis:2 * axis + 2]
+            if max(start, box_start) >= min(end, box_end):
+                return None
+
+            # centred on what it has to cover
+            size = max(self.roi_size[axis], self._quantize(end - start))
+            start -= (size - (end - start)) // 2
+            window.extend(_fit_range(start, start + size, box_start,
+                          box_end))
+
+        return tuple(window)
+
+    def _quantize(self, size):
+        # size rounded up to a multiple of roi_quantum
+        quantum = self.roi_quantum
+        return int(quantum * ceil(float(size) / quantum))
+
+    def _border(self):
+        # how far beyond a region the transform over it depends on the
+        # frame: a gradient votes the largest radius n away either way, the
+        # Gaussian of that radius spreads the votes another n / 2, and each
+        # gradient takes a pixel either side.  The compiled backends drop
+        # both votes of a pixel if either lands outside the image, so a
+        # vote reaching the region counts only if the other one, 2 n
+        # further out, lands within the frame, and the crop has to take it
+        # in too; the vanilla backend clamps votes to the edges instead,
+        # which at this distance don't reach the region
+        return int(ceil(2.5 * max(self.radiuses_to_try))) + 2
+
+    def _search(self, im_array, region, whole_frame=False):
+        """ Find the pupil and CR within region (top, bottom, left, right) of
+            the downsampled frame, computing the transform over just that
+            region plus enough border for the gradients and smoothing to
+            be the same as over the whole frame (or over the whole frame, if
+            whole_frame is set).  Returns the candidates for each (n x 2
+            arrays, the strongest first) and the transform.
+        """
+
+        (rows, cols) = im_array.shape
+        (top, bottom, left, right) = region
+
+        # (the crop is moved, rather than cut, at the edges of the frame, so
+        # that windows of the same size give crops of the same shape)
+        if whole_frame:
+            (crop_top, crop_bottom, crop_left, crop_right) = (0, rows, 0,
+                    cols)
+        else:
+            border = self._border()
+            (crop_top, crop_bottom) = _fit_range(top - border, bottom
+                    + border, 0, rows)
+            (crop_left, crop_right) = _fit_range(left - border, right
+                    + border, 0, cols)
+
+        crop = im_array[crop_top:crop_bottom, crop_left:crop_right]
+        if crop.shape != im_array.shape:
+            crop = ascontiguousarray(crop)
+
+        # (the transform itself is only read back from backends that keep
+        # it on a device when it is wanted for display or the albino search)
+        (pupil_candidates, cr_candidates, S) = \
+            self.backend.fast_radial_peaks(crop, self.radiuses_to_try,
+                self.alpha, region=(top - crop_top, bottom - crop_top, left
+                - crop_left, right - crop_left), keep_transform=whole_frame
+                or self.albino_mode, n_peaks=self.n_candidates,
+                separation=self.candidate_separation
+                * max(self.radiuses_to_try), subpixel=self.subpixel_peaks,
+                cached_sobel=self._cached_sobel(im_array, (crop_top,
+                crop_bottom, crop_left, crop_right)))
+
+        if self.albino_mode and S is not None:
+            (pupil_coords, cr_coords) = self.find_albino_features(S, crop)
+            pupil_candidates = [pupil_coords] if pupil_coords is not None \
+                else []
+            cr_candidates = [cr_coords] if cr_coords is not None else []
+
+        # runners-up on the edge of the region are where the transform is
+        # cut off, rather than extrema of it
+        def inside(coords):
+            return top - crop_top < coords[0] < bottom - crop_top - 1 \
+                and left - crop_left < coords[1] < right - crop_left - 1
+
+        pupil_candidates = [coords for (i, coords) in
+                            enumerate(pupil_candidates) if i == 0
+                            or inside(coords)]
+        cr_candidates = [coords for (i, coords) in enumerate(cr_candidates)
+                         if i == 0 or inside(coords)]
+
+        # back to the coordinates of the downsampled frame
+        offset = array([crop_top, crop_left])
+        pupil_candidates = array([coords[0:2] for coords in
+                                 pupil_candidates], dtype=float).reshape(-1,
+                                 2) + offset
+        cr_candidates = array([coords[0:2] for coords in cr_candidates],
+                              dtype=float).reshape(-1, 2) + offset
+
+        return (pupil_candidates, cr_candidates, S)
+
+    def _cached_sobel(self, im_array, window):
+        """ The gradients over window of the downsampled frame (or all of
+            it), from the gradient_cache, or None if there isn't one
+        """
+
+        if self.gradient_cache is None:
+            return None
+        return self.gradient_cache.gradient(im_array, self.backend, window)
+
     def update_parameters(self):
         self.parameters_updated = 1
 
@@ -185,6 +392,16 @@ class FastRadialFeatureFinder(EyeFeatureFinder):
             return (c1_center, c2_center)
 
 
+def _fit_range(start, end, lower, upper):
+    """ The range [start, end) moved to lie within [lower, upper), and cut
+        to fit only if it is longer
+    """
+
+    size = min(end - start, upper - lower)
+    start = min(max(start, lower), upper - size)
+    return (start, start + size)
+
+
 def test_it():
 
     import matplotlib.pylab as plt
@@ -265,19 +482,128 @@ def test_it():
         plt.imshow(test['transform'])
         plt.title('Convolve2d')
 
-    if 0:
-        f.reuse_storage = 1
-        tic = time.time()
 
-        def sepfir_multithread_test(i, f, im):
-            test = f.analyze_image(im, filter='sepfir')
+    # pylab.show()
 
-        foreach(lambda t: sepfir_multithread_test(t, f, im), range(0, trials),
-                3)
-        print 'Sep FIR (multithreaded): ', (time.time() - tic) / trials
 
+def test_downsampling():
+    """ Compare the positions found in synthetic frames (a dark pupil and a
+        small bright CR, on noise) downsampled each way, and time them
+    """
+
+    import time
+
+    (rows, cols) = (480, 640)
+    (ii, jj) = mgrid[0:rows, 0:cols]
+    random_state = random.RandomState(0)
+
+    for downsampling in ['stride', 'box', 'gaussian']:
+        f = FastRadialFeatureFinder(backend='vanilla',
+                                    downsampling=downsampling)
+        f.target_kpixels = 10.
+        f.correct_downsampling = True
+        (f.restrict_bottom, f.restrict_right) = (rows, cols)
+
+        errors = []
+        elapsed = 0.
+        for trial in range(0, 20):
+            pupil = array([rows / 2., cols / 2.]) + random_state.uniform(-40,
+                    40, 2)
+            angle = random_state.uniform(0, 2 * pi)
+            cr = pupil + 30. * array([cos(angle), sin(angle)])
+            im = 20. + random_state.normal(0, 10, (rows, cols))
+            im[hypot(ii - pupil[0], jj - pupil[1]) < 150] += 100.
+            im[hypot(ii - pupil[0], jj - pupil[1]) < 40] -= 80.
+            im[hypot(ii - cr[0], jj - cr[1]) < 15] += 120.
+            im = im.astype(float32)
+
+            tic = time.time()
+            f.analyze_image(im)
+            elapsed += time.time() - tic
+            result = f.get_result()
+            errors.append((hypot(*(result['pupil_position'] - pupil)),
+                          hypot(*(result['cr_position'] - cr))))
+
+        errors = array(errors)
+        print '%s (ds %d): median error pupil %.1f px, CR %.1f px; %f ms' \
+            % (downsampling, f.ds_factor, median(errors[:, 0]),
+               median(errors[:, 1]), 1000. * elapsed / 20)
+
+
+def test_roi_search():
+    """ Check that searching windows of the bundled snapshots over crops
+        finds the same candidates, and the same transform within the
+        window, as searching them over the whole frame, with each backend
+        that loads and each way of smoothing (to within the rounding of the
+        FFT)
+    """
+
+    import os
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    random_state = random.RandomState(0)
+
+    backends = []
+    for name in ['vanilla', 'woven', 'numba']:
+        try:
+            backends.append((name, make_backend(name, None)))
+        except Exception, e:
+            print 'Skipping %s (%s)' % (name, e)
+
+    for name in ['Snapshot.bmp', 'Snapshot2.bmp', 'Snapshot_test.bmp',
+                 'RatEye_snap6.tiff', 'RatEye_snap12_zoom.jpg']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+
+        for (backend_name, backend) in backends:
+            for smoothing in ['sepfir', 'fft']:
+                f = FastRadialFeatureFinder(backend=backend)
+                f.backend.smoothing = smoothing
+                f.n_candidates = 3
+                (f.restrict_bottom, f.restrict_right) = im.shape
+                f.analyze_image(im)
+                im_array = f.get_result()['im_array']
+                (rows, cols) = im_array.shape
+                border = f._border()
+
+                for trial in range(0, 10):
+                    positions = [random_state.uniform(0, rows, 2),
+                                 random_state.uniform(0, cols, 2)]
+                    guess = {'pupil_position': [positions[0][0],
+                             positions[1][0]],
+                             'cr_position': [positions[0][1],
+                             positions[1][1]]}
+                    window = f._guess_window(guess, (0, rows, 0, cols), 1)
+                    if window is None:
+                        continue
+                    (top, bottom, left, right) = window
+                    crop_top = _fit_range(top - border, bottom + border, 0,
+                                          rows)[0]
+                    crop_left = _fit_range(left - border, right + border, 0,
+                                           cols)[0]
+
+                    # (the transforms may be the backend's storage, which
+                    # the next search reuses)
+                    found = f._search(im_array, window)
+                    S = found[2][top - crop_top:bottom - crop_top, left
+                                 - crop_left:right - crop_left].copy()
+                    expected = f._search(im_array, window, whole_frame=True)
+                    S_expected = expected[2][top:bottom, left:right]
+
+                    scale = max(abs(S_expected).ravel())
+                    assert allclose(S, S_expected, atol=1e-4 * scale), \
+                        (name, backend_name, smoothing, window,
+                         max(abs(S - S_expected).ravel()) / scale)
+                    for (a, b) in zip(found[0:2], expected[0:2]):
+                        assert a.shape == b.shape and allclose(a, b,
+                                atol=1e-2), (name, backend_name, smoothing,
+                                window, a, b)
+
+        print '%s: same candidates and transform' % name
 
-    # pylab.show()
 
 if __name__ == '__main__':
-    test_it()
+    test_downsampling()
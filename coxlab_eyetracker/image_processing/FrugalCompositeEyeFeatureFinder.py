@@ -13,13 +13,16 @@ from scipy import *
 from numpy import *
 from FastRadialFeatureFinder import *
 from SubpixelStarburstEyeFeatureFinder import *
+from MotionModel import *
+from GradientCache import *
+from ImagePyramid import *
 
 import logging
 
 
 class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
 
-    def __init__(self, ff_radial, ff_starbust):
+    def __init__(self, ff_radial, ff_starbust, motion_model=None):
 
         self.result = None
         self.last = None
@@ -34,6 +37,30 @@ class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
         self.minimum_frames_to_reseed = 50
         self.reseed_count = self.minimum_frames_to_reseed
 
+        # when the starburst finder can't refine the fast radial finder's
+        # pupil and CR, it is run again from the fast radial runners-up
+        # (up to reseed_candidates of each), strongest first, for at most
+        # max_candidate_tries other pairings, before the frame is left to
+        # the next reseed
+        self.reseed_candidates = 3
+        self.max_candidate_tries = 3
+        self.ff_fast_radial.n_candidates = self.reseed_candidates
+
+        # with a motion model, the starburst finder is seeded with the
+        # predicted positions, and instead of reseeding every
+        # minimum_frames_to_reseed frames, a reseed happens when a
+        # measurement falls outside the model's gate
+        self.motion_model = make_motion_model(motion_model)
+
+        # both finders take their gradients of each frame from one cache, so
+        # that a reseed (or a second starburst pass) doesn't compute any
+        # gradient twice, and the downsampled frames from one pyramid
+        self.gradient_cache = GradientCache()
+        self.ff_fast_radial.gradient_cache = self.gradient_cache
+        self.ff_starburst.gradient_cache = self.gradient_cache
+        self.pyramid = ImagePyramid()
+        self.ff_fast_radial.pyramid = self.pyramid
+
     def update_parameters(self):
         pass
 
@@ -48,7 +75,30 @@ class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
 
         error_level = inf
 
-        if not self.first_run:
+        self.gradient_cache.begin_frame()
+        self.pyramid.begin_frame(im)
+
+        # when the guess carries a 'reseed' flag, reseeds are scheduled by
+        # whoever supplies the guesses (e.g. a PipelinedFeatureFinder sharing
+        # one schedule across its workers), and any guess with positions can
+        # be tracked, even on this finder's first frame
+        coordinated = guess is not None and 'reseed' in guess
+        predicting = self.motion_model is not None and not coordinated
+        innovation = None
+
+        if coordinated:
+            tracking = guess.get('pupil_position') is not None \
+                and guess.get('cr_position') is not None
+        elif predicting:
+            prediction = self.motion_model.predict(guess.get('timestamp'))
+            tracking = prediction is not None
+            if tracking:
+                guess = guess.copy()
+                (guess['pupil_position'], guess['cr_position']) = prediction
+        else:
+            tracking = not self.first_run
+
+        if tracking:
             # Try to track with the starburst finder using the previous guess as a seed
             try:
                 self.ff_starburst.analyze_image(im, guess.copy())
@@ -61,14 +111,28 @@ class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
                 features['cr_position'] = None
                 logging.error(e.message)
 
-        if features is not None and 'starburst' in features and 'pupil_err' \
-            in features['starburst']:
-            cr_error = features['starburst']['cr_err']
-            pupil_error = features['starburst']['pupil_err']
-            error_level = max(cr_error, pupil_error)
+        if features is not None:
+            error_level = self._starburst_error(features)
             # print("error_level: %f" % error_level)
 
-        if self.first_run or error_level > self.reseed_threshold \
+        if predicting and tracking:
+            if features.get('pupil_position') is not None \
+                and features.get('cr_position') is not None:
+                innovation = self.motion_model.update(features['pupil_position'],
+                        features['cr_position'], guess.get('timestamp'))
+            else:
+                innovation = inf
+
+        if coordinated:
+            if guess['reseed'] or not tracking \
+                or error_level > self.reseed_threshold:
+                reseed = True
+        elif predicting:
+            if not tracking or error_level > self.reseed_threshold \
+                or (innovation is not None
+                    and innovation > self.motion_model.gate):
+                reseed = True
+        elif self.first_run or error_level > self.reseed_threshold \
             or self.reseed_count <= 0:
             reseed = True
 
@@ -79,15 +143,31 @@ class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
 
             # Exhaustive Search: Get intial guess of pupil and CR using the fast radial finder
             # self.ff_fast_radial.target_kpixels = 10 #50
-            self.ff_fast_radial.analyze_image(im, guess)  # NOTE: for now, the guess is not used by the fast radial feature finder
-            features = self.ff_fast_radial.get_result()
-            ds = features['dwnsmp_factor_coord']
-            pupil_position_stage1 = features['pupil_position']
-            cr_position_stage1 = features['cr_position']
-            im_array_stage1 = features['im_array']
-
-            if 'sobel_avg' in features:
-                sobel_avg = features['sobel_avg']
+            # a scheduled reseed while tracking is still good only needs to
+            # search around the tracked positions (and as far again as any
+            # 'roi_margin' in the guess, e.g. the uncertainty of a
+            # PipelinedFeatureFinder's motion model); if tracking has been
+            # lost, search the whole restriction box
+            radial_guess = guess.copy()
+            lost = not tracking or error_level > self.reseed_threshold \
+                or (innovation is not None and predicting
+                    and innovation > self.motion_model.gate)
+            if lost:
+                radial_guess['pupil_position'] = None
+                radial_guess['cr_position'] = None
+            else:
+                radial_guess['pupil_position'] = features['pupil_position']
+                radial_guess['cr_position'] = features['cr_position']
+
+            self.ff_fast_radial.analyze_image(im, radial_guess)
+            radial_features = self.ff_fast_radial.get_result()
+            ds = radial_features['dwnsmp_factor_coord']
+            pupil_position_stage1 = radial_features['pupil_position']
+            cr_position_stage1 = radial_features['cr_position']
+            im_array_stage1 = radial_features['im_array']
+
+            if 'sobel_avg' in radial_features:
+                sobel_avg = radial_features['sobel_avg']
             else:
                 sobel_avg = None
 
@@ -95,9 +175,13 @@ class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
             # try:
 
             # Run the starburst ff
-            self.ff_starburst.analyze_image(im, features.copy())
+            self.ff_starburst.analyze_image(im, radial_features.copy())
             features = self.ff_starburst.get_result()
 
+            if self._starburst_error(features) > self.reseed_threshold:
+                (features, pupil_position_stage1, cr_position_stage1) = \
+                    self._try_candidates(im, radial_features, features)
+
             # except Exception, e:
             #                 raise e
             #                 features['pupil_radius'] = None
@@ -110,6 +194,14 @@ class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
             features['pupil_position_stage1'] = pupil_position_stage1 * ds
             features['cr_position_stage1'] = cr_position_stage1 * ds
 
+            if predicting:
+                # start the model over from the reseeded positions
+                self.motion_model.reset()
+                if features.get('pupil_position') is not None \
+                    and features.get('cr_position') is not None:
+                    self.motion_model.update(features['pupil_position'],
+                            features['cr_position'], guess.get('timestamp'))
+
         # Add features axtracted by the first feature finder to the final feature vector
         features['im_array'] = im
         features['im_shape'] = im.shape
@@ -118,10 +210,116 @@ class FrugalCompositeEyeFeatureFinder(EyeFeatureFinder):
             features['sobel_avg'] = sobel_avg
 
         features['timestamp'] = guess.get('timestamp', 0)
+        features['reseeded'] = reseed
+        if predicting:
+            features['innovation'] = innovation
 
         self.result = self.last = features
 
         self.first_run = False
 
+    def _starburst_error(self, features):
+        # the worse of the starburst finder's pupil and CR fit errors (inf if
+        # it didn't fit them)
+        if features is None or 'starburst' not in features \
+            or 'pupil_err' not in features['starburst']:
+            return inf
+        return max(features['starburst']['cr_err'],
+                   features['starburst']['pupil_err'])
+
+    def _try_candidates(self, im, radial_features, features):
+        """ Run the starburst finder from the other pairings of the fast
+            radial finder's pupil and CR candidates (strongest first), until
+            one is refined within reseed_threshold; returns its result, with
+            the pupil and CR positions it started from (or else features,
+            from the strongest)
+        """
+
+        pupil_candidates = radial_features.get('pupil_candidates', [])
+        cr_candidates = radial_features.get('cr_candidates', [])
+
+        pairings = [(p, c) for p in range(0, len(pupil_candidates)) for c in
+                    range(0, len(cr_candidates)) if p > 0 or c > 0]
+        pairings.sort(key=lambda pairing: (sum(pairing), pairing[0]))
+
+        for (p, c) in pairings[0:self.max_candidate_tries]:
+            seed = radial_features.copy()
+            seed['pupil_position'] = pupil_candidates[p]
+            seed['cr_position'] = cr_candidates[c]
+            try:
+                self.ff_starburst.analyze_image(im, seed)
+            except Exception, e:
+                logging.error(e.message)
+                continue
+            candidate_features = self.ff_starburst.get_result()
+
+            if self._starburst_error(candidate_features) \
+                <= self.reseed_threshold:
+                return (candidate_features, seed['pupil_position'],
+                        seed['cr_position'])
+
+        return (features, radial_features['pupil_position'],
+                radial_features['cr_position'])
+
     def get_result(self):
         return self.result
+
+
+def test_gradient_cache():
+    """ Check that sharing a GradientCache between the stages gives the same
+        features as each computing its own gradients, over frames of the
+        bundled snapshots (every other one reseeded), and count and time
+        the Sobel passes with and without it
+    """
+
+    import os
+    import time
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    for name in ['Snapshot.bmp', 'RatEye_snap6.tiff']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+
+        print name, im.shape
+        runs = []
+        for shared in [False, True]:
+            fr = FastRadialFeatureFinder(backend='vanilla')
+            sb = SubpixelStarburstEyeFeatureFinder(backend='vanilla')
+            (fr.restrict_bottom, fr.restrict_right) = im.shape
+            ff = FrugalCompositeEyeFeatureFinder(fr, sb)
+            if not shared:
+                fr.gradient_cache = sb.gradient_cache = None
+
+            # count the Sobel passes of both finders' backends
+            passes = [0]
+            for backend in (fr.backend, sb.backend):
+                def counted(image, sobel3x3=backend.sobel3x3, **kwargs):
+                    passes[0] += 1
+                    return sobel3x3(image, **kwargs)
+                backend.sobel3x3 = counted
+
+            results = []
+            guess = {'timestamp': 0}
+            tic = time.time()
+            for i in range(0, 20):
+                ff.reseed_count = i % 2
+                ff.analyze_image(im.copy(), guess)
+                results.append(ff.get_result())
+                guess = dict(results[-1])
+                guess['timestamp'] = i + 1
+            elapsed = 1000. * (time.time() - tic) / 20
+            runs.append(results)
+
+            print '\t%s: %d Sobel passes, %f ms per frame' % (shared
+                    and 'Shared gradients' or 'Separate gradients',
+                    passes[0], elapsed)
+
+        for (a, b) in zip(*runs):
+            for key in ['cr_position', 'pupil_position', 'cr_radius',
+                        'pupil_radius']:
+                assert allclose(a[key], b[key]), (key, a[key], b[key])
+        print '\tSame features'
@@ -0,0 +1,95 @@
+#
+#  GradientCache.py
+#  EyeTracker
+#
+#  The Sobel gradients of the frame being analyzed, shared between the
+#  stages that analyze it.
+#
+
+from numpy import *
+from Workspace import *
+
+
+class GradientCache(object):
+    """ Holds the Sobel gradients (mag, x, y) of one frame, so that the
+        stages analyzing it (the fast radial and starburst finders of a
+        FrugalCompositeEyeFeatureFinder) never compute the same gradient
+        twice.
+
+        Gradients are kept by the image they are of (the frame, or one of
+        its ImagePyramid levels), and by the window (top, bottom, left,
+        right) of that image they cover; a request for a window within one
+        already computed of the same image is answered from it.  Near the
+        edges of a window (though not of the image) the gradient differs
+        from the gradient of the whole image, so callers should ask for
+        windows with the border they need.
+
+        begin_frame() starts on a new frame, forgetting every gradient.
+    """
+
+    def __init__(self, workspace=None):
+        if workspace is None:
+            workspace = Workspace()
+        self.workspace = workspace
+
+        # (image, window, gradients), in the order they were computed
+        self.gradients = []
+
+        self.hits = 0
+        self.misses = 0
+
+    def begin_frame(self):
+        """ Forget the gradients of the last frame
+        """
+
+        self.gradients = []
+        self.workspace.begin_frame()
+
+    def gradient(self, im, backend, window=None):
+        """ The gradients (mag, x, y) of im over window (or all of it),
+            computed with backend.sobel3x3 unless they have already been
+        """
+
+        (rows, cols) = im.shape
+        if window is None:
+            window = (0, rows, 0, cols)
+        window = tuple(window)
+        (top, bottom, left, right) = window
+
+        found = self.find(im, window)
+        if found is not None:
+            (gradients, w) = found
+            if w == window:
+                return gradients
+            return tuple([ascontiguousarray(g[top - w[0]:bottom - w[0], left
+                         - w[2]:right - w[2]]) for g in gradients])
+
+        self.misses += 1
+
+        crop = im[top:bottom, left:right]
+        if crop.shape != im.shape:
+            crop = ascontiguousarray(crop)
+
+        # the backend may hand back storage it will reuse, so keep copies
+        stored = []
+        for (i, g) in enumerate(backend.sobel3x3(crop)):
+            stored.append(self.workspace.get(('gradient',
+                          len(self.gradients), i), g.shape, g.dtype))
+            copyto(stored[-1], g)
+        stored = tuple(stored)
+
+        self.gradients.append((im, window, stored))
+        return stored
+
+    def find(self, im, window):
+        """ The gradients already computed of im over a window covering
+            window, and that window, or None
+        """
+
+        (top, bottom, left, right) = window
+        for (image, w, gradients) in self.gradients:
+            if image is im and w[0] <= top and w[1] >= bottom and w[2] \
+                <= left and w[3] >= right:
+                self.hits += 1
+                return (gradients, w)
+        return None
@@ -9,6 +9,8 @@
 #
 
 from numpy import *
+import heapq
+import logging
 
 
 class ImageProcessingBackend:
@@ -16,16 +18,35 @@ class ImageProcessingBackend:
     def __init__(self):
         self.cached_shape = (0, 0)
 
-    def autotune(self, example_im):
+    def autotune(self, example_im, **kwargs):
         self.cached_shape = example_im.shape
         return
 
+    # the keyword arguments selecting each of the ways a backend has of
+    # doing an operation (e.g. [{'smoothing': 'sepfir'}, {'smoothing':
+    # 'fft'}] for fast_radial_transform), for an autotuner to time
+    def variants(self, operation):
+        return [{}]
+
+    # called once at the start of each frame, so that backends that keep
+    # per-frame storage or statistics can recycle them
+    def begin_frame(self):
+        return
+
     def sobel3x3(self, im, **kwargs):
         mag = None
         imgx = None
         imgy = None
         return (mag, imgx, imgy)
 
+    # the gradients of im, taken from kwargs['cached_sobel'] when the caller
+    # already has them (e.g. from a GradientCache), or else from sobel3x3
+    def sobel3x3_cached(self, im, **kwargs):
+        cached = kwargs.get('cached_sobel', None)
+        if cached is not None and cached[0].shape == im.shape:
+            return cached
+        return self.sobel3x3(im)
+
     def separable_convolution2d(self, im, row, col, **kwargs):
         result = None
         return result
@@ -39,4 +60,179 @@ class ImageProcessingBackend:
         S = None
         return S
 
+    # the transform's min and max (the pupil and CR) within region (top,
+    # bottom, left, right) of im, and the transform itself, as one
+    # operation, so that backends that keep the image on a device need only
+    # read back the coordinates (and S only if keep_transform is set; S may
+    # be None otherwise)
+    def fast_radial_minmax(self, im, radii, alpha, region=None,
+                           keep_transform=True, **kwargs):
+        S = self.fast_radial_transform(im, radii, alpha, **kwargs)
+        if S is None:
+            return (None, None, None)
+
+        mask_outside(S, region)
+
+        (min_coord, max_coord) = self.find_minmax(S)
+        return (min_coord, max_coord, S)
+
+    # the n_peaks strongest minima and maxima of im (within region, if
+    # given) as arrays of (row, col), strongest first: local extrema, of
+    # which any closer than separation to a stronger one kept is dropped
+    # (see strongest_peaks), refined to subpixel positions if subpixel is
+    # set (see refine_peaks).  The first of each is where find_minmax would
+    # put the min and max
+    def find_peaks(self, im, n_peaks=1, separation=1., region=None,
+                   subpixel=True, **kwargs):
+        minima = None
+        maxima = None
+        return (minima, maxima)
+
+    # like fast_radial_minmax, with the transform's n_peaks strongest minima
+    # and maxima (see find_peaks) in place of its min and max
+    def fast_radial_peaks(self, im, radii, alpha, region=None,
+                          keep_transform=True, n_peaks=1, separation=1.,
+                          subpixel=True, **kwargs):
+        S = self.fast_radial_transform(im, radii, alpha, **kwargs)
+        if S is None:
+            return (None, None, None)
+
+        mask_outside(S, region)
+
+        (minima, maxima) = self.find_peaks(S, n_peaks, separation, region,
+                                           subpixel)
+        return (minima, maxima, S)
+
+    # the starburst ray search (see SubpixelStarburstEyeFeatureFinder.
+    # _find_ray_boundaries), for backends with a compiled version; returns
+    # an N x 2 array of boundary points, or None to have the caller do it
+    def find_ray_boundaries(self, im, seed_point, rays, cutoff_index,
+                            threshold, exclusion_center=None,
+                            exclusion_radius=None):
+        return None
+
+
+def mask_outside(S, region):
+    """ Set S to -1 outside region (top, bottom, left, right), if given
+    """
+
+    if region is not None:
+        (top, bottom, left, right) = region
+        S[:, 0:left] = -1.
+        S[:, right:] = -1.
+        S[0:top, :] = -1.
+        S[bottom:, :] = -1.
+
+
+# how many of the strongest local extrema find_peaks keeps at first, per peak
+# asked for, to choose among; if too few of them are far enough apart (e.g.
+# on a plateau, every pixel of which is an extremum), it looks again, keeping
+# more_candidates times as many
+candidates_per_peak = 8
+more_candidates = 4
+
+
+def strongest_peaks(candidates, n_peaks, separation):
+    """ The strongest n_peaks of candidates, local extrema (row, col,
+        strength) in scan order, as a list of them, strongest first: taken
+        strongest first (the first found of equally strong ones first), each
+        unless it is closer than separation to one already taken (greedy
+        non-maximum suppression).  Only the strongest few are sorted, kept
+        in a bounded heap, and more only if too few of them are taken.
+    """
+
+    candidates = list(candidates)
+    n_candidates = n_peaks * candidates_per_peak
+    while True:
+        peaks = suppress_peaks(heapq.nlargest(n_candidates, candidates,
+                               key=lambda p: p[2]), n_peaks, separation)
+        if len(peaks) == n_peaks or n_candidates >= len(candidates):
+            return peaks
+        n_candidates *= more_candidates
+
+
+def suppress_peaks(candidates, n_peaks, separation):
+    """ Greedy non-maximum suppression: the first n_peaks of candidates
+        (row, col, strength), strongest first, that aren't closer than
+        separation to an earlier one taken
+    """
+
+    peaks = []
+    for (r, c, value) in candidates:
+        if len(peaks) == n_peaks:
+            break
+        for p in peaks:
+            if (r - p[0]) ** 2 + (c - p[1]) ** 2 < separation ** 2:
+                break
+        else:
+            peaks.append((r, c, value))
+    return peaks
+
+
+def refine_peaks(im, peaks, region=None):
+    """ Move each (row, col) of peaks to the vertex of the parabola through
+        it and its two neighbours in im, along each axis (by at most half a
+        pixel, and only where both neighbours are within region)
+    """
+
+    (rows, cols) = im.shape
+    if region is None:
+        region = (0, rows, 0, cols)
+    (top, bottom, left, right) = region
+
+    def vertex(before, at, after):
+        curvature = before - 2. * at + after
+        if curvature == 0:
+            return 0.
+        offset = 0.5 * (before - after) / curvature
+        if offset < -0.5:
+            return -0.5
+        if offset > 0.5:
+            return 0.5
+        return offset
+
+    # (a handful of peaks, for which element by element is quickest)
+    refined = array(peaks, dtype=float).reshape(-1, 2)
+    for p in refined:
+        (r, c) = (int(p[0]), int(p[1]))
+        at = im.item(r, c)
+        if top < r < bottom - 1:
+            p[0] += vertex(im.item(r - 1, c), at, im.item(r + 1, c))
+        if left < c < right - 1:
+            p[1] += vertex(im.item(r, c - 1), at, im.item(r, c + 1))
+    return refined
+
+
+# Backends that can be selected by name (e.g. from the image_processing_backend
+# config setting).  Modules are imported lazily, since most backends depend
+# on optional packages (scipy.weave, numba, pyopencl); 'auto' picks among the
+# others, operation by operation (see Autotuning.AutotunedBackend)
+available_backends = {'vanilla': ('VanillaBackend', 'VanillaBackend'),
+                      'woven': ('WovenBackend', 'WovenBackend'),
+                      'numba': ('NumbaBackend', 'NumbaBackend'),
+                      'opencl': ('OpenCLBackend', 'OpenCLBackend'),
+                      'auto': ('Autotuning', 'AutotunedBackend')}
+
+
+def make_backend(name='woven', fallback='vanilla'):
+    """ Instantiate an image processing backend by name, falling back to a
+        pure-NumPy backend if the requested one cannot be loaded
+    """
+
+    if isinstance(name, ImageProcessingBackend):
+        return name
+
+    name = str(name).lower()
+    if name not in available_backends:
+        raise ValueError('Unknown image processing backend: %s' % name)
 
+    (module_name, class_name) = available_backends[name]
+    try:
+        module = __import__(module_name, globals(), locals(), [class_name])
+        return getattr(module, class_name)()
+    except Exception, e:
+        if fallback is None or fallback == name:
+            raise
+        logging.warning('Unable to load %s backend (%s); using %s instead'
+                        % (name, e, fallback))
+        return make_backend(fallback, None)
@@ -0,0 +1,127 @@
+#
+#  ImagePyramid.py
+#  EyeTracker
+#
+#  Anti-aliased, downsampled copies of the frame being analyzed, shared
+#  between the stages that analyze it.
+#
+
+from numpy import *
+from Workspace import *
+
+
+class ImagePyramid(object):
+    """ Downsampled copies ("levels") of a frame, each computed at most once
+        per frame into storage that is reused from frame to frame, and
+        always contiguous.
+
+        level(frame, factor, filter) has the shape of frame[::factor,
+        ::factor], and its pixel (i, j) stands for the frame around pixel
+        (i * factor, j * factor), as the strided frame's does.  The filters:
+          'stride': just frame[::factor, ::factor] (which aliases)
+          'box': the mean of the factor x factor block of the frame
+            centered on each pixel (clipped at the edges of the frame)
+          'gaussian': the box level, smoothed with a [1 2 1] / 4 kernel;
+            together, close to a Gaussian with a standard deviation of
+            about 0.7 factor
+
+        The levels are kept for the current frame, which begin_frame(frame)
+        (or asking for a level of a different frame) starts.  Call
+        begin_frame on every frame if frames may be overwritten in place.
+    """
+
+    def __init__(self, workspace=None):
+        if workspace is None:
+            workspace = Workspace()
+        self.workspace = workspace
+
+        self.frame = None
+        self.levels = {}
+
+    def begin_frame(self, frame=None):
+        """ Forget the levels of the last frame, and start on frame
+        """
+
+        self.frame = frame
+        self.levels = {}
+        self.workspace.begin_frame()
+
+    def level(self, frame, factor, filter='box'):
+        """ frame downsampled by factor (see the class's description)
+        """
+
+        factor = int(factor)
+        if factor <= 1:
+            return frame
+        if filter == 'stride':
+            return frame[::factor, ::factor]
+
+        if frame is not self.frame:
+            self.begin_frame(frame)
+
+        key = (factor, filter)
+        level = self.levels.get(key)
+        if level is None:
+            if filter == 'box':
+                level = self._box(frame, factor)
+            elif filter == 'gaussian':
+                level = self._smooth(self.level(frame, factor, 'box'))
+            else:
+                raise ValueError('Unknown downsampling filter: %s' % filter)
+            self.levels[key] = level
+        return level
+
+    def _box(self, frame, factor):
+        ws = self.workspace
+        (rows, cols) = frame.shape
+        dtype = frame.dtype
+        if not issubdtype(dtype, floating):
+            dtype = float32
+
+        def blocks(n):
+            # the first row (or column) of each block, and the weights that
+            # make the blocks' sums means
+            starts = maximum(arange(0, n, factor) - (factor - 1) // 2, 0)
+            return (starts, 1. / diff(append(starts, n)))
+
+        (row_starts, row_weights) = ws.cached(('pyramid_blocks', rows,
+                factor), lambda : blocks(rows))
+        (col_starts, col_weights) = ws.cached(('pyramid_blocks', cols,
+                factor), lambda : blocks(cols))
+        weights = ws.cached(('pyramid_weights', rows, cols, factor,
+                            dtype.str), lambda : outer(row_weights,
+                            col_weights).astype(dtype))
+
+        partial = ws.get(('pyramid_rows', factor), (len(row_starts), cols),
+                         dtype)
+        add.reduceat(frame, row_starts, axis=0, dtype=dtype, out=partial)
+        level = ws.get(('pyramid_box', factor), weights.shape, dtype)
+        add.reduceat(partial, col_starts, axis=1, out=level)
+        level *= weights
+        return level
+
+    def _smooth(self, im):
+        ws = self.workspace
+        (rows, cols) = im.shape
+
+        # [1 2 1] / 4 down the columns and then along the rows, repeating
+        # the edges
+        rows_smoothed = ws.get('pyramid_smooth_rows', im.shape, im.dtype)
+        padded = ws.get('pyramid_pad_rows', (rows + 2, cols), im.dtype)
+        padded[1:-1] = im
+        padded[0] = im[0]
+        padded[-1] = im[-1]
+        add(padded[0:-2], padded[2:], rows_smoothed)
+        rows_smoothed += padded[1:-1]
+        rows_smoothed += padded[1:-1]
+
+        level = ws.get('pyramid_gaussian', im.shape, im.dtype)
+        padded = ws.get('pyramid_pad_cols', (rows, cols + 2), im.dtype)
+        padded[:, 1:-1] = rows_smoothed
+        padded[:, 0] = rows_smoothed[:, 0]
+        padded[:, -1] = rows_smoothed[:, -1]
+        add(padded[:, 0:-2], padded[:, 2:], level)
+        level += padded[:, 1:-1]
+        level += padded[:, 1:-1]
+        level *= 1. / 16
+        return level
@@ -0,0 +1,213 @@
+#
+#  MotionModel.py
+#  EyeTracker
+#
+#  Predictors for the pupil and CR positions, used to seed the starburst
+#  finder and to decide when tracking has been lost.
+#
+
+from numpy import *
+
+
+class MotionModel(object):
+    """ Predicts where the pupil and CR will be from where they have been.
+
+        predict(t) returns the predicted (pupil_position, cr_position) at
+        time t without changing the model, or None if the model has nothing
+        to go on yet.  update(pupil_position, cr_position, t) folds in a
+        measurement and returns its innovation (how far it was from the
+        prediction, in the model's units), or None if the measurement only
+        initialized the model.  An innovation greater than gate means the
+        measurement can't be trusted to have followed the eye;
+        uncertainty(t) is how far (in pixels) a measurement at time t can be
+        from the prediction within the gate.
+
+        Times are in seconds; when a time is missing, default_dt is assumed
+        to have passed since the last measurement.
+    """
+
+    def __init__(self, gate=inf, default_dt=1. / 250.):
+        self.gate = gate
+        self.default_dt = default_dt
+        self.reset()
+
+    def reset(self):
+        self.last_t = None
+        self.initialized = False
+
+    def _elapsed(self, t):
+        if t is None or self.last_t is None or t <= self.last_t:
+            return self.default_dt
+        return t - self.last_t
+
+    def _advance(self, t):
+        dt = self._elapsed(t)
+        if t is not None:
+            self.last_t = t
+        elif self.last_t is not None:
+            self.last_t += dt
+        return dt
+
+    def predict(self, t=None):
+        return None
+
+    def update(self, pupil_position, cr_position, t=None):
+        return None
+
+    def uncertainty(self, t=None):
+        return inf
+
+
+class ConstantVelocityMotionModel(MotionModel):
+    """ Extrapolates from the last two measurements.  The innovation is the
+        larger of the pupil and CR prediction errors, in pixels.
+    """
+
+    def __init__(self, gate=10., default_dt=1. / 250.):
+        MotionModel.__init__(self, gate, default_dt)
+
+    def reset(self):
+        MotionModel.reset(self)
+        # rows: pupil (y, x), cr (y, x)
+        self.position = zeros((2, 2))
+        self.velocity = zeros((2, 2))
+        self.have_velocity = False
+
+    def predict(self, t=None):
+        if not self.initialized:
+            return None
+
+        predicted = self.position + self._elapsed(t) * self.velocity
+        return (predicted[0], predicted[1])
+
+    def update(self, pupil_position, cr_position, t=None):
+        measured = array([pupil_position, cr_position], dtype=float)
+
+        if not self.initialized:
+            self._advance(t)
+            self.position[:] = measured
+            self.initialized = True
+            return None
+
+        dt = self._advance(t)
+        error = measured - (self.position + dt * self.velocity)
+
+        self.velocity[:] = (measured - self.position) / dt
+        self.position[:] = measured
+
+        innovation = sqrt((error ** 2).sum(axis=1)).max()
+        if not self.have_velocity:
+            # the first step has no velocity to predict with
+            self.have_velocity = True
+            return None
+        return innovation
+
+    def uncertainty(self, t=None):
+        return self.gate
+
+
+class KalmanMotionModel(MotionModel):
+    """ A constant-velocity Kalman filter on each pupil and CR coordinate,
+        driven by white-noise acceleration.  The coordinates share the same
+        dynamics and noise, so a single 2x2 (position, velocity) covariance
+        serves all four.  The innovation is the larger of the pupil and CR
+        prediction errors, in standard deviations of the predicted error.
+
+        measurement_noise is the standard deviation of a position
+        measurement in pixels, and process_noise that of the acceleration,
+        in pixels / s^2.
+    """
+
+    def __init__(self, gate=4., measurement_noise=0.5, process_noise=1e5,
+                 initial_velocity_sd=500., default_dt=1. / 250.):
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.initial_velocity_sd = initial_velocity_sd
+        MotionModel.__init__(self, gate, default_dt)
+
+    def reset(self):
+        MotionModel.reset(self)
+        # rows: pupil y, pupil x, cr y, cr x; columns: position, velocity
+        self.state = zeros((4, 2))
+        self.covariance = zeros((2, 2))
+
+    def _propagate(self, dt):
+        """ The state and covariance advanced by dt, without any measurement
+        """
+
+        state = self.state.copy()
+        state[:, 0] += dt * state[:, 1]
+
+        P = self.covariance
+        q = self.process_noise ** 2
+        covariance = array([[P[0, 0] + dt * (P[0, 1] + P[1, 0]) + dt * dt
+                             * P[1, 1] + q * dt ** 4 / 4.,
+                             P[0, 1] + dt * P[1, 1] + q * dt ** 3 / 2.],
+                            [P[1, 0] + dt * P[1, 1] + q * dt ** 3 / 2.,
+                             P[1, 1] + q * dt ** 2]])
+        return (state, covariance)
+
+    def predict(self, t=None):
+        if not self.initialized:
+            return None
+
+        (state, covariance) = self._propagate(self._elapsed(t))
+        return (state[0:2, 0], state[2:4, 0])
+
+    def update(self, pupil_position, cr_position, t=None):
+        measured = concatenate((asarray(pupil_position, dtype=float),
+                                asarray(cr_position, dtype=float)))
+
+        if not self.initialized:
+            self._advance(t)
+            self.state[:, 0] = measured
+            self.state[:, 1] = 0.
+            self.covariance[:] = [[self.measurement_noise ** 2, 0.],
+                                  [0., self.initial_velocity_sd ** 2]]
+            self.initialized = True
+            return None
+
+        (state, P) = self._propagate(self._advance(t))
+
+        residual = measured - state[:, 0]
+        s = P[0, 0] + self.measurement_noise ** 2
+        gain = P[:, 0] / s
+
+        self.state = state + outer(residual, gain)
+        self.covariance = P - outer(gain, P[0, :])
+
+        # normalized distance of each point from its prediction
+        distance = sqrt((residual.reshape(2, 2) ** 2).sum(axis=1) / s)
+        return distance.max()
+
+    def uncertainty(self, t=None):
+        if not self.initialized:
+            return inf
+
+        (state, covariance) = self._propagate(self._elapsed(t))
+        return self.gate * sqrt(covariance[0, 0] + self.measurement_noise
+                                ** 2)
+
+
+# Motion models that can be selected by name (e.g. from the motion_model
+# config setting)
+available_motion_models = {'none': None,
+                           'constant_velocity': ConstantVelocityMotionModel,
+                           'kalman': KalmanMotionModel}
+
+
+def make_motion_model(name='none', **kwargs):
+    """ Instantiate a motion model by name; 'none' (or None) gives None
+    """
+
+    if name is None or isinstance(name, MotionModel):
+        return name
+
+    name = str(name).lower()
+    if name not in available_motion_models:
+        raise ValueError('Unknown motion model: %s' % name)
+
+    model_class = available_motion_models[name]
+    if model_class is None:
+        return None
+    return model_class(**kwargs)
@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  NumbaBackend.py
+#  EyeTracker
+#
+#  A drop-in replacement for WovenBackend whose kernels are compiled by
+#  numba instead of scipy.weave.  Kernels are cached on disk after the
+#  first compile and release the GIL while they run.
+#
+
+import math
+from VanillaBackend import *
+from numba import jit
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _separable_convolution2d(image, row, col, firstpass, result):
+
+    h = image.shape[0]
+    w = image.shape[1]
+
+    row_width = row.shape[0]
+    if row_width % 2 == 0:
+        row_halfwidth = (row_width - 1) // 2
+    else:
+        row_halfwidth = row_width // 2
+
+    col_width = col.shape[0]
+    if col_width % 2 == 0:
+        col_halfwidth = (col_width - 1) // 2
+    else:
+        col_halfwidth = col_width // 2
+
+    # Apply the row kernel (same boundary handling as WovenBackend)
+    for r in range(h):
+        for c in range(w):
+            acc = 0.0
+            for k in range(row_width):
+                k_index = k - row_halfwidth + c
+                if k_index < 0:
+                    k_index *= -1  # reflect at boundaries
+                if k_index >= w:
+                    k_index = w - (k - row_halfwidth)
+                acc += row[k] * image[r, k_index]
+            firstpass[r, c] = acc
+
+    # Apply the col kernel
+    for r in range(h):
+        for c in range(w):
+            acc = 0.0
+            for k in range(col_width):
+                k_index = k - col_halfwidth + r
+                if k_index < 0:
+                    k_index *= -1  # reflect at boundaries
+                if k_index >= h:
+                    k_index = h - (k - col_halfwidth)
+                acc += col[k] * firstpass[k_index, c]
+            result[r, c] = acc
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _round_half_away(v):
+    # matches C's round(), which the weave kernels use
+    if v < 0:
+        return -int(math.floor(-v + 0.5))
+    return int(math.floor(v + 0.5))
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _radial_votes(mag, imgx, imgy, n, kappa, alpha, O, M, F):
+
+    rows = mag.shape[0]
+    cols = mag.shape[1]
+
+    for r in range(rows):
+        for c in range(cols):
+            O[r, c] = 0.0
+            M[r, c] = 0.0
+
+    # Form the orientation and magnitude projection matrices
+    for r in range(rows):
+        for c in range(cols):
+            posx_ = _round_half_away(c + n * imgx[r, c])
+            posy_ = _round_half_away(r + n * imgy[r, c])
+            negx_ = _round_half_away(c - n * imgx[r, c])
+            negy_ = _round_half_away(r - n * imgy[r, c])
+
+            if posx_ < 0 or posx_ > cols - 1 or posy_ < 0 or posy_ > rows \
+                - 1 or negx_ < 0 or negx_ > cols - 1 or negy_ < 0 or negy_ \
+                > rows - 1:
+                continue
+
+            O[posy_, posx_] += 1.0
+            O[negy_, negx_] -= 1.0
+
+            M[posy_, posx_] += mag[r, c]
+            M[negy_, negx_] -= mag[r, c]
+
+    for r in range(rows):
+        for c in range(cols):
+            O_ = abs(O[r, c])
+            if O_ > kappa:
+                O_ = kappa
+            F[r, c] = M[r, c] / kappa * (O_ / kappa) ** alpha
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _find_minmax(image, coordinates):
+
+    themax = image[0, 0]
+    themin = image[0, 0]
+    coordinates[0] = 0
+    coordinates[1] = 0
+    coordinates[2] = 0
+    coordinates[3] = 0
+
+    for r in range(image.shape[0]):
+        for c in range(image.shape[1]):
+            v = image[r, c]
+            if v > themax:
+                themax = v
+                coordinates[2] = r
+                coordinates[3] = c
+            if v < themin:
+                themin = v
+                coordinates[0] = r
+                coordinates[1] = c
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _is_peak(image, r, c, sign, top, bottom, left, right):
+    # whether (r, c) is at least as strong as its neighbours in the region
+    v = sign * image[r, c]
+    r_start = r - 1 if r > top else r
+    r_end = r + 2 if r + 2 < bottom else bottom
+    c_start = c - 1 if c > left else c
+    c_end = c + 2 if c + 2 < right else right
+    for rr in range(r_start, r_end):
+        for cc in range(c_start, c_end):
+            if not v >= sign * image[rr, cc]:
+                return False
+    return True
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _ranks_below(heap, i, j):
+    # whether candidate i is weaker than j, or as strong and found later
+    if heap[i, 2] != heap[j, 2]:
+        return heap[i, 2] < heap[j, 2]
+    if heap[i, 0] != heap[j, 0]:
+        return heap[i, 0] > heap[j, 0]
+    return heap[i, 1] > heap[j, 1]
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _swap_rows(heap, i, j):
+    for k in range(3):
+        t = heap[i, k]
+        heap[i, k] = heap[j, k]
+        heap[j, k] = t
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _sift_down(heap, i, count):
+    while True:
+        lowest = i
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < count and _ranks_below(heap, child, lowest):
+                lowest = child
+        if lowest == i:
+            return
+        _swap_rows(heap, i, lowest)
+        i = lowest
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _offer_candidate(heap, count, r, c, v):
+    # keep the strongest local extrema found so far in the first count rows
+    # of heap, (row, col, strength) with the weakest at the top
+    if count == heap.shape[0]:
+        # (as strong as the top, it was found later)
+        if v <= heap[0, 2]:
+            return count
+        heap[0, 0] = r
+        heap[0, 1] = c
+        heap[0, 2] = v
+        _sift_down(heap, 0, count)
+        return count
+
+    i = count
+    heap[i, 0] = r
+    heap[i, 1] = c
+    heap[i, 2] = v
+    while i > 0 and _ranks_below(heap, i, (i - 1) // 2):
+        _swap_rows(heap, i, (i - 1) // 2)
+        i = (i - 1) // 2
+    return count + 1
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _suppress(heap, count, separation, peaks):
+    # ImageProcessingBackend.suppress_peaks, on the candidates in heap
+    # into peaks; returns how many there are
+
+    # (sorted strongest first, by taking the weakest off the top in turn)
+    for end in range(count - 1, 0, -1):
+        _swap_rows(heap, 0, end)
+        _sift_down(heap, 0, end)
+
+    separation2 = separation * separation
+    n_peaks = 0
+    for i in range(count):
+        if n_peaks == peaks.shape[0]:
+            break
+        is_near = False
+        for j in range(n_peaks):
+            dr = heap[i, 0] - peaks[j, 0]
+            dc = heap[i, 1] - peaks[j, 1]
+            if dr * dr + dc * dc < separation2:
+                is_near = True
+                break
+        if not is_near:
+            for k in range(3):
+                peaks[n_peaks, k] = heap[i, k]
+            n_peaks += 1
+    return n_peaks
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _find_peaks(image, top, bottom, left, right, separation, minima, maxima,
+                minimum_candidates, maximum_candidates):
+
+    n_candidates = maximum_candidates.shape[0]
+    n_minima = 0
+    n_maxima = 0
+
+    # most rows lie within the weakest candidates kept (once there are
+    # n_candidates of them), which their max and min (in a tight loop)
+    # show, and aren't looked at any further
+    lowest_max = -inf
+    highest_min = inf
+    for r in range(top, bottom):
+        row_max = -inf
+        row_min = inf
+        for c in range(left, right):
+            v = image[r, c]
+            if v > row_max:
+                row_max = v
+            if v < row_min:
+                row_min = v
+        if not (row_max > lowest_max or row_min < highest_min):
+            continue
+
+        for c in range(left, right):
+            v = image[r, c]
+            if v > lowest_max:
+                if _is_peak(image, r, c, 1., top, bottom, left, right):
+                    n_maxima = _offer_candidate(maximum_candidates, n_maxima,
+                            r, c, v)
+                    if n_maxima == n_candidates:
+                        lowest_max = maximum_candidates[0, 2]
+            if v < highest_min:
+                if _is_peak(image, r, c, -1., top, bottom, left, right):
+                    n_minima = _offer_candidate(minimum_candidates, n_minima,
+                            r, c, -v)
+                    if n_minima == n_candidates:
+                        highest_min = -minimum_candidates[0, 2]
+
+    # (and how many candidates there were, to tell if there may be more)
+    return (_suppress(minimum_candidates, n_minima, separation, minima),
+            _suppress(maximum_candidates, n_maxima, separation, maxima),
+            n_minima, n_maxima)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _sample_ray(im, seed, rays, r, s):
+    # bilinearly interpolated image value at sample s of ray r (nan off the
+    # image), as SubpixelStarburstEyeFeatureFinder samples it
+    x = seed[0] + rays[r, s, 0]
+    y = seed[1] + rays[r, s, 1]
+    if x < 0 or x >= im.shape[0] - 1 or y < 0 or y >= im.shape[1] - 1:
+        return nan
+
+    fx = int(math.floor(x))
+    fy = int(math.floor(y))
+    cx = int(math.ceil(x))
+    cy = int(math.ceil(y))
+    xf = 1 - (x - fx)
+    yf = 1 - (y - fy)
+    return xf * yf * im[fx, fy] + (1 - xf) * yf * im[cx, fy] + xf * (1 - yf) \
+        * im[fx, cy] + (1 - xf) * (1 - yf) * im[cx, cy]
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _find_ray_boundaries(im, seed, rays, cutoff_index, threshold,
+                         has_exclusion, exclusion, points):
+
+    n_rays = rays.shape[0]
+    n_samples = rays.shape[1]
+
+    # streaming mean and (population) std of the samples inside the cutoff;
+    # with no cutoff every sample counts, and any off-image one leaves the
+    # threshold undefined (as NaNs do in the Python version)
+    stats_samples = cutoff_index
+    if cutoff_index == 0:
+        stats_samples = n_samples
+
+    n_vals = 0
+    mean_val = 0.0
+    m2 = 0.0
+    for r in range(n_rays):
+        for s in range(stats_samples):
+            val = _sample_ray(im, seed, rays, r, s)
+            if val != val:
+                if cutoff_index == 0:
+                    return 0
+                continue
+            n_vals += 1
+            delta = val - mean_val
+            mean_val += delta / n_vals
+            m2 += delta * (val - mean_val)
+
+    if n_vals == 0:
+        return 0
+
+    normalized_threshold = threshold * math.sqrt(m2 / n_vals) + mean_val
+
+    n_points = 0
+    for r in range(n_rays):
+        crossed = False
+        previous = nan
+        if cutoff_index > 0:
+            previous = _sample_ray(im, seed, rays, r, cutoff_index - 1)
+
+        for s in range(cutoff_index, n_samples):
+            val = _sample_ray(im, seed, rays, r, s)
+
+            if s == 0:
+                slope = 2.0
+            else:
+                slope = val - previous
+            if slope != slope:
+                slope = 0.0
+            previous = val
+
+            if val > normalized_threshold:
+                crossed = True
+
+            if crossed and slope <= 0:
+                # the boundary is the previous sample (which may be off the
+                # image, if the ray came onto it already above threshold)
+                bx = seed[0] + rays[r, s - 1, 0]
+                by = seed[1] + rays[r, s - 1, 1]
+
+                if has_exclusion:
+                    dx = bx - exclusion[0]
+                    dy = by - exclusion[1]
+                    if math.sqrt(dx * dx + dy * dy) <= exclusion[2]:
+                        break
+
+                points[n_points, 0] = bx
+                points[n_points, 1] = by
+                n_points += 1
+                break
+
+    return n_points
+
+
+class NumbaBackend(VanillaBackend):
+
+    def __init__(self):
+        VanillaBackend.__init__(self)
+
+        # reusable storage
+        self.cached_shape = None
+        self.M = None
+        self.O = None
+        self.F = None
+        self.sepfir_firstpass = None
+
+        self.autotuned = False
+
+    def autotune(self, example_im, **kwargs):
+
+        self.dtype = example_im.dtype
+
+        # (re)initialize reusable storage
+        self.cached_shape = example_im.shape
+        self.M = zeros_like(example_im)
+        self.O = zeros_like(example_im)
+        self.F = zeros_like(example_im)
+        self.sepfir_firstpass = zeros_like(example_im)
+
+        # run each kernel once so that compilation (or loading from the
+        # on-disk cache) doesn't land on the first real frame
+        self.fast_radial_transform(example_im, [1], 1.)
+
+        self.autotuned = True
+        self.choose_smoothing(example_im, kwargs.get('radii', None))
+        return
+
+    def sobel3x3(self, image, **kwargs):
+        return self.sobel3x3_separable(image)
+
+    def sobel3x3_separable(self, image, **kwargs):
+
+        sobel_c = array([-1., 0., 1.]).astype(image.dtype)
+        sobel_r = array([1., 2., 1.]).astype(image.dtype)
+
+        imgx = self.separable_convolution2d(image, sobel_c, sobel_r)
+        imgy = self.separable_convolution2d(image, sobel_r, sobel_c)
+
+        mag = sqrt(imgx ** 2 + imgy ** 2) + 1e-16
+
+        return (mag, imgx, imgy)
+
+    def separable_convolution2d(self, image, row, col, **kwargs):
+
+        if self.cached_shape != image.shape:
+            self.autotune(image)
+
+        row = asarray(row).astype(image.dtype)
+        col = asarray(col).astype(image.dtype)
+
+        result = zeros_like(image)
+        _separable_convolution2d(image, row, col, self.sepfir_firstpass,
+                                 result)
+        return result
+
+    # borrowed with some translation from Peter Kovesi's fastradial.m
+    def fast_radial_transform(self, image, radii, alpha, **kwargs):
+
+        if self.cached_shape != image.shape:
+            self.autotune(image)
+
+        gaussian_kernel_cheat = 1.
+
+        (mag, imgx, imgy) = self.sobel3x3_cached(image, **kwargs)
+
+        # Normalise gradient values so that [imgx imgy] form unit
+        # direction vectors.
+        imgx = imgx / mag
+        imgy = imgy / mag
+
+        M = self.M  # Magnitude projection image
+        O = self.O  # Orientation projection image
+        F = self.F  # the result, prior to accumulation
+        S = zeros_like(image)
+
+        # smoothing in the frequency domain takes the F of every radius at
+        # once
+        use_fft_filter = self._smoothing_method(image, **kwargs) == 'fft'
+        if use_fft_filter:
+            F_stack = empty((len(radii), ) + image.shape, dtype=image.dtype)
+
+        for r in range(0, len(radii)):
+
+            n = radii[r]
+
+            # values of kappa suggested by Loy and Zelinski
+            kappa = 9.9
+            if n == 1:
+                kappa = 8
+
+            if use_fft_filter:
+                F = F_stack[r]
+
+            _radial_votes(mag, imgx, imgy, float(n), kappa, float(alpha), O,
+                          M, F)
+
+            if use_fft_filter:
+                continue
+
+            # Generate a Gaussian of size proportional to n to smooth and
+            # spread the symmetry measure.
+            width = round(gaussian_kernel_cheat * n)
+            if mod(width, 2) == 0:
+                width += 1
+            gauss1d = scipy.signal.gaussian(width, 0.25 * n)
+
+            S += self.separable_convolution2d(F, gauss1d, gauss1d)
+
+        if use_fft_filter:
+            self.smooth_radial_fft(F_stack, radii, out=S)
+
+        S = S / len(radii)  # Average
+
+        return S
+
+    def find_minmax(self, image, **kwargs):
+
+        if image is None:
+            return ([0, 0], [0])
+
+        coordinates = array([0., 0., 0., 0.])
+        _find_minmax(image, coordinates)
+
+        return (coordinates[0:2], coordinates[2:4])
+
+    def find_peaks(self, image, n_peaks=1, separation=1., region=None,
+                   subpixel=True, **kwargs):
+
+        if image is None:
+            return (None, None)
+
+        if region is None:
+            region = (0, image.shape[0], 0, image.shape[1])
+        (top, bottom, left, right) = [int(bound) for bound in region]
+
+        if n_peaks == 1:
+            # just the min and max (which are always peaks)
+            coordinates = array([0., 0., 0., 0.])
+            if top < bottom and left < right:
+                _find_minmax(image[top:bottom, left:right], coordinates)
+                coordinates += [top, left, top, left]
+                (minima, maxima) = (coordinates[newaxis, 0:2],
+                                    coordinates[newaxis, 2:4])
+            else:
+                (minima, maxima) = (zeros((0, 2)), zeros((0, 2)))
+        else:
+            # (row, col, strength) of each; with more candidates if too few
+            # of them were far enough apart and there may be more
+            minima = zeros((int(n_peaks), 3))
+            maxima = zeros((int(n_peaks), 3))
+            n_candidates = int(n_peaks) * candidates_per_peak
+            while True:
+                (n_minima, n_maxima, n_minimum_candidates,
+                 n_maximum_candidates) = _find_peaks(image, top, bottom,
+                        left, right, float(separation), minima, maxima,
+                        zeros((n_candidates, 3)), zeros((n_candidates, 3)))
+                if (n_minima == n_peaks or n_minimum_candidates
+                    < n_candidates) and (n_maxima == n_peaks
+                        or n_maximum_candidates < n_candidates):
+                    break
+                n_candidates *= more_candidates
+
+            minima = minima[0:n_minima, 0:2]
+            maxima = maxima[0:n_maxima, 0:2]
+        if subpixel:
+            minima = refine_peaks(image, minima, region)
+            maxima = refine_peaks(image, maxima, region)
+        return (minima, maxima)
+
+    def find_ray_boundaries(self, im, seed_point, rays, cutoff_index,
+                            threshold, exclusion_center=None,
+                            exclusion_radius=None):
+
+        if im.dtype != float32 and im.dtype != float64:
+            im = im.astype(float64)
+
+        has_exclusion = exclusion_center is not None \
+            and size(exclusion_center) == 2
+        if has_exclusion:
+            exclusion = array([exclusion_center[0], exclusion_center[1],
+                              exclusion_radius], dtype=float64)
+        else:
+            exclusion = zeros(3)
+
+        points = zeros((rays.shape[0], 2))
+        n_points = _find_ray_boundaries(im, array(seed_point[0:2],
+                dtype=float64), ascontiguousarray(rays, dtype=float64),
+                int(max(cutoff_index, 0)), float(threshold), has_exclusion,
+                exclusion, points)
+
+        return points[0:n_points]
+
+
+def test_it():
+
+    import os
+    import time
+    import PIL.Image
+    from WovenBackend import WovenBackend
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    radii = array([2, 4, 6, 9, 12, 15])
+    alpha = 10.
+    trials = 20
+
+    numba_backend = NumbaBackend()
+    woven_backend = WovenBackend()
+
+    for name in ['Snapshot_test.bmp', 'Snapshot.bmp', 'Snapshot2.bmp']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+
+        print name, im.shape
+
+        for (label, b) in [('Woven', woven_backend), ('Numba', numba_backend)]:
+            b.autotune(im)
+            S = b.fast_radial_transform(im, radii, alpha)
+            tic = time.time()
+            for i in range(0, trials):
+                S = b.fast_radial_transform(im, radii, alpha)
+            print '\t%s: %f s' % (label, (time.time() - tic) / trials)
+
+        S_woven = woven_backend.fast_radial_transform(im, radii, alpha)
+        S_numba = numba_backend.fast_radial_transform(im, radii, alpha)
+        print '\tMax abs difference: ', max(abs(S_woven - S_numba).ravel())
+        print '\tMin/max (woven): ', woven_backend.find_minmax(S_woven)
+        print '\tMin/max (numba): ', numba_backend.find_minmax(S_numba)
+
+
+def test_peaks():
+    """ Check the peaks found in a chain of them, compare the peaks found by
+        the numba and vanilla backends on noise and on the transforms of the
+        bundled snapshots, and time them against find_minmax
+    """
+
+    import os
+    import time
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    numba_backend = NumbaBackend()
+    vanilla_backend = VanillaBackend()
+
+    backends = [numba_backend, vanilla_backend]
+    try:
+        from WovenBackend import WovenBackend
+        backends.append(WovenBackend())
+    except ImportError:
+        pass
+
+    # peaks each within separation of the next, met weakest first: the
+    # middle one is suppressed by the strongest, but not the weakest, which
+    # is further from it
+    im = zeros((5, 21))
+    im[2, 2] = 1.
+    im[2, 10] = 2.
+    im[2, 18] = 3.
+    for b in backends:
+        (minima, maxima) = b.find_peaks(im, 3, 10., subpixel=False)
+        assert allclose(maxima, [[2, 18], [2, 2]]), (b, maxima)
+        (minima, maxima) = b.find_peaks(-im, 3, 10., subpixel=False)
+        assert allclose(minima, [[2, 18], [2, 2]]), (b, minima)
+    print 'Chain of peaks'
+
+    # a plateau, and a cluster of peaks each a pixel apart, with more
+    # extrema in them than are kept as candidates at first, besides two
+    # weaker peaks further away
+    (rows, cols) = mgrid[0:12, 0:12]
+    for texture in (0., 0.01):
+        im = zeros((32, 44))
+        im[2:14, 2:14] = 3. + texture * ((rows % 2 == 0) & (cols % 2 == 0))
+        im[28, 35] = 2.
+        im[2, 37] = 1.
+        for b in backends:
+            (minima, maxima) = b.find_peaks(im, 3, 17., subpixel=False)
+            assert allclose(maxima, [[2, 2], [28, 35], [2, 37]]), (b,
+                    texture, maxima)
+            (minima, maxima) = b.find_peaks(-im, 3, 17., subpixel=False)
+            assert allclose(minima, [[2, 2], [28, 35], [2, 37]]), (b,
+                    texture, minima)
+    print 'Plateau and cluster of peaks'
+
+    random_state = random.RandomState(0)
+    for trial in range(0, 100):
+        (rows, cols) = random_state.randint(1, 40, 2)
+        im = random_state.normal(0, 1, (rows, cols)).astype(float32)
+        if trial % 2:
+            im = around(2 * im)  # with plateaus
+        n_peaks = random_state.randint(1, 6)
+        separation = random_state.uniform(0, 8)
+        region = None
+        if trial % 3 and rows > 3 and cols > 3:
+            region = (1, rows - 1, 2, cols - 1)
+        for subpixel in (False, True):
+            found = zip(numba_backend.find_peaks(im, n_peaks, separation,
+                        region, subpixel),
+                        vanilla_backend.find_peaks(im, n_peaks, separation,
+                        region, subpixel))
+            for (a, b) in found:
+                assert a.shape == b.shape and allclose(a, b), (trial, a, b)
+    print 'Same peaks'
+
+    radii = array([2, 4, 6, 9, 12, 15])
+    alpha = 10.
+    trials = 200
+
+    for name in ['Snapshot_test.bmp', 'Snapshot.bmp', 'Snapshot2.bmp']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+
+        S = numba_backend.fast_radial_transform(im, radii, alpha).copy()
+        separation = max(radii)
+
+        print name, S.shape
+        print '\tMin/max: ', numba_backend.find_minmax(S)
+        print '\tPeaks (numba): ', numba_backend.find_peaks(S, 3,
+                separation)
+        print '\tPeaks (vanilla): ', vanilla_backend.find_peaks(S, 3,
+                separation)
+
+        for (label, f) in [('find_minmax', lambda: \
+                           numba_backend.find_minmax(S)), ('find_peaks (1)',
+                           lambda: numba_backend.find_peaks(S, 1,
+                           separation)), ('find_peaks (3)', lambda: \
+                           numba_backend.find_peaks(S, 3, separation))]:
+            f()
+            tic = time.time()
+            for i in range(0, trials):
+                f()
+            print '\t%s: %f ms' % (label, 1000. * (time.time() - tic)
+                                   / trials)
+
+
+if __name__ == '__main__':
+    test_it()
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from VanillaBackend import *
-from WovenBackend import *
 from OpenCLImageProcessing import *
 
 import numpy
@@ -9,10 +8,16 @@ import pyopencl as cl
 mf = cl.mem_flags
 
 
-class OpenCLBackend(WovenBackend):
+class OpenCLBackend(VanillaBackend):
+    """ Runs the fast radial transform on an OpenCL device (a GPU, or a
+        CPU implementation such as pocl), from the upload of the image to
+        the min/max of the result (see FastRadialTransformKernel), and the
+        separable convolutions with LocalMemorySeparableConvolutionKernel;
+        the rest is VanillaBackend's.
+    """
 
     def __init__(self):
-        WovenBackend.__init__(self)
+        VanillaBackend.__init__(self)
         platforms = cl.get_platforms()
         platform = platforms[0]
         devices = platform.get_devices()
@@ -21,114 +26,131 @@ class OpenCLBackend(WovenBackend):
         self.queue = cl.CommandQueue(self.ctx)
         self.convolution_cl_kernel = \
             LocalMemorySeparableConvolutionKernel(self.queue)
+        self.fast_radial_cl_kernel = FastRadialTransformKernel(self.queue)
 
     def autotune(self, example_im, **kwargs):
+        ImageProcessingBackend.autotune(self, example_im)
         self.autotuned = True
 
-#    def _sobel_3x3(self, im, **kwargs):
-#        return (imgx, imgy, mag)
+    def variants(self, operation):
+        # (the device transform has only the one way of smoothing)
+        return ImageProcessingBackend.variants(self, operation)
 
     def separable_convolution2d(self, im, row, col, **kwargs):
-        return self.convolution_cl_kernel(im, row, col,
+        return self.convolution_cl_kernel(im.astype(numpy.float32),
+                numpy.asarray(row, dtype=numpy.float32),
+                numpy.asarray(col, dtype=numpy.float32),
                 readback_from_device=True)
 
-    def _fast_radial_transform(self, im, radii, alpha, **kwargs):
-
-        if readback_from_device:
-            pass
-
+    def fast_radial_transform(self, im, radii, alpha, **kwargs):
+        (min_coord, max_coord, S) = self.fast_radial_cl_kernel(im, radii,
+                alpha, readback_transform=True)
         return S
 
+    def fast_radial_minmax(self, im, radii, alpha, region=None,
+                           keep_transform=True, **kwargs):
+        (min_coord, max_coord, S) = self.fast_radial_cl_kernel(im, radii,
+                alpha, region=region, readback_transform=keep_transform)
+
+        # (masked as the other backends' is, for the albino search)
+        if S is not None:
+            mask_outside(S, region)
+
+        return (min_coord, max_coord, S)
+
+    def fast_radial_peaks(self, im, radii, alpha, region=None,
+                          keep_transform=True, n_peaks=1, separation=1.,
+                          subpixel=True, **kwargs):
+        # the device only finds the min and max; for more peaks, or to refine
+        # them, the transform is read back and searched on the host
+        if n_peaks == 1 and not subpixel:
+            (min_coord, max_coord, S) = self.fast_radial_minmax(im, radii,
+                    alpha, region, keep_transform, **kwargs)
+            return (array([min_coord], dtype=float).reshape(-1, 2),
+                    array([max_coord], dtype=float).reshape(-1, 2), S)
+
+        (min_coord, max_coord, S) = self.fast_radial_minmax(im, radii, alpha,
+                region, True, **kwargs)
+        (minima, maxima) = self.find_peaks(S, n_peaks, separation, region,
+                                           subpixel)
+        return (minima, maxima, S)
+
+
+def test_it():
+    """ Compare the device transform, and its min/max, with the compiled
+        backends' on the bundled snapshots (on whatever OpenCL device comes
+        first, e.g. pocl's CPU device)
+    """
+
+    import os
+    import time
+    import PIL.Image
+
+    try:
+        from NumbaBackend import NumbaBackend
+        reference = NumbaBackend()
+    except ImportError:
+        from WovenBackend import WovenBackend
+        reference = WovenBackend()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    radii = array([2, 4, 6, 9, 12, 15])
+    alpha = 10.
+    trials = 10
 
-if __name__ == '__main__':
-
-    from numpy.random import rand
-    from pylab import *
-
-    test_im = rand(2250, 2250).astype(numpy.float32)
-    # test_im = (rand(768,1024)).astype(numpy.float32)
-    row = array([0.25, 0.3, 0.4]).astype(numpy.float32)
-    # row = array([0.25, 0.3, 0.4, 0.6, 0.7, 0.6, 0.4, 0.3, 0.25]).astype(numpy.float32)
-    # row = array([0.25, 0.4, 0.6, 0.4, 0.25]).astype(numpy.float32)
-    row = row / sum(row)
+    cl_backend = OpenCLBackend()
+    print 'Device: ', cl_backend.queue.device.name
+
+    for name in ['Snapshot.bmp', 'Snapshot2.bmp', 'RatEye_snap6.tiff']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+        (rows, cols) = im.shape
+
+        print name, im.shape
+
+        reference.autotune(im)
+        S_reference = reference.fast_radial_transform(im, radii, alpha,
+                smoothing='sepfir')
+        S = cl_backend.fast_radial_transform(im, radii, alpha)
+        print '\tMax abs difference (relative): ', max(abs(S
+                - S_reference).ravel()) / max(abs(S_reference).ravel())
+        print '\tMin/max (reference): ', reference.find_minmax(S_reference)
+
+        (min_coord, max_coord, S) = cl_backend.fast_radial_minmax(im, radii,
+                alpha, keep_transform=False)
+        print '\tMin/max (device): ', (min_coord, max_coord)
+        assert S is None
+
+        # within a region, as a finder masks it
+        region = (rows // 4, 3 * rows // 4, cols // 4, 3 * cols // 4)
+        (top, bottom, left, right) = region
+        masked = S_reference.copy()
+        masked[:, 0:left] = -1.
+        masked[:, right:] = -1.
+        masked[0:top, :] = -1.
+        masked[bottom:, :] = -1.
+        print '\tMin/max in %s (reference): ' % (region, ), \
+            reference.find_minmax(masked)
+        print '\tMin/max in %s (device): ' % (region, ), \
+            cl_backend.fast_radial_minmax(im, radii, alpha, region=region,
+                keep_transform=False)[0:2]
+
+        tic = time.time()
+        for i in range(0, trials):
+            reference.fast_radial_transform(im, radii, alpha,
+                    smoothing='sepfir')
+        print '\tReference transform: %f ms' % (1000. * (time.time() - tic)
+                / trials)
+        tic = time.time()
+        for i in range(0, trials):
+            cl_backend.fast_radial_minmax(im, radii, alpha,
+                    keep_transform=False)
+        print '\tDevice transform and min/max: %f ms' % (1000.
+                * (time.time() - tic) / trials)
 
-    col = row
 
-    cl_backend = OpenCLBackend()
-    vanilla_backend = VanillaBackend()
-    woven_backend = WovenBackend()
-
-    woven_backend.autotune(test_im)
-    cl_backend.autotune(test_im)
-    print 'CL Filtering...'
-    # row_dev = cl.Buffer(cl_backend.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, 0, row.astype(float32))
-    # col_dev = cl.Buffer(cl_backend.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, 0, col.astype(float32))
-
-    row_dev = DeviceBuffer(cl_backend.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR,
-                           row.astype(float32))
-    col_dev = DeviceBuffer(cl_backend.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR,
-                           col.astype(float32))
-
-    # print cl_backend.device.name
-
-    cl_filtered = cl_backend.separable_convolution2d(
-        test_im.astype(float32),
-        row_dev,
-        col_dev,
-        readback_from_device=False,
-        im_shape=test_im.shape,
-        row_shape=row.shape,
-        col_shape=col.shape,
-        )
-    for i in range(0, 8):
-        cl_filtered = cl_backend.separable_convolution2d(
-            cl_filtered,
-            row_dev,
-            col_dev,
-            readback_from_device=False,
-            im_shape=test_im.shape,
-            row_shape=row.shape,
-            col_shape=col.shape,
-            )
-    cl_filtered = cl_backend.separable_convolution2d(
-        cl_filtered,
-        row_dev,
-        col_dev,
-        readback_from_device=True,
-        im_shape=test_im.shape,
-        row_shape=row.shape,
-        col_shape=col.shape,
-        )
-
-    print 'Vanilla Filtering...'
-    vanilla_filtered = \
-        vanilla_backend.separable_convolution2d(test_im.astype(float32), row,
-            col)
-    for i in range(0, 8):
-        vanilla_filtered = \
-            vanilla_backend.separable_convolution2d(vanilla_filtered, row, col)
-    vanilla_filtered = \
-        vanilla_backend.separable_convolution2d(vanilla_filtered, row, col)
-
-    print 'Woven filtering...'
-    woven_filtered = \
-        woven_backend.separable_convolution2d(test_im.astype(float32), row, col)
-    for i in range(0, 9):
-        woven_filtered = woven_backend.separable_convolution2d(woven_filtered,
-                row, col)
-
-    # print(vanilla_filtered)
-
-    # print(cl_filtered)
-
-    vmin = 0.4
-    vmax = 0.6
-
-    subplot(3, 1, 1)
-    imshow(cl_filtered, vmin=vmin, vmax=vmax)
-    subplot(3, 1, 2)
-    imshow(vanilla_filtered, vmin=vmin, vmax=vmax)
-    subplot(3, 1, 3)
-    imshow(woven_filtered, vmin=vmin, vmax=vmax)
-
-    # show()
+if __name__ == '__main__':
+    test_it()
@@ -2,59 +2,13 @@
 # -*- coding: utf-8 -*-
 import pyopencl as cl
 import numpy
+import scipy.signal
 from stopwatch import *
 import mako.template
+from AcceleratorRuntime import *
 mf = cl.mem_flags
 
 
-class NoProgramToFreezeException(Exception):
-
-    def __str__(self):
-        return 'No cl program to freeze'
-
-
-class KernelMustUseFloat32Exception(Exception):
-
-    def __str__(self):
-        return 'This kernel only operates on float32 data'
-
-
-class UnknownArrayShapeException(Exception):
-
-    def __str__(self):
-        return 'Array shape unknown for OpenCL buffer object'
-
-
-# Helper functions for computing alignment...
-
-def int_div_up(a, b):
-    # Round a / b to nearest higher integer value
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return (a / b + 1 if a % b != 0 else a / b)
-
-
-def int_div_down(a, b):
-    # Round a / b to nearest lower integer value
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return a / b
-
-
-def int_align_up(a, b):
-    # Align a to nearest higher multiple of b
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return (a - a % b + b if a % b != 0 else a)
-
-
-def int_align_down(a, b):
-    # Align a to nearest lower multiple of b
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return a - a % b
-
-
 class DeviceBuffer(cl.Buffer):
 
     def __init__(self, ctx, flags, arr=None, **kwargs):
@@ -66,36 +20,61 @@ class DeviceBuffer(cl.Buffer):
         else:
             self.shape = kwargs.get('shape', None)
             if self.shape is None:
-                raise UnknownShapeException
+                raise UnknownArrayShapeException
             self.dtype = kwargs.get('dtype', numpy.float32)
             dummy = numpy.zeros((1, 1), dtype=self.dtype)
-            cl.Buffer.__init__(self, ctx, flags, dummy.itemsize * self.shape[0]
-                               * self.shape[1])
+            cl.Buffer.__init__(self, ctx, flags, dummy.itemsize
+                               * int(numpy.prod(self.shape)))
 
 
-class MetaKernel:
+class OpenCLRuntime(object):
+    """ The device of an OpenCL command queue, as a ProgramCache and
+        BufferPool (see AcceleratorRuntime) see it
+    """
 
     def __init__(self, queue):
-        self.cached_programs = {}
-        self.last_program = None
-        self.frozen_program = None
         self.queue = queue
         self.ctx = queue.get_info(cl.command_queue_info.CONTEXT)
+        self.device = queue.get_info(cl.command_queue_info.DEVICE)
+
+    def device_key(self):
+        return (self.ctx, self.device)
+
+    def device_name(self):
+        return 'OpenCL %s %s %s' % (self.device.platform.name,
+                                    self.device.name,
+                                    self.device.driver_version)
+
+    def build(self, source):
+        program = cl.Program(self.ctx, source).build(devices=[self.device])
+        devices = program.get_info(cl.program_info.DEVICES)
+        binaries = program.get_info(cl.program_info.BINARIES)
+        return (program, bytes(binaries[devices.index(self.device)]))
+
+    def load(self, binary):
+        return cl.Program(self.ctx, [self.device],
+                          [binary]).build(devices=[self.device])
+
+    def allocate(self, shape, dtype):
+        return DeviceBuffer(self.ctx, mf.READ_WRITE, shape=shape, dtype=dtype)
+
+    def allocate_pinned(self, shape, dtype):
+        # page-locked host memory, as an array mapped from a buffer the
+        # implementation allocates (and which the mapping keeps alive)
+        buf = cl.Buffer(self.ctx, mf.READ_WRITE | mf.ALLOC_HOST_PTR,
+                        int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize)
+        (host, evt) = cl.enqueue_map_buffer(self.queue, buf,
+                cl.map_flags.READ | cl.map_flags.WRITE, 0, shape, dtype)
+        evt.wait()
+        return host
 
-    def __call__(self, *args, **kwargs):
-        return
-
-    def freeze(self):
-        if self.last_program == None:
-            raise NoProgramToFreezeException
-        self.frozen_program = self.last_program
 
-    def thaw(self):
-        self.frozen_program = None
+class MetaKernel(AcceleratorKernel):
 
-    def cache_program(self, key, program):
-        self.cached_programs[key] = program
-        self.last_program = program
+    def __init__(self, queue):
+        AcceleratorKernel.__init__(self, OpenCLRuntime(queue))
+        self.queue = queue
+        self.ctx = self.runtime.ctx
 
     # #@clockit
     def transfer_to_device(self, buf):
@@ -115,11 +94,10 @@ class MetaKernel:
             # print("Allocating result buffer")
             shape = result_device.shape
             dtype = result_device.dtype
-            print dtype
             result_host = numpy.zeros(shape, dtype=dtype)
 
-        evt = cl.enqueue_read_buffer(self.queue, result_device, result_host)
-        evt.wait()
+        cl.enqueue_copy(self.queue, result_host, result_device,
+                        wait_for=kwargs.get('wait_for', None))
         return result_host
 
 
@@ -127,10 +105,6 @@ class NaiveSeparableConvolutionKernel(MetaKernel):
 
     def __init__(self, queue):
         MetaKernel.__init__(self, queue)
-        self.cached_intermediate_buffers = {}
-        self.cached_result_buffers = {}
-        self.cached_row_kernels = {}
-        self.cached_col_kernels = {}
 
     # ##@clockit
     def build_program(self):
@@ -207,16 +181,12 @@ class NaiveSeparableConvolutionKernel(MetaKernel):
 
             }
         """
-        program = cl.Program(self.ctx, code)
-
         try:
-            program.build()
+            program = self.cache_program(None, code)
         except cl.RuntimeError, e:
             print e
             exit()
 
-        self.cache_program(None, program)
-
         return program
 
     # ##@clockit
@@ -233,31 +203,20 @@ class NaiveSeparableConvolutionKernel(MetaKernel):
         row_dev = self.transfer_to_device(row_kernel)
         col_dev = self.transfer_to_device(col_kernel)
 
-        if None in self.cached_programs:
-            prg = self.cached_programs[None]
-        else:
+        prg = self.cached_program(None)
+        if prg is None:
             prg = self.build_program()
 
         # a device buffer for the intermediate result
-        intermediate_dev = None
-        if use_cached_buffers and input_shape \
-            in self.cached_intermediate_buffers:
-            intermediate_dev = self.cached_intermediate_buffers[input_im.shape]
-        else:
-            intermediate_dev = DeviceBuffer(self.ctx, mf.READ_WRITE,
-                    shape=input_im.shape, dtype=input_im.dtype)
-            self.cached_intermediate_buffers[input_shape] = intermediate_dev
+        intermediate_dev = self.buffer('intermediate', input_im.shape,
+                input_im.dtype, use_cached_buffers)
 
         # a device buffer for the result, if not already supplied
         result_dev = None
         if result is None or result.__class__ == numpy.ndarray:
             # need to make or repurpose a device buffer
-            if use_cached_buffers and input_shape in self.cached_result_buffers:
-                result_dev = self.cached_result_buffers[input_shape]
-            else:
-                result_dev = DeviceBuffer(self.ctx, mf.READ_WRITE,
-                        input_im.shape[0] * input_im.shape[1] * 4)
-                self.cached_result_buffers[input_shape] = result_dev
+            result_dev = self.buffer('result', input_im.shape,
+                    input_im.dtype, use_cached_buffers)
         else:
 
             # assume that result is a device buffer already (possibly not a safe assumption)
@@ -268,6 +227,7 @@ class NaiveSeparableConvolutionKernel(MetaKernel):
             exec_evt = prg.separable_convolution_row(
                 self.queue,
                 input_im.shape,
+                None,
                 intermediate_dev,
                 input_dev,
                 numpy.uint32(input_im.shape[1]),
@@ -290,6 +250,7 @@ class NaiveSeparableConvolutionKernel(MetaKernel):
             exec_evt = prg.separable_convolution_col(
                 self.queue,
                 input_im.shape,
+                None,
                 result_dev,
                 intermediate_dev,
                 numpy.uint32(input_im.shape[1]),
@@ -323,10 +284,7 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
 
     def __init__(self, queue):
         MetaKernel.__init__(self, queue)
-        self.cached_intermediate_buffers = {}
-        self.cached_result_buffers = {}
-        self.cached_row_kernels = {}
-        self.cached_col_kernels = {}
+        self.cached_queues = [queue]
 
     # ##@clockit
     def build_program(self, dtype, im_shape, row_kernel_radius,
@@ -343,6 +301,7 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
 
         col_input_load_stride = image_width * col_hstride
         col_tile_cache_stride = col_tile_width * col_hstride
+        frame_size = image_width * image_height
 
         TYPE = ''
         if dtype == numpy.float32:
@@ -360,6 +319,10 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
                                                     __global const float *row_kernel){
 
                 __local ${TYPE} tile_cache[${tile_cache_width}];
+
+                // the third dimension runs over the frames of a stack
+                input += get_global_id(2) * ${frame_size};
+                output += get_global_id(2) * ${frame_size};
                 
                 // --------------------------------------------------------------------
                 // Cooperatively load a tile of data into the local memory tile cache
@@ -439,6 +402,9 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
 
                 __local float tile_cache[${col_tile_width} * (2*${col_kernel_radius} + ${col_tile_height})];
 
+                input += get_global_id(2) * ${frame_size};
+                output += get_global_id(2) * ${frame_size};
+
                 
                 // --------------------------------------------------------------------
                 // Cooperatively load a tile of data into the local memory tile cache
@@ -471,8 +437,10 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
                 // Compute the starting position to load data into in the tile cache
                 int     tile_cache_offset = get_local_id(1) * ${col_tile_width} + get_local_id(0);
                 
-                // Do the actual loads
-                for(int y = apron_start + get_local_id(1); y <= apron_end; y += get_local_size(1)){
+                // Do the actual loads (the last tile may overhang the right edge
+                // of the image, so those threads only join in the barrier)
+                const bool  in_image = col_start_offset < ${image_width};
+                for(int y = apron_start + get_local_id(1); in_image && y <= apron_end; y += get_local_size(1)){
                     if( y < 0 ){
                         tile_cache[tile_cache_offset] = (float)input[col_start_offset - y *${image_width}];
                     } else if(y > apron_end_clamped){
@@ -498,7 +466,7 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
                 input_load_offset = (tile_start + get_local_id(1)) * ${image_width} + col_start_offset;
                 tile_cache_offset = (get_local_id(1) + ${col_kernel_radius}) * ${col_tile_width} + get_local_id(0);
                 
-                for(int y = tile_start + get_local_id(1); y <= tile_end_clamped; y += get_local_size(1)){
+                for(int y = tile_start + get_local_id(1); in_image && y <= tile_end_clamped; y += get_local_size(1)){
                     float sum = 0;
                     
                     %for k in range(-col_kernel_radius, col_kernel_radius+1):
@@ -517,54 +485,39 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
         local_vars.pop('self')
         templated_code = mako.template.Template(code).render(**local_vars)
         # print templated_code
-        program = cl.Program(self.ctx, templated_code)
 
         try:
-            program.build()
+            program = self.cache_program((
+                dtype,
+                im_shape,
+                row_kernel_radius,
+                row_kernel_radius_aligned,
+                row_tile_width,
+                col_kernel_radius,
+                col_tile_width,
+                col_tile_height,
+                col_hstride,
+                ), templated_code)
         except cl.RuntimeError, e:
             print e
             exit()
 
-        self.cache_program((
-            dtype,
-            im_shape,
-            row_kernel_radius,
-            row_kernel_radius_aligned,
-            row_tile_width,
-            col_kernel_radius,
-            col_tile_width,
-            col_tile_height,
-            col_hstride,
-            ), program)
-
         print 'Done building.'
         return program
 
-    # @clockit
-    def __call__(self, input_im, row_kernel, col_kernel, result=None,
-                 input_shape=None, row_shape=None, col_shape=None, **kwargs):
-
-        use_cached_buffers = kwargs.get('use_cached_buffers', True)
-
-        if input_im.__class__ == numpy.ndarray and input_im.dtype \
-            != numpy.float32:
-            print input_im.dtype
-            raise KernelMustUseFloat32Exception
-
-        wait_for = kwargs.get('wait_for', None)
-
-        input_dev = self.transfer_to_device(input_im)
-        row_dev = self.transfer_to_device(row_kernel)
-        col_dev = self.transfer_to_device(col_kernel)
+    def configure(self, dtype, im_shape, row_width, col_width):
+        """ The program for images of dtype and shape im_shape, and kernels
+            of row_width and col_width taps, with the (global, local) work
+            sizes of its row and column passes over one frame
+        """
 
         row_tile_width = 128
         col_tile_width = 16
         col_tile_height = 48
         col_hstride = 8
-        assert numpy.mod(row_dev.shape[0], 2) == 1, \
-            'Kernels must be of odd width'
+        assert numpy.mod(row_width, 2) == 1, 'Kernels must be of odd width'
 
-        row_kernel_radius = row_dev.shape[0] / 2
+        row_kernel_radius = row_width / 2
 
         coallescing_quantum = 16
         row_kernel_radius_aligned = row_kernel_radius / coallescing_quantum \
@@ -572,14 +525,13 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
         if row_kernel_radius_aligned == 0:
             row_kernel_radius_aligned = coallescing_quantum
 
-        assert numpy.mod(col_dev.shape[0], 2) == 1, \
-            'Kernels must be of odd width'
-        col_kernel_radius = col_dev.shape[0] / 2
+        assert numpy.mod(col_width, 2) == 1, 'Kernels must be of odd width'
+        col_kernel_radius = col_width / 2
 
         # build_args = (im_type, im_shape, row_kernel_radius, row_kernel_radius_aligned, row_tile_width, col_kernel_radius, col_tile_width, col_tile_height, col_hstride
         build_args = (
-            input_im.dtype,
-            input_im.shape,
+            dtype,
+            tuple(im_shape),
             row_kernel_radius,
             row_kernel_radius_aligned,
             row_tile_width,
@@ -588,115 +540,93 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
             col_tile_height,
             col_hstride,
             )
-        if build_args in self.cached_programs:
-            prg = self.cached_programs[build_args]
-        else:
+        prg = self.cached_program(build_args)
+        if prg is None:
             prg = self.build_program(*build_args)
 
         row_local_size = (row_kernel_radius_aligned + row_tile_width
                           + row_kernel_radius, 1)
-        row_group_size = (int_div_up(input_im.shape[1], row_tile_width),
-                          input_im.shape[0])
+        row_group_size = (int_div_up(im_shape[1], row_tile_width),
+                          im_shape[0])
         row_global_size = (row_local_size[0] * row_group_size[0],
                            row_local_size[1] * row_group_size[1])
 
         col_local_size = (col_tile_width, col_hstride)
-        col_group_size = (int_div_up(input_im.shape[1], col_tile_width),
-                          int_div_up(input_im.shape[0], col_tile_height))
+        col_group_size = (int_div_up(im_shape[1], col_tile_width),
+                          int_div_up(im_shape[0], col_tile_height))
         col_global_size = (col_local_size[0] * col_group_size[0],
                            col_local_size[1] * col_group_size[1])
 
-        # print col_local_size
-        # print col_group_size
-        # print col_global_size
+        return (prg, (row_global_size, row_local_size), (col_global_size,
+                col_local_size))
+
+    def enqueue(self, queue, configuration, n_frames, result_dev,
+                intermediate_dev, input_dev, row_dev, col_dev, wait_for=None):
+        """ Enqueue both passes over n_frames consecutive frames, returning
+            the event of the last
+        """
+
+        (prg, (row_global_size, row_local_size), (col_global_size,
+         col_local_size)) = configuration
+
+        # (the third dimension runs over the frames)
+        row_evt = prg.separable_convolution_row(
+            queue,
+            [int(e) for e in row_global_size] + [int(n_frames)],
+            [int(e) for e in row_local_size] + [1],
+            intermediate_dev,
+            input_dev,
+            row_dev,
+            wait_for=wait_for,
+            )
+        return prg.separable_convolution_col(
+            queue,
+            [int(e) for e in col_global_size] + [int(n_frames)],
+            [int(e) for e in col_local_size] + [1],
+            result_dev,
+            intermediate_dev,
+            col_dev,
+            wait_for=[row_evt],
+            )
+
+    # @clockit
+    def __call__(self, input_im, row_kernel, col_kernel, result=None,
+                 input_shape=None, row_shape=None, col_shape=None, **kwargs):
+
+        use_cached_buffers = kwargs.get('use_cached_buffers', True)
+
+        if input_im.__class__ == numpy.ndarray and input_im.dtype \
+            != numpy.float32:
+            print input_im.dtype
+            raise KernelMustUseFloat32Exception
+
+        wait_for = kwargs.get('wait_for', None)
+
+        input_dev = self.transfer_to_device(input_im)
+        row_dev = self.transfer_to_device(row_kernel)
+        col_dev = self.transfer_to_device(col_kernel)
+
+        configuration = self.configure(input_im.dtype, input_im.shape,
+                row_dev.shape[0], col_dev.shape[0])
 
         # a device buffer for the intermediate result
-        intermediate_dev = None
-        if use_cached_buffers and (input_im.shape, input_im.dtype) \
-            in self.cached_intermediate_buffers:
-            intermediate_dev = \
-                self.cached_intermediate_buffers[(input_im.shape,
-                    input_im.dtype)]
-        else:
-            # dummy = numpy.array([1], dtype=input_type)
-            # intermediate_dev = cl.Buffer(self.ctx, mf.READ_WRITE, input_shape[0] * input_shape[1] * dummy.itemsize)
-            intermediate_dev = DeviceBuffer(self.ctx, mf.READ_WRITE,
-                    shape=input_im.shape, dtype=input_im.dtype)
-            self.cached_intermediate_buffers[(input_im.shape,
-                    input_im.dtype)] = intermediate_dev
+        intermediate_dev = self.buffer('intermediate', input_im.shape,
+                input_im.dtype, use_cached_buffers)
 
         # a device buffer for the result, if not already supplied
         result_dev = None
         if result is None or result.__class__ == numpy.ndarray:
             # need to make or repurpose a device buffer
-            if use_cached_buffers and (input_im.shape, input_im.dtype) \
-                in self.cached_result_buffers:
-                result_dev = self.cached_result_buffers[(input_im.shape,
-                        input_im.dtype)]
-            else:
-                # print "Here"
-                # print(result_dev)
-                # dummy = numpy.array([1], dtype=input_im.dtype)
-                # result_dev = cl.Buffer(self.ctx, mf.READ_WRITE, input_shape[0] * input_shape[1] * dummy.itemsize)
-                result_dev = DeviceBuffer(self.ctx, mf.READ_WRITE,
-                        shape=input_im.shape, dtype=input_im.dtype)
-                self.cached_result_buffers[(input_im.shape, input_im.dtype)] = \
-                    result_dev
+            result_dev = self.buffer('result', input_im.shape,
+                    input_im.dtype, use_cached_buffers)
         else:
 
             # assume that result is a device buffer already (possibly not a safe assumption)
             result_dev = result
 
-        # t = Timer()
-        try:
-            if wait_for is not None:
-                row_evt = prg.separable_convolution_row(
-                    self.queue,
-                    [int(e) for e in row_global_size],
-                    intermediate_dev,
-                    input_dev,
-                    row_dev,
-                    local_size=[int(e) for e in row_local_size],
-                    wait_for=wait_for,
-                    )
-            else:
-                row_evt = prg.separable_convolution_row(
-                    self.queue,
-                    [int(e) for e in row_global_size],
-                    intermediate_dev,
-                    input_dev,
-                    row_dev,
-                    local_size=[int(e) for e in row_local_size],
-                    )
-        except Exception, e:
-            print input_im.shape
-            print intermediate_dev
-            print input_dev
-            print row_dev
-            print row_global_size
-            print row_local_size
-            print wait_for
-            raise e
-
-        try:
-            exec_evt = prg.separable_convolution_col(
-                self.queue,
-                [int(e) for e in col_global_size],
-                result_dev,
-                intermediate_dev,
-                col_dev,
-                local_size=[int(e) for e in col_local_size],
-                wait_for=[row_evt],
-                )
-        except Exception, e:
-            print input_im.shape
-            print result_dev
-            print intermediate_dev
-            print col_dev
-            print col_dev.shape
-            raise e
-        # exec_evt.wait()
-        # print("Elapsed: %f" % t.elapsed)
+        exec_evt = self.enqueue(self.queue, configuration, 1, result_dev,
+                                intermediate_dev, input_dev, row_dev,
+                                col_dev, wait_for)
 
         evt = None
         if kwargs.get('readback_from_device', False):
@@ -704,7 +634,7 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
                 result = self.transfer_from_device(result_dev,
                         shape=input_im.shape, wait_for=[exec_evt])
             else:
-                self.transfer_from_device(result_dev, result, wait_for=exec_evt)
+                self.transfer_from_device(result_dev, result, wait_for=[exec_evt])
         else:
             result = result_dev
             evt = [exec_evt]
@@ -714,234 +644,618 @@ class LocalMemorySeparableConvolutionKernel(MetaKernel):
         else:
             return (result, evt)
 
+    def convolve_stack(self, stack, row_kernel, col_kernel, result=None,
+                       frames_per_launch=8, n_queues=2):
+        """ Convolve every frame of an N x H x W float32 stack, returning the
+            N x H x W stack of results (in result, if given).
+
+            The frames go to the device frames_per_launch at a time, each
+            chunk convolved by one launch per pass, and the chunks are dealt
+            round n_queues command queues, each with its own pinned host
+            buffers to stage them through; so while one chunk is convolved,
+            the next is uploaded and the last read back.
+        """
+
+        stack = numpy.asarray(stack)
+        if stack.dtype != numpy.float32:
+            raise KernelMustUseFloat32Exception
+        stack = numpy.ascontiguousarray(stack)
+        (n, rows, cols) = stack.shape
+        if result is None:
+            result = numpy.empty_like(stack)
+
+        row_dev = self.transfer_to_device(numpy.asarray(row_kernel,
+                dtype=numpy.float32))
+        col_dev = self.transfer_to_device(numpy.asarray(col_kernel,
+                dtype=numpy.float32))
+        configuration = self.configure(stack.dtype, (rows, cols),
+                row_dev.shape[0], col_dev.shape[0])
+
+        chunk = max(1, min(frames_per_launch, n))
+        shape = (chunk, rows, cols)
+
+        slots = []
+        for (k, queue) in enumerate(self.batch_queues(n_queues)):
+            slots.append({
+                'queue': queue,
+                'upload': self.pinned(('upload', k), shape, stack.dtype),
+                'readback': self.pinned(('readback', k), shape, stack.dtype),
+                'input': self.buffer(('input', k), shape, stack.dtype),
+                'intermediate': self.buffer(('intermediate', k), shape,
+                        stack.dtype),
+                'result': self.buffer(('result', k), shape, stack.dtype),
+                'pending': None,
+                })
+
+        def finish(slot):
+            # (the readback following the last use of the slot's buffers)
+            (start, count, evt) = slot['pending']
+            evt.wait()
+            result[start:start + count] = slot['readback'][0:count]
+            slot['pending'] = None
+
+        for (i, start) in enumerate(range(0, n, chunk)):
+            slot = slots[i % len(slots)]
+            if slot['pending'] is not None:
+                finish(slot)
+
+            count = min(chunk, n - start)
+            slot['upload'][0:count] = stack[start:start + count]
+
+            queue = slot['queue']
+            upload_evt = cl.enqueue_copy(queue, slot['input'], slot['upload'
+                    ][0:count], is_blocking=False)
+            exec_evt = self.enqueue(queue, configuration, count,
+                                    slot['result'], slot['intermediate'],
+                                    slot['input'], row_dev, col_dev,
+                                    [upload_evt])
+            readback_evt = cl.enqueue_copy(queue, slot['readback'][0:count],
+                    slot['result'], is_blocking=False, wait_for=[exec_evt])
+            slot['pending'] = (start, count, readback_evt)
+
+        for slot in slots:
+            if slot['pending'] is not None:
+                finish(slot)
+
+        return result
+
+    def batch_queues(self, n_queues):
+        """ This kernel's queue, and as many more on its device as it takes
+            to make n_queues
+        """
+
+        while len(self.cached_queues) < n_queues:
+            self.cached_queues.append(cl.CommandQueue(self.ctx,
+                                      self.runtime.device))
+        return self.cached_queues[0:max(1, n_queues)]
+
 
 class FastRadialTransformKernel(MetaKernel):
+    """ The fast radial transform from end to end on the device: the image
+        is uploaded, and its Sobel gradients, the votes of every radius
+        (scattered with atomics), the symmetry measures, their Gaussian
+        smoothing, the average over radii and the min/max of the result all
+        stay there; only the two coordinate pairs (and the transform, if
+        asked for) are read back.
+
+        It computes what the compiled backends (WovenBackend, NumbaBackend)
+        do, reflecting at the edges as they do, up to the order of the
+        floating point additions.  The sizes of the image and the number of
+        radii are kernel arguments, so one program serves every window a
+        finder searches, and the device buffers only ever grow.
+    """
 
     def __init__(self, queue):
         MetaKernel.__init__(self, queue)
-        self.cached_intermediate_buffers = {}
-        self.cached_result_buffers = {}
-        self.cached_gaussian_kernels = {}
+        self.cached_capacity = (0, 0)
+        self.cached_tables = {}
 
-    # ##@clockit
-    def build_program(self, dtype, im_shape, radii, alpha):
+        # work-group size (and number of groups) of the min/max reduction
+        self.reduction_size = 64
+        self.reduction_groups = 64
 
-        print 'Building kernel...'
-
-        print 'Done building.'
+    # ##@clockit
+    def build_program(self):
 
-    # @clockit
-    def __call__(self, image, radii, alpha, sobel_triplet=None, **kwargs):
+        code = \
+            """
+            #define REDUCTION_SIZE ${reduction_size}
+
+            // the compiled backends' boundary handling: reflected before the
+            // start, and folded back by the tap's offset past the end
+            inline int reflect_index(int index, int offset, int n){
+                if(index < 0) index = -index;
+                if(index >= n) index = n - offset;
+                return index;
+            }
 
-        if sobel_triplet is None:
-            sobel_triplet = self.sobel3x3(image, readback_from_device=False)
+            inline void atomic_add_float(volatile __global float *target,
+                                         float value){
+                union { unsigned int u; float f; } old, updated;
+                do {
+                    old.f = *target;
+                    updated.f = old.f + value;
+                } while(atomic_cmpxchg((volatile __global unsigned int *)target,
+                                       old.u, updated.u) != old.u);
+            }
 
-        (imgx_, imgy_, mag_) = sobel_triplet
+            __kernel void sobel_rows(__global const float *image,
+                                     __global float *x_rows,
+                                     __global float *y_rows,
+                                     int rows, int cols){
+                int c = get_global_id(0);
+                int r = get_global_id(1);
+                __global const float *row = image + r*cols;
+
+                float left = row[reflect_index(c - 1, -1, cols)];
+                float right = row[reflect_index(c + 1, 1, cols)];
+                x_rows[r*cols + c] = right - left;
+                y_rows[r*cols + c] = left + 2.0f*row[c] + right;
+            }
 
-        imgx_device = self.transfer_to_device(imgx_)
-        imgy_device = self.transfer_to_device(imgy_)
-        mag_device = self.transfer_to_device(mag_)
+            __kernel void sobel_cols(__global const float *x_rows,
+                                     __global const float *y_rows,
+                                     __global float *grad_x,
+                                     __global float *grad_y,
+                                     __global float *mag,
+                                     int rows, int cols){
+                int c = get_global_id(0);
+                int r = get_global_id(1);
+                int up = reflect_index(r - 1, -1, rows)*cols + c;
+                int down = reflect_index(r + 1, 1, rows)*cols + c;
+                int index = r*cols + c;
+
+                float x = x_rows[up] + 2.0f*x_rows[index] + x_rows[down];
+                float y = y_rows[down] - y_rows[up];
+                grad_x[index] = x;
+                grad_y[index] = y;
+                mag[index] = sqrt(x*x + y*y) + 1e-16f;
+            }
 
-        # don't cheat, use the appropriate size
-        gaussian_kernel_cheat = 1.0
+            __kernel void clear_votes(__global int *O, __global float *M){
+                int i = get_global_id(0);
+                O[i] = 0;
+                M[i] = 0.0f;
+            }
 
-        # get intermediate storage
+            // each pixel votes, for every radius, at the pixels that far
+            // along and against its gradient
+            __kernel void vote(__global const float *grad_x,
+                               __global const float *grad_y,
+                               __global const float *mag,
+                               __global const float *radii,
+                               __global int *O,
+                               __global float *M,
+                               int rows, int cols){
+                int c = get_global_id(0);
+                int r = get_global_id(1);
+                int k = get_global_id(2);
+                int index = r*cols + c;
+
+                float m = mag[index];
+                float ux = grad_x[index] / m;
+                float uy = grad_y[index] / m;
+                float n = radii[k];
+
+                int posx = (int)round(c + n*ux);
+                int posy = (int)round(r + n*uy);
+                int negx = (int)round(c - n*ux);
+                int negy = (int)round(r - n*uy);
+
+                if(posx < 0 || posx > cols-1 || posy < 0 || posy > rows-1 ||
+                   negx < 0 || negx > cols-1 || negy < 0 || negy > rows-1){
+                    return;
+                }
 
-        # Normalise gradient values so that [imgx imgy] form unit
-        # direction vectors.
-        imgx = imgx / mag
-        imgy = imgy / mag
+                int plane = k*rows*cols;
+                int pos_index = plane + posy*cols + posx;
+                int neg_index = plane + negy*cols + negx;
 
-        Ss = list(radii)
+                atomic_inc(O + pos_index);
+                atomic_dec(O + neg_index);
+                atomic_add_float(M + pos_index, m);
+                atomic_add_float(M + neg_index, -m);
+            }
 
-        (y, x) = mgrid[0:rows, 0:cols]  # meshgrid(1:cols, 1:rows);
+            // the symmetry measure of each radius (written over M); O only
+            // ever holds whole vote counts, so (|O|/kappa)^alpha is looked
+            // up rather than computed with pow()
+            __kernel void symmetry(__global const int *O,
+                                   __global float *M,
+                                   __global const float *kappas,
+                                   __global const float *orientation_lut,
+                                   int n_levels,
+                                   int plane){
+                int i = get_global_id(0);
+                int k = i / plane;
+                int level = min((int)abs(O[i]), n_levels - 1);
+                M[i] = M[i]/kappas[k] * orientation_lut[k*n_levels + level];
+            }
 
-        # S_sub = zeros((rows,cols))
+            __kernel void smooth_rows(__global const float *F,
+                                      __global float *scratch,
+                                      __global const float *gauss_table,
+                                      __global const int *widths,
+                                      int table_width,
+                                      int rows, int cols){
+                int c = get_global_id(0);
+                int r = get_global_id(1);
+                int k = get_global_id(2);
+
+                int width = widths[k];
+                int halfwidth = (width % 2 == 0) ? (width - 1)/2 : width/2;
+                __global const float *taps = gauss_table + k*table_width;
+                __global const float *row = F + (k*rows + r)*cols;
+
+                float acc = 0.0f;
+                for(int j = 0; j < width; j++){
+                    acc += taps[j] *
+                           row[reflect_index(c + j - halfwidth, j - halfwidth,
+                                             cols)];
+                }
+                scratch[(k*rows + r)*cols + c] = acc;
+            }
 
-        if reuse_storage:
+            // smooths down the columns, summing over the radii, and averages
+            __kernel void smooth_cols(__global const float *scratch,
+                                      __global float *S,
+                                      __global const float *gauss_table,
+                                      __global const int *widths,
+                                      int table_width,
+                                      int n_radii,
+                                      int rows, int cols){
+                int c = get_global_id(0);
+                int r = get_global_id(1);
+
+                float S_ = 0.0f;
+                for(int k = 0; k < n_radii; k++){
+                    int width = widths[k];
+                    int halfwidth = (width % 2 == 0) ? (width - 1)/2 : width/2;
+                    __global const float *taps = gauss_table + k*table_width;
+                    __global const float *plane = scratch + k*rows*cols;
+
+                    float acc = 0.0f;
+                    for(int j = 0; j < width; j++){
+                        int index = reflect_index(r + j - halfwidth,
+                                                  j - halfwidth, rows);
+                        acc += taps[j] * plane[index*cols + c];
+                    }
+                    S_ += acc;
+                }
+                S[r*cols + c] = S_ / n_radii;
+            }
 
-            M = self.M  # Magnitude projection image
-            O = self.O  # Orientation projection image
-            F = self.F  # the result, prior to accumulation
-            S = self.S  # the accumulated result
-            self._fast_clear_array2d(S)
-        else:
-            M = zeros_like(image)
-            O = zeros_like(image)
-            F = zeros_like(image)
-            S = zeros_like(image)
+            // keeps the lowest (and highest) value, and the first index of
+            // it, as a raster scan of the image would
+            inline void keep_min(float *v, int *i, float v2, int i2){
+                if(v2 < *v || (v2 == *v && i2 < *i)){ *v = v2; *i = i2; }
+            }
 
-        for r in range(0, len(radii)):
+            inline void keep_max(float *v, int *i, float v2, int i2){
+                if(v2 > *v || (v2 == *v && i2 < *i)){ *v = v2; *i = i2; }
+            }
 
-            n = radii[r]
+            // pixels outside region (top, bottom, left, right) count as -1,
+            // as the finders mask them
+            __kernel void minmax_partial(__global const float *S,
+                                         __global float *values,
+                                         __global int *indices,
+                                         int rows, int cols,
+                                         int top, int bottom,
+                                         int left, int right){
+                __local float min_v[REDUCTION_SIZE];
+                __local float max_v[REDUCTION_SIZE];
+                __local int min_i[REDUCTION_SIZE];
+                __local int max_i[REDUCTION_SIZE];
+
+                int plane = rows*cols;
+                float lo = INFINITY;
+                float hi = -INFINITY;
+                int lo_i = plane;
+                int hi_i = plane;
+
+                for(int i = get_global_id(0); i < plane;
+                    i += get_global_size(0)){
+                    int r = i / cols;
+                    int c = i - r*cols;
+                    float v = -1.0f;
+                    if(r >= top && r < bottom && c >= left && c < right){
+                        v = S[i];
+                    }
+                    keep_min(&lo, &lo_i, v, i);
+                    keep_max(&hi, &hi_i, v, i);
+                }
 
-            if reuse_storage:
-                self._fast_clear_array2d(M)
-                self._fast_clear_array2d(O)
-                self._fast_clear_array2d(F)
-            else:
-                M = zeros_like(image)
-                O = zeros_like(image)
-                F = zeros_like(image)
+                int lid = get_local_id(0);
+                min_v[lid] = lo; min_i[lid] = lo_i;
+                max_v[lid] = hi; max_i[lid] = hi_i;
+                barrier(CLK_LOCAL_MEM_FENCE);
 
-            # Coordinates of 'positively' and 'negatively' affected pixels
-            posx = x + n * imgx
-            posy = y + n * imgy
+                for(int stride = REDUCTION_SIZE/2; stride > 0; stride /= 2){
+                    if(lid < stride){
+                        keep_min(&lo, &lo_i, min_v[lid + stride],
+                                 min_i[lid + stride]);
+                        keep_max(&hi, &hi_i, max_v[lid + stride],
+                                 max_i[lid + stride]);
+                        min_v[lid] = lo; min_i[lid] = lo_i;
+                        max_v[lid] = hi; max_i[lid] = hi_i;
+                    }
+                    barrier(CLK_LOCAL_MEM_FENCE);
+                }
 
-            negx = x - n * imgx
-            negy = y - n * imgy
+                if(lid == 0){
+                    int g = get_group_id(0);
+                    values[2*g] = lo; indices[2*g] = lo_i;
+                    values[2*g + 1] = hi; indices[2*g + 1] = hi_i;
+                }
+            }
 
-            # Clamp Orientation projection matrix values to a maximum of
-            # +/-kappa,  but first set the normalization parameter kappa to the
-            # values suggested by Loy and Zelinski
-            kappa = 9.9
-            if n == 1:
-                kappa = 8
+            // reduces the groups' partial results (in one group), giving
+            // (min row, min col, max row, max col)
+            __kernel void minmax_final(__global const float *values,
+                                       __global const int *indices,
+                                       int n_partials,
+                                       int cols,
+                                       __global int *coordinates){
+                __local float min_v[REDUCTION_SIZE];
+                __local float max_v[REDUCTION_SIZE];
+                __local int min_i[REDUCTION_SIZE];
+                __local int max_i[REDUCTION_SIZE];
+
+                int lid = get_local_id(0);
+                float lo = INFINITY;
+                float hi = -INFINITY;
+                int lo_i = INT_MAX;
+                int hi_i = INT_MAX;
+                for(int g = lid; g < n_partials; g += REDUCTION_SIZE){
+                    keep_min(&lo, &lo_i, values[2*g], indices[2*g]);
+                    keep_max(&hi, &hi_i, values[2*g + 1], indices[2*g + 1]);
+                }
 
-            # Form the orientation and magnitude projection matrices
+                min_v[lid] = lo; min_i[lid] = lo_i;
+                max_v[lid] = hi; max_i[lid] = hi_i;
+                barrier(CLK_LOCAL_MEM_FENCE);
 
-            code = \
-                """
-            Py_BEGIN_ALLOW_THREADS
-            
-            #define __TYPE  %s
-            
-            int rows = Nmag[0];
-            //int rstart = 0;
-            //int rend = rows;
-            int tile_size = rows / n_tiles;
-            int rstart = (tile) * tile_size;
-            int rend;
-            if(tile == n_tiles-1){
-                rend = rows;
-            } else {
-                rend = (tile+1) * tile_size - 1; 
-            } 
-            
-            int cols = Nmag[1];
-            int cstart = 0;
-            int cend = cols;
-            
-            for(int r = rstart; r < rend; r++){
-                for(int c = cstart; c < cend; c++){
-                    int index = r*cols + c;
-                    
-                    int posx_ = round(posx[index]);
-                    int posy_ = round(posy[index]);
-                    int negx_ = round(negx[index]);
-                    int negy_ = round(negy[index]);
-                    
-                    if(posx_ < 0 || posx_ > cols-1 ||
-                       posy_ < 0 || posy_ > rows-1 ||
-                       negx_ < 0 || negx_ > cols-1 ||
-                       negy_ < 0 || negy_ > rows-1){
-                        continue;
+                for(int stride = REDUCTION_SIZE/2; stride > 0; stride /= 2){
+                    if(lid < stride){
+                        keep_min(&lo, &lo_i, min_v[lid + stride],
+                                 min_i[lid + stride]);
+                        keep_max(&hi, &hi_i, max_v[lid + stride],
+                                 max_i[lid + stride]);
+                        min_v[lid] = lo; min_i[lid] = lo_i;
+                        max_v[lid] = hi; max_i[lid] = hi_i;
                     }
-                    
-                    if(posx_ < 0) posx_ = 0;
-                    if(posx_ > cols-1) posx_ = cols-1;
-                    if(posy_ < 0) posy_ = 0;
-                    if(posy_ > rows-1) posy_ = rows-1;
-                    
-                    if(negx_ < 0) negx_ = 0;
-                    if(negx_ > cols-1) negx_ = cols-1;
-                    if(negy_ < 0) negy_ = 0;
-                    if(negy_ > rows-1) negy_ = rows-1;
-                    
-                    int pos_index = (int)posy_*cols + (int)posx_;
-                    int neg_index = (int)negy_*cols + (int)negx_;
-                    
-                    O[pos_index] += 1.0;
-                    O[neg_index] -= 1.0;
-                    
-                    M[pos_index] += mag[index];
-                    M[neg_index] -= mag[index];
+                    barrier(CLK_LOCAL_MEM_FENCE);
                 }
-            }
-            
-            for(int r = rstart; r < rend; r++){
-                for(int c=cstart; c < cend; c++){
-                    int index = r*cols + c;
-                    __TYPE O_ = abs(O[index]);
-                    if(O_ > kappa) O_ = kappa;
-                    
-                    F[index] = M[index]/kappa * pow(O_/kappa, alpha);
+
+                if(lid == 0){
+                    coordinates[0] = lo_i / cols;
+                    coordinates[1] = lo_i % cols;
+                    coordinates[2] = hi_i / cols;
+                    coordinates[3] = hi_i % cols;
                 }
             }
-            
-            
-            Py_END_ALLOW_THREADS
-            """ \
-                % self.type_string
-
-            multithreaded_weave = 0
-
-            def run_inline(tile, O, M, mag, posx, posy, negx, negy, kappa, F,
-                           alpha, n_tiles):
-                inline(code, [  # , type_converters=converters.blitz)
-                    'O',
-                    'M',
-                    'mag',
-                    'posx',
-                    'posy',
-                    'negx',
-                    'negy',
-                    'kappa',
-                    'F',
-                    'alpha',
-                    'n_tiles',
-                    'tile',
-                    ], verbose=0)
-
-            if multithreaded_weave:
-                n_tiles = 2
-                foreach(lambda t: run_inline(
-                        t,
-                        O,
-                        M,
-                        mag,
-                        posx,
-                        posy,
-                        negx,
-                        negy,
-                        kappa,
-                        F,
-                        alpha,
-                        n_tiles,
-                        ), range(0, n_tiles), 2)
-            else:
-                n_tiles = 1
-                tile = 0
-                inline(code, [
-                    'O',
-                    'M',
-                    'mag',
-                    'posx',
-                    'posy',
-                    'negx',
-                    'negy',
-                    'kappa',
-                    'F',
-                    'alpha',
-                    'n_tiles',
-                    'tile',
-                    ], verbose=0)
-
-            # Generate a Gaussian of size proportional to n to smooth and spread
-            # the symmetry measure.  The Gaussian is also scaled in magnitude
-            # by n so that large scales do not lose their relative weighting.
-            # A = fspecial('gaussian',[n n], 0.25*n) * n;
-            # S = S + filter2(A,F);
-            width = round(gaussian_kernel_cheat * n)
-            if mod(width, 2) == 0:
-                width += 1
-            gauss1d = scipy.signal.gaussian(width, 0.25 * n).astype(image.dtype)
-            print gauss1d.shape
+        """
+
+        templated_code = mako.template.Template(code).render(
+            reduction_size=self.reduction_size)
+        return self.cache_program(self.reduction_size, templated_code)
 
-            S += self.separable_convolution2d(F, gauss1d, gauss1d)
+    def buffers(self, plane, n_radii):
+        """ The device storage for an image of plane pixels and n_radii
+            radii, from the buffer pool; the sizes asked for only ever grow,
+            so that windows of every size share the same buffers
+        """
 
-        S = S / len(radii)  # Average
+        (capacity, radii_capacity) = self.cached_capacity
+        self.cached_capacity = (max(plane, capacity), max(n_radii,
+                                radii_capacity))
+        (plane, n_radii) = self.cached_capacity
+
+        f = numpy.float32
+        i = numpy.int32
+        sizes = {
+            'image': (plane, f),
+            'x_rows': (plane, f),
+            'y_rows': (plane, f),
+            'grad_x': (plane, f),
+            'grad_y': (plane, f),
+            'mag': (plane, f),
+            'O': (n_radii * plane, i),
+            'M': (n_radii * plane, f),
+            'scratch': (n_radii * plane, f),
+            'S': (plane, f),
+            'values': (2 * self.reduction_groups, f),
+            'indices': (2 * self.reduction_groups, i),
+            'coordinates': (4, i),
+            }
+        return dict([(name, self.buffer(name, (size, ), dtype)) for (name,
+                    (size, dtype)) in sizes.items()])
 
-        return S
+    def tables(self, radii, alpha):
+        """ The radii, their values of kappa, (|O|/kappa)^alpha by vote count
+            and their Gaussians, on the device
+        """
 
+        key = (tuple(radii), alpha)
+        if key in self.cached_tables:
+            return self.cached_tables[key]
+
+        radii_ = numpy.asarray(radii, dtype=numpy.float32)
+
+        # values of kappa suggested by Loy and Zelinski
+        kappas = numpy.where(radii_ == 1, 8., 9.9)
+        n_levels = int(numpy.ceil(kappas.max())) + 1
+        levels = numpy.minimum(numpy.arange(n_levels)[numpy.newaxis, :],
+                               kappas[:, numpy.newaxis])
+        orientation_lut = (levels / kappas[:, numpy.newaxis]) ** alpha
+
+        # Gaussians of size proportional to each n, packed into one table
+        gaussians = []
+        for n in radii:
+            width = round(n)
+            if numpy.mod(width, 2) == 0:
+                width += 1
+            gaussians.append(scipy.signal.gaussian(int(width), 0.25 * n))
+        widths = numpy.array([len(g) for g in gaussians], dtype=numpy.int32)
+        gauss_table = numpy.zeros((len(radii), widths.max()),
+                                  dtype=numpy.float32)
+        for (k, g) in enumerate(gaussians):
+            gauss_table[k, 0:len(g)] = g
+
+        def upload(arr):
+            return cl.Buffer(self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR,
+                             hostbuf=numpy.ascontiguousarray(arr))
+
+        tables = (
+            upload(radii_),
+            upload(kappas.astype(numpy.float32)),
+            upload(orientation_lut.astype(numpy.float32)),
+            numpy.int32(n_levels),
+            upload(gauss_table),
+            upload(widths),
+            numpy.int32(gauss_table.shape[1]),
+            )
+        self.cached_tables[key] = tables
+        return tables
+
+    # @clockit
+    def __call__(self, image, radii, alpha, region=None,
+                 readback_transform=False, **kwargs):
+        """ The transform's (min row, min col) and (max row, max col) within
+            region (top, bottom, left, right) of image, and the transform
+            itself if readback_transform (or else None)
+        """
+
+        image = numpy.ascontiguousarray(image, dtype=numpy.float32)
+        (rows, cols) = image.shape
+        plane = rows * cols
+        n_radii = len(radii)
+        if region is None:
+            region = (0, rows, 0, cols)
+
+        prg = self.cached_program(self.reduction_size)
+        if prg is None:
+            prg = self.build_program()
 
+        b = self.buffers(plane, n_radii)
+        (radii_dev, kappas_dev, lut_dev, n_levels, gauss_dev, widths_dev,
+         table_width) = self.tables(radii, alpha)
+        size = (numpy.int32(rows), numpy.int32(cols))
+        q = self.queue
+
+        cl.enqueue_copy(q, b['image'], image)
+
+        prg.sobel_rows(q, (cols, rows), None, b['image'], b['x_rows'],
+                       b['y_rows'], *size)
+        prg.sobel_cols(q, (cols, rows), None, b['x_rows'], b['y_rows'],
+                       b['grad_x'], b['grad_y'], b['mag'], *size)
+
+        prg.clear_votes(q, (n_radii * plane, ), None, b['O'], b['M'])
+        prg.vote(q, (cols, rows, n_radii), None, b['grad_x'], b['grad_y'],
+                 b['mag'], radii_dev, b['O'], b['M'], *size)
+        prg.symmetry(q, (n_radii * plane, ), None, b['O'], b['M'],
+                     kappas_dev, lut_dev, n_levels, numpy.int32(plane))
+
+        prg.smooth_rows(q, (cols, rows, n_radii), None, b['M'], b['scratch'
+                        ], gauss_dev, widths_dev, table_width, *size)
+        prg.smooth_cols(q, (cols, rows), None, b['scratch'], b['S'],
+                        gauss_dev, widths_dev, table_width,
+                        numpy.int32(n_radii), *size)
+
+        groups = min(self.reduction_groups, int_div_up(plane,
+                     self.reduction_size))
+        (top, bottom, left, right) = [numpy.int32(e) for e in region]
+        prg.minmax_partial(q, (int(groups * self.reduction_size), ),
+                           (self.reduction_size, ), b['S'], b['values'],
+                           b['indices'], numpy.int32(rows), numpy.int32(cols),
+                           top, bottom, left, right)
+        prg.minmax_final(q, (self.reduction_size, ), (self.reduction_size, ),
+                         b['values'], b['indices'], numpy.int32(groups),
+                         numpy.int32(cols), b['coordinates'])
+
+        coordinates = numpy.zeros(4, dtype=numpy.int32)
+        cl.enqueue_copy(q, coordinates, b['coordinates'])
+
+        S = None
+        if readback_transform:
+            S = numpy.empty((rows, cols), dtype=numpy.float32)
+            cl.enqueue_copy(q, S, b['S'])
+
+        coordinates = coordinates.astype(float)
+        return (coordinates[0:2], coordinates[2:4], S)
+
+
+def test_caches():
+    """ Check that the separable convolution (on whatever OpenCL device
+        comes first) matches scipy's on an image of no particular size, that
+        a second process would load its program rather than build it, and
+        that the buffer pool stays within its capacity
+    """
+
+    import time
+    import tempfile
+    import scipy.ndimage
+
+    queue = cl.CommandQueue(cl.create_some_context(interactive=False))
+    cache_dir = tempfile.mkdtemp()
+
+    im = numpy.random.rand(201, 299).astype(numpy.float32)
+    g = gaussian_kernel(7, 2.0)
+    expected = scipy.ndimage.correlate1d(scipy.ndimage.correlate1d(im, g,
+            1, mode='mirror'), g, 0, mode='mirror')
+
+    for trial in ['Built', 'Loaded']:
+        kernel = LocalMemorySeparableConvolutionKernel(queue)
+        kernel.program_cache = ProgramCache(cache_dir)
+        kernel.buffer_pool = BufferPool(capacity=1000000)
+
+        tic = time.time()
+        result = kernel(im, g, g, readback_from_device=True)
+        print '%s: %f s' % (trial, time.time() - tic)
+        print '\tMax abs difference: ', abs(result - expected).max()
+        assert abs(result - expected).max() < 1e-5
+
+        assert (kernel.program_cache.builds, kernel.program_cache.loads) \
+            == ((1, 0) if trial == 'Built' else (0, 1))
+
+        for shape in [(100, 100), (200, 200), (300, 300)]:
+            kernel(numpy.random.rand(*shape).astype(numpy.float32), g, g,
+                   readback_from_device=True)
+        print '\tPooled: %d bytes in %d buffers' \
+            % (kernel.buffer_pool.nbytes, len(kernel.buffer_pool.buffers))
+        assert kernel.buffer_pool.nbytes <= kernel.buffer_pool.capacity
+
+
+def test_convolve_stack():
+    """ Check that convolving a stack of frames gives what convolving each
+        frame does, and compare the frames per second of the two (for a few
+        sizes of batch)
+    """
+
+    import time
+
+    queue = cl.CommandQueue(cl.create_some_context(interactive=False))
+    kernel = LocalMemorySeparableConvolutionKernel(queue)
+
+    stack = numpy.random.rand(64, 240, 320).astype(numpy.float32)
+    g = gaussian_kernel(7, 2.0)
+
+    one_by_one = numpy.array([kernel(frame, g, g, readback_from_device=True)
+                             for frame in stack])
+    assert abs(kernel.convolve_stack(stack, g, g) - one_by_one).max() < 1e-5
+    assert abs(kernel.convolve_stack(stack[0:5], g, g, frames_per_launch=2,
+               n_queues=3) - one_by_one[0:5]).max() < 1e-5
+
+    tic = time.time()
+    for frame in stack:
+        kernel(frame, g, g, readback_from_device=True)
+    print 'One frame per call: %f frames/s' % (len(stack) / (time.time()
+            - tic))
+
+    for frames_per_launch in [1, 4, 16, 64]:
+        tic = time.time()
+        kernel.convolve_stack(stack, g, g,
+                              frames_per_launch=frames_per_launch)
+        print '%d frames per launch: %f frames/s' % (frames_per_launch,
+                len(stack) / (time.time() - tic))
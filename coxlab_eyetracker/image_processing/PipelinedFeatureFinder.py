@@ -6,112 +6,140 @@
 #  Copyright (c) 2008 The Rowland Institute at Harvard. All rights reserved.
 #
 
-from multiprocessing.managers import SyncManager
+from multiprocessing.sharedctypes import RawArray
 
 from FrugalCompositeEyeFeatureFinder import *
 from FastRadialFeatureFinder import *
 from SubpixelStarburstEyeFeatureFinder import *
+from MotionModel import *
 
 import time
 import Queue
-import threading
+import logging
+import collections
+import multiprocessing
 import cPickle as pickle
 
 
-class PipelinedWorker:
+class SharedFrameRing:
+    """ A fixed number of frame-sized slots in shared memory.  The ring is
+        allocated before the worker process is forked, so both sides map the
+        same pages: the producer copies a frame into a free slot, and the
+        worker reads it in place.  Only a SharedFrame record (slot index,
+        shape and dtype) has to cross the queue.
+    """
 
-    def __init__(self, ff, input_queue, output_queue):
-        self.input_queue = input_queue
-        self.output_queue = output_queue
-        self.ff = ff
-        self._stop = threading.Event()
+    def __init__(self, nslots, slot_bytes):
+        self.slot_bytes = slot_bytes
+        self.slots = [RawArray('b', slot_bytes) for s in range(0, nslots)]
+        self.free_slots = collections.deque(range(0, nslots))
 
-    def stop(self):
-        #print "Worker told to stop: %s" % self
-        self._stop.set()
+    def view(self, slot, shape, dtype):
+        return frombuffer(self.slots[slot], dtype=dtype,
+                          count=int(prod(shape))).reshape(shape)
 
-    def stopped(self):
-        return self._stop.isSet()
+    def put(self, image):
+        """ Copy image into a free slot, returning a SharedFrame that refers
+            to it, or None if the image doesn't fit or no slot is free
+        """
 
-    def start(self):
-        while(not self.stopped()):
-            #print "%s.stopped = %s" % (self, self.stopped())
-            try:
-                input = self.input_queue.get(timeout=1.)
-            except Queue.Empty:
-                continue
+        if image is None or image.nbytes > self.slot_bytes \
+            or len(self.free_slots) == 0:
+            return None
 
-            if input is not None:
-                (im, guess) = input
-            else:
-                im = None
-                guess = None
+        slot = self.free_slots.popleft()
+        self.view(slot, image.shape, image.dtype)[...] = image
+        return SharedFrame(slot, image.shape, image.dtype.str)
+
+    def release(self, slot):
+        self.free_slots.append(slot)
+
+
+class SharedFrame:
+    """ Stands in for an image on a worker's input queue """
+
+    def __init__(self, slot, shape, dtype):
+        self.slot = slot
+        self.shape = shape
+        self.dtype = dtype
 
-            # else an image
-            self.ff.analyze_image(im, guess)
-            features = self.ff.get_result()
 
-            features["transform"] = None
-            features["im_array"] = None
+class PipelinedParams(object):
+    """ Parameters of one of the feature finders living in the worker
+        processes.  Reads come from a local copy; assignments update the copy
+        and are broadcast to every worker as a versioned message, which each
+        worker applies between frames.
+    """
 
-            # pickle the structure manually, because Queue doesn't seem to do the
-            # job correctly
-            self.output_queue.put(pickle.dumps(features))
-            self.input_queue.task_done()
+    def __init__(self, pipeline, target, values):
+        object.__setattr__(self, 'pipeline', pipeline)
+        object.__setattr__(self, 'target', target)
+        object.__setattr__(self, 'values', values)
 
+    def get_param(self, param):
+        return self.values[param]
 
-def worker_thread(worker):
-    worker.start()
+    def set_param(self, param, value):
+        self.values[param] = value
+        self.pipeline.broadcast_param(self.target, param, value)
 
+    def __getattr__(self, attr):
+        values = object.__getattribute__(self, 'values')
+        if attr in values:
+            return values[attr]
+        raise AttributeError(attr)
 
-class PipelinedWorkerProcessManager(SyncManager):
+    def __setattr__(self, attr, value):
+        if attr in self.values:
+            return self.set_param(attr, value)
+        return object.__setattr__(self, attr, value)
 
-    #CompositeEyeFeatureFinder_ = CreatorMethod(CompositeEyeFeatureFinder)
-    #FastRadialFeatureFinder_ = CreatorMethod(FastRadialFeatureFinder)
-    #StarBurstEyeFeatureFinder_ = CreatorMethod(SubpixelStarburstEyeFeatureFinder)
-    #PipelinedWorker_ = CreatorMethod(PipelinedWorker)
 
-    def __init__(self, queue_size=None):
-        #print "instantiating process manager"
-        SyncManager.__init__(self)
+def make_worker_finders(backend):
+    """ The feature finders of one worker: the radial and starburst finders
+        (by the names parameters are addressed to) and the composite of them
+        that analyzes the frames
+    """
 
-        self.start()
+    finders = {'radial': FastRadialFeatureFinder(backend=backend),
+               'starburst': SubpixelStarburstEyeFeatureFinder(backend=backend)}
+    ff = FrugalCompositeEyeFeatureFinder(finders['radial'],
+                                         finders['starburst'])
+    return (finders, ff)
 
-        self.ff = None
-        self.input_queue = self.Queue(queue_size)
-        self.output_queue = self.Queue(queue_size)
-        self.worker = None
 
-    def set_main_feature_finder(self, ff):
-        self.ff = ff
+def worker_loop(input_queue, output_queue, frame_ring, backend, param_names,
+                make_finders=make_worker_finders):
 
-    def start_worker_loop(self):
-        self.worker = self.PipelinedWorker(self.ff, self.input_queue, self.output_queue)
-        self.worker_thread = threading.Thread(target=worker_thread, args=[self.worker])
-        self.worker_thread.start()
-    
-    def stop(self):
-        #print "Stopping worker: %s" % self
-        self.worker.stop()
-    
-    def join_worker(self):
-        # wait for join
-        #print "%s.is_alive = %s" % (self.worker_thread, self.worker_thread.is_alive())
-        self.worker_thread.join(1.0)
-        #print "%s.is_alive = %s" % (self.worker_thread, self.worker_thread.is_alive())
+    # the feature finders are built here, in the worker process
+    (finders, ff) = make_finders(backend)
 
+    # report the starting parameter values back to the parent
+    output_queue.put(dict([(target, dict([(p, finders[target].get_param(p))
+                                          for p in param_names[target]]))
+                           for target in finders]))
+
+    params_version = 0
 
-def worker_loop(ff, image_queue, output_queue, id=-1):
     while(1):
-        input = image_queue.get()
+        message = input_queue.get()
 
-        if input is not None:
-            (im, guess) = input
-        else:
-            im = None
-            guess = None
+        if message is None:
+            break
+
+        message = pickle.loads(message)
+
+        if message[0] == 'param':
+            (kind, params_version, target, param, value) = message
+            finders[target].set_param(param, value)
+            continue
+
+        started = time.time()
+
+        (kind, frame_index, im, guess) = message
+        if isinstance(im, SharedFrame):
+            im = frame_ring.view(im.slot, im.shape, im.dtype)
 
-        # else an image
         ff.analyze_image(im, guess)
         features = ff.get_result()
 
@@ -119,88 +147,546 @@ def worker_loop(ff, image_queue, output_queue, id=-1):
         features["transform"] = None
         features["im_array"] = None
 
-        # pickle the structure manually, because Queue doesn't seem to do the
-        # job correctly
-        output_queue.put(pickle.dumps(features))
+        # the parameter settings this result was computed with
+        features["params_version"] = params_version
 
-
-PipelinedWorkerProcessManager.register('FrugalCompositeEyeFeatureFinder', FrugalCompositeEyeFeatureFinder)
-PipelinedWorkerProcessManager.register('FastRadialFeatureFinder', FastRadialFeatureFinder, exposed=('get_param', 'set_param'))
-PipelinedWorkerProcessManager.register('StarBurstEyeFeatureFinder', SubpixelStarburstEyeFeatureFinder, exposed=('get_param', 'set_param'))
-PipelinedWorkerProcessManager.register('PipelinedWorker', PipelinedWorker)
+        # pickle here rather than in the queue's feeder thread, which would
+        # race with the feature finders reusing their result structures
+        output_queue.put(pickle.dumps((frame_index, features, started,
+                                       time.time()), pickle.HIGHEST_PROTOCOL))
 
 
 class PipelinedFeatureFinder:
-
-    def __init__(self, nworkers):
+    """ Farms frames out to a pool of worker processes and hands back their
+        results in the order the frames were submitted.
+
+        Results are held in a reorder buffer keyed by the pipeline's own
+        frame index, so a result is returned as soon as it and every earlier
+        frame are done, whichever worker finished first.  If max_latency
+        (in seconds) is set, a frame that has been in flight longer than
+        that is skipped rather than holding up the frames behind it; its
+        result is discarded if it turns up later.
+
+        Each result carries its 'queue_latency' (submission to the start of
+        analysis), 'processing_latency' and 'total_latency' (submission to
+        being returned by get_result).
+
+        With propagate_seeds set, the pool tracks the eye as one finder
+        would: each frame is seeded with the positions from the most recent
+        result to come back from any worker, rather than the caller's guess
+        (which lags by the depth of the pipeline), and the periodic fast
+        radial reseed is scheduled once for the whole pool, every
+        reseed_interval frames, instead of separately on each worker.  Given
+        a motion_model as well, frames are seeded with the model's
+        prediction, and the pool reseeds when a result falls outside the
+        model's gate rather than on a timer.  (Without propagate_seeds, the
+        motion_model is ignored, with a warning.)
+
+        Each worker builds its feature finders with make_finders(backend)
+        (see make_worker_finders).
+    """
+
+    def __init__(self, nworkers, backend='woven', radial_params=(),
+                 starburst_params=(), max_frame_bytes=1024 * 768 * 4,
+                 max_latency=None, propagate_seeds=False,
+                 reseed_interval=50, motion_model=None,
+                 make_finders=make_worker_finders):
 
         self.workers = []
 
         queue_length = 3
 
+        # enough shared frame slots for every frame that can be in flight to
+        # a worker (queued, being analyzed, or waiting in the output queue);
+        # frames that don't fit, or arrive when all slots are busy, fall back
+        # to being pickled through the queue
+        nslots = 2 * queue_length + 2
+        self.frame_rings = []
+
         self.current_input_worker = 0
-        self.current_output_worker = 0
         self.input_queues = []
-        self.output_queues = []
-        self.image_queue = Queue.Queue()
+        self.output_queue = multiprocessing.Queue()
+
+        self.max_latency = max_latency
+
+        # number of frames that get_result lets into the pipeline before it
+        # waits on a result
+        self.pipeline_depth = nworkers + 1
+
+        # frame index -> (worker, slot, image, submission time)
+        self.in_flight = {}
+        self.worker_load = [0] * nworkers
+
+        # frame index -> (features, submission time)
+        self.reorder_buffer = {}
+        self.frames_submitted = 0
+        self.next_result = 0
+        self.frames_dropped = 0
+
+        self.propagate_seeds = propagate_seeds
+        self.reseed_interval = reseed_interval
+        # the frame index of the next scheduled reseed, and of the last one
+        self.next_reseed_index = 0
+        self.last_reseed_index = -1
+
+        # (the model is fed the results, and its predictions used as seeds,
+        # only when seeds are propagated)
+        self.motion_model = make_motion_model(motion_model)
+        if self.motion_model is not None and not propagate_seeds:
+            logging.warning('Ignoring the %s motion model: the pipeline only '
+                            'uses one when propagating seeds (see '
+                            'pipeline_propagate_seeds)'
+                            % self.motion_model.__class__.__name__)
+            self.motion_model = None
+        if self.motion_model is not None:
+            self.reseed_interval = inf
+
+        # the newest result seen so far: (frame index, pupil, cr)
+        self.latest_seed = None
+
+        self.params_version = 0
+        param_names = {'radial': radial_params,
+                       'starburst': starburst_params}
 
         self.last_im = None
 
         for w in range(0, nworkers):
 
-            worker = PipelinedWorkerProcessManager(queue_length)
+            # the frame ring is allocated before the worker forks, so both
+            # processes map the same pages
+            frame_ring = SharedFrameRing(nslots, max_frame_bytes)
+            self.frame_rings.append(frame_ring)
+
+            input_queue = multiprocessing.Queue(queue_length)
+
+            worker = multiprocessing.Process(target=worker_loop,
+                                             args=(input_queue,
+                                                   self.output_queue,
+                                                   frame_ring, backend,
+                                                   param_names,
+                                                   make_finders))
+            worker.daemon = True
             self.workers.append(worker)
-            self.input_queues.append(worker.input_queue)
-            self.output_queues.append(worker.output_queue)
+            self.input_queues.append(input_queue)
+
+        for worker in self.workers:
+            worker.start()
+
+        # every worker starts from the same defaults, so keep one set
+        initial_params = None
+        for worker in self.workers:
+            initial_params = self.output_queue.get()
 
-        self.grace = nworkers + 1
-        #self.grace = 10
+        self.radial_ff = PipelinedParams(self, 'radial',
+                                         initial_params['radial'])
+        self.starburst_ff = PipelinedParams(self, 'starburst',
+                                            initial_params['starburst'])
 
     def start(self):
-        for worker in self.workers:
-            worker.start_worker_loop()
+        # the workers are already running
+        pass
+
+    def broadcast_param(self, target, param, value):
+        self.params_version += 1
+        message = pickle.dumps(('param', self.params_version, target, param,
+                                value), pickle.HIGHEST_PROTOCOL)
+        for input_queue in self.input_queues:
+            input_queue.put(message)
 
     #@clockit
     def analyze_image(self, image, guess=None):
-        if(self.current_input_worker >= len(self.workers)):
-            self.current_input_worker = 0
 
-        self.input_queues[self.current_input_worker].put((image, guess))
-        self.current_input_worker += 1
+        # send the frame to the least loaded worker, taking them in turn
+        # when there's a tie
+        nworkers = len(self.workers)
+        candidates = range(self.current_input_worker,
+                           self.current_input_worker + nworkers)
+        w = min(candidates, key=lambda c: self.worker_load[c % nworkers]) \
+            % nworkers
+        self.current_input_worker = (w + 1) % nworkers
+
+        frame_index = self.frames_submitted
+        self.frames_submitted += 1
+
+        if self.propagate_seeds:
+            guess = self._seed_guess(guess)
+
+        frame = self.frame_rings[w].put(image)
+        if frame is not None:
+            slot = frame.slot
+        else:
+            slot = None
+            frame = image
+
+        self.in_flight[frame_index] = (w, slot, image, time.time())
+        self.worker_load[w] += 1
+
+        # pickle now, so that the caller is free to reuse image and guess
+        message = pickle.dumps(('frame', frame_index, frame, guess),
+                               pickle.HIGHEST_PROTOCOL)
+        self.input_queues[w].put(message)
 
-        self.image_queue.put(image)
-        #self.last_im = image
+    def _seed_guess(self, guess):
+
+        # pick up anything that has finished since the last get_result
+        self._collect_results(block=False)
+
+        if guess is None:
+            guess = {}
+        else:
+            guess = guess.copy()
+
+        prediction = None
+        if self.motion_model is not None:
+            prediction = self.motion_model.predict(guess.get('timestamp'))
+
+        if prediction is not None:
+            (guess['pupil_position'], guess['cr_position']) = prediction
+            guess['roi_margin'] = \
+                self.motion_model.uncertainty(guess.get('timestamp'))
+        elif self.latest_seed is not None:
+            (seed_index, guess['pupil_position'], guess['cr_position']) = \
+                self.latest_seed
+
+        frame_index = self.frames_submitted - 1
+        guess['reseed'] = frame_index >= self.next_reseed_index
+        if guess['reseed']:
+            self.next_reseed_index = frame_index + self.reseed_interval
+            self.last_reseed_index = frame_index
+
+        return guess
+
+    def _update_motion_model(self, frame_index, result):
+
+        if result.get('reseeded', False):
+            self.motion_model.reset()
+
+        innovation = self.motion_model.update(result['pupil_position'],
+                result['cr_position'], result.get('timestamp'))
+
+        # lost track: reseed on the next frame, unless a reseed has been sent
+        # out since this frame was
+        if innovation is not None and innovation > self.motion_model.gate \
+            and frame_index > self.last_reseed_index:
+            self.next_reseed_index = 0
 
     def get_result(self):
 
-        if(self.grace > 0):
-            self.grace -= 1
-            return None
+        self._collect_results(block=False)
 
-        if(self.current_output_worker >= len(self.workers)):
-            self.current_output_worker = 0
+        while(1):
+            if self.next_result in self.reorder_buffer:
+                (result, submitted) = \
+                    self.reorder_buffer.pop(self.next_result)
+                self.next_result += 1
+                result["total_latency"] = time.time() - submitted
+                return result
+
+            if self.next_result >= self.frames_submitted:
+                return None
+
+            age = time.time() - self.in_flight[self.next_result][3]
+            if self.max_latency is not None and age > self.max_latency:
+                # give up on this frame and let the ones behind it through
+                self.frames_dropped += 1
+                self.next_result += 1
+                continue
 
-        # unpickle manually, because Queue doesn't seem to do it right
-        result = pickle.loads(self.output_queues[self.current_output_worker].get())
-        result["im_array"] = self.image_queue.get()
-        self.output_queues[self.current_output_worker].task_done()
+            # let the pipeline fill up before waiting on anything
+            if self.frames_submitted - self.next_result \
+                <= self.pipeline_depth:
+                return None
 
-        self.current_output_worker += 1
-        return result
+            if self.max_latency is None:
+                self._collect_results()
+            else:
+                self._collect_results(timeout=self.max_latency - age)
+
+    def _collect_results(self, block=True, timeout=None):
+        """ Move finished results from the output queue into the reorder
+            buffer, waiting (up to timeout) for the first one if block is set
+        """
+
+        try:
+            message = self.output_queue.get(block, timeout)
+            while(1):
+                self._file_result(*pickle.loads(message))
+                message = self.output_queue.get(False)
+        except Queue.Empty:
+            pass
+
+    def _file_result(self, frame_index, result, started, finished):
+
+        (w, slot, image, submitted) = self.in_flight.pop(frame_index)
+        self.worker_load[w] -= 1
+        if slot is not None:
+            self.frame_rings[w].release(slot)
+
+        if self.propagate_seeds:
+            if result.get('reseeded', False):
+                # a worker reseeded (on its own, if tracking was lost);
+                # that counts for the whole pool
+                self.next_reseed_index = max(self.next_reseed_index,
+                        frame_index + self.reseed_interval)
+
+            if (self.latest_seed is None
+                    or frame_index > self.latest_seed[0]) \
+                and result.get('pupil_position') is not None \
+                and result.get('cr_position') is not None:
+                self.latest_seed = (frame_index, result['pupil_position'],
+                                    result['cr_position'])
+
+                if self.motion_model is not None:
+                    self._update_motion_model(frame_index, result)
+
+        # too late: this frame was already skipped
+        if frame_index < self.next_result:
+            return
+
+        result["im_array"] = image
+        result["queue_latency"] = started - submitted
+        result["processing_latency"] = finished - started
+        self.reorder_buffer[frame_index] = (result, submitted)
 
     def stop_threads(self):
-        for worker in self.workers:
-            worker.stop()
-        time.sleep(len(self.workers) + 1)
-        #for iq in self.input_queues:
-        #    iq.join()
-        #for oq in self.output_queues:
-        #    oq.join()
-        for worker in self.workers:
-            worker.join_worker()
+        for (worker, input_queue) in zip(self.workers, self.input_queues):
+            if worker.is_alive():
+                try:
+                    input_queue.put(None, timeout=1.)
+                except Queue.Full:
+                    pass
 
+        for worker in self.workers:
+            worker.join(1.0)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
 
     def __del__(self):
         self.stop_threads()
 
 
+class _EchoFinder(object):
+    """ Stands in for a worker's feature finders in the tests below: after
+        taking delay seconds, it reports the frame it was given (its first
+        pixel, which the tests set to the frame's index, and its sum), the
+        guess it was seeded with and which worker it ran on.  It reseeds when
+        the guess says to, or on its own (as if it had lost track) if the
+        frame's second pixel is set.
+    """
+
+    def __init__(self, worker, delay):
+        self.worker = worker
+        self.delay = delay
+        self.result = None
+
+    def get_param(self, param):
+        return getattr(self, param)
+
+    def set_param(self, param, value):
+        setattr(self, param, value)
+
+    def analyze_image(self, im, guess=None):
+        time.sleep(self.delay)
+        frame = int(im[0, 0])
+        self.result = {
+            'frame': frame,
+            'frame_sum': float(sum(im.astype(float64))),
+            'worker': self.worker,
+            'guess': guess,
+            'pupil_position': array([frame, 0.]),
+            'cr_position': array([frame, 1.]),
+            'reseeded': bool(guess is not None and guess.get('reseed'))
+            or im[0, 1] != 0,
+            }
+
+    def get_result(self):
+        return self.result
+
+
+def _echo_finders(delays):
+    """ A make_finders giving the workers, in the order they start, each an
+        _EchoFinder taking the next of delays
+    """
+
+    started = multiprocessing.Value('i', 0)
+
+    def make_finders(backend):
+        with started.get_lock():
+            worker = started.value
+            started.value += 1
+        ff = _EchoFinder(worker, delays[worker])
+        return ({'radial': ff, 'starburst': ff}, ff)
+
+    return make_finders
+
+
+def _drain(pipeline, results, timeout=10.):
+    # get_result until every frame submitted is returned or dropped
+    give_up = time.time() + timeout
+    while pipeline.next_result < pipeline.frames_submitted:
+        assert time.time() < give_up, 'pipeline stalled'
+        result = pipeline.get_result()
+        if result is not None:
+            results.append(result)
+        else:
+            time.sleep(0.005)
+
+
+def test_frame_ring():
+    """ Push frames through the shared frame rings of two workers, reusing
+        one array for all of them, and check that every worker saw the frame
+        that was submitted, that the slots were reused, and that they are all
+        free again at the end
+    """
+
+    n_frames = 60
+    shape = (120, 160)
+    random_state = random.RandomState(0)
+
+    pipeline = PipelinedFeatureFinder(2, make_finders=_echo_finders([0.002,
+            0.005]))
+    try:
+        nslots = len(pipeline.frame_rings[0].free_slots)
+
+        im = zeros(shape, dtype=float32)
+        sums = []
+        slots_used = set()
+        results = []
+        for i in range(0, n_frames):
+            im[...] = random_state.randint(0, 256, shape)
+            im[0, 0] = i
+            sums.append(float(sum(im.astype(float64))))
+
+            pipeline.analyze_image(im)
+            (w, slot, image, submitted) = pipeline.in_flight[i]
+            assert slot is not None, i  # it went through the ring
+            slots_used.add((w, slot))
+
+            result = pipeline.get_result()
+            if result is not None:
+                results.append(result)
+        _drain(pipeline, results)
+
+        assert [r['frame'] for r in results] == range(0, n_frames)
+        for r in results:
+            assert r['frame_sum'] == sums[r['frame']], r['frame']
+        assert len(set([r['worker'] for r in results])) == 2
+        assert len(slots_used) <= 2 * nslots < n_frames
+        for frame_ring in pipeline.frame_rings:
+            assert sorted(frame_ring.free_slots) == range(0, nslots)
+    finally:
+        pipeline.stop_threads()
+
+    print '%d frames through %d slots: none corrupted' % (n_frames,
+            len(slots_used))
+
+
+def test_reorder():
+    """ With one worker much slower than the other, check that results come
+        back in the order the frames were submitted: all of them without a
+        max_latency, and with one, all but those held up on the slow worker,
+        which are dropped (and their results discarded when they arrive)
+    """
+
+    n_frames = 30
+    im = zeros((8, 8), dtype=float32)
+
+    for max_latency in (None, 0.03):
+        pipeline = PipelinedFeatureFinder(2, max_latency=max_latency,
+                make_finders=_echo_finders([0.002, 0.002]))
+        try:
+            # slow down the first worker only
+            pipeline.input_queues[0].put(pickle.dumps(('param', 0, 'radial',
+                    'delay', 0.1), pickle.HIGHEST_PROTOCOL))
+
+            workers = []
+            results = []
+            for i in range(0, n_frames):
+                im[0, 0] = i
+                pipeline.analyze_image(im)
+                workers.append(pipeline.in_flight[i][0])
+                result = pipeline.get_result()
+                if result is not None:
+                    results.append(result)
+                time.sleep(0.01)
+            _drain(pipeline, results)
+
+            frames = [r['frame'] for r in results]
+            slow_frames = [i for i in range(0, n_frames) if workers[i] == 0]
+            assert 0 < len(slow_frames) < n_frames
+            assert frames == sorted(frames)
+            if max_latency is None:
+                assert frames == range(0, n_frames)
+                assert pipeline.frames_dropped == 0
+            else:
+                assert frames == [i for i in range(0, n_frames) if workers[i]
+                                  == 1]
+                assert pipeline.frames_dropped == len(slow_frames)
+
+                # the late results are discarded
+                time.sleep(0.1 * len(pipeline.in_flight) + 0.1)
+                pipeline._collect_results(block=False)
+                assert len(pipeline.in_flight) == 0
+                assert len(pipeline.reorder_buffer) == 0
+        finally:
+            pipeline.stop_threads()
+
+        print 'max_latency %s: %d of %d frames in order, %d dropped' \
+            % (max_latency, len(frames), n_frames, pipeline.frames_dropped)
+
+
+def test_seeds():
+    """ Check that with propagate_seeds each frame is seeded with the
+        positions of the newest result back from either worker, and that the
+        pool reseeds every reseed_interval frames, counting from the last
+        reseed, whether scheduled or one a worker made on its own
+    """
+
+    n_frames = 40
+    reseed_interval = 5
+    lost_frame = 12
+
+    pipeline = PipelinedFeatureFinder(2, propagate_seeds=True,
+            reseed_interval=reseed_interval,
+            make_finders=_echo_finders([0.002, 0.005]))
+    try:
+        im = zeros((8, 8), dtype=float32)
+        results = []
+        for i in range(0, n_frames):
+            im[0, 0] = i
+            im[0, 1] = i == lost_frame
+            pipeline.analyze_image(im)
+            result = pipeline.get_result()
+            if result is not None:
+                results.append(result)
+            time.sleep(0.005)
+        _drain(pipeline, results)
+        depth = pipeline.pipeline_depth
+    finally:
+        pipeline.stop_threads()
+
+    assert [r['frame'] for r in results] == range(0, n_frames)
+
+    # seeded with the newest result filed, which, once the pipeline is
+    # full, is never more than its depth behind
+    seeds = []
+    for r in results:
+        (i, guess) = (r['frame'], r['guess'])
+        if 'pupil_position' not in guess:
+            assert len(seeds) == 0 and i <= depth, i
+            continue
+        j = int(guess['pupil_position'][0])
+        assert allclose(guess['pupil_position'], [j, 0.]), i
+        assert allclose(guess['cr_position'], [j, 1.]), i
+        assert i - 1 - depth <= j < i, (i, j)
+        assert len(seeds) == 0 or j >= seeds[-1], (i, j)
+        seeds.append(j)
+
+    reseeds = [r['frame'] for r in results if r['guess']['reseed']]
+    expected = range(0, lost_frame, reseed_interval) + range(lost_frame
+            + reseed_interval, n_frames, reseed_interval)
+    assert reseeds == expected, reseeds
+
+    print 'seeds propagated to %d of %d frames; reseeds at %s' \
+        % (len(seeds), n_frames, reseeds)
@@ -0,0 +1,137 @@
+#
+#  RaySampling.py
+#  EyeTracker
+#
+#  Bilinear sampling of an image along the starburst finder's rays, from
+#  tables precomputed for the ray pattern.
+#
+
+from numpy import *
+from Workspace import *
+
+
+class RaySampler(object):
+    """ Samples an image by bilinear interpolation along a fixed pattern of
+        rays (nrays x samples x 2, relative to a seed point), giving the
+        same values as the starburst finder's _get_image_values_interp_faster
+        (nan for samples off the image, or on its last row or column).
+
+        The pattern is split into whole and fractional pixels once, and the
+        flat offsets of the four pixels around every sample, relative to
+        the seed's whole pixel, are kept for up to cache_size image widths.
+        Sampling is then one take of all four pixels of
+        every sample into a single contiguous workspace buffer, and one sum
+        weighted by the fractional pixels shifted by the sub-pixel part of
+        the seed (which differs from seed to seed, so those weights are
+        worked out on each call, in workspace buffers); the samples are
+        only checked against the edges of the image when the pattern
+        reaches past them.
+    """
+
+    def __init__(self, rays, workspace=None, cache_size=4):
+        if workspace is None:
+            workspace = Workspace()
+        self.workspace = workspace
+        self.cache_size = cache_size
+
+        self.rays = rays
+        whole = floor(rays)
+        (self.whole_x, self.whole_y) = (whole[:, :, 0].astype(int),
+                                        whole[:, :, 1].astype(int))
+        (self.fraction_x, self.fraction_y) = (rays[:, :, 0] - whole[:, :, 0],
+                rays[:, :, 1] - whole[:, :, 1])
+
+        # bounds on the whole pixels of the samples, whatever the seed
+        self.extent = (self.whole_x.min(), self.whole_x.max() + 1,
+                       self.whole_y.min(), self.whole_y.max() + 1)
+
+        # image width -> (offsets, lowest)
+        self.offsets = {}
+
+    def sample(self, im, seed_point):
+        """ The image values at the samples of the rays cast from seed_point,
+            as an nrays x samples array that is only valid until the next
+            call
+        """
+
+        ws = self.workspace
+        im = ascontiguousarray(im)
+        (rows, cols) = im.shape
+
+        vals = ws.get('ray_values', self.rays.shape[0:2], float64)
+
+        seed = asarray(seed_point, dtype=float64)[0:2]
+        if not isfinite(seed).all():
+            vals.fill(nan)
+            return vals
+
+        corner = floor(seed)
+        (offsets, weights, carry_x, carry_y, lowest) = \
+            self._weights(seed - corner, cols)
+        (x, y) = (int(corner[0]), int(corner[1]))
+        (lowest_x, highest_x, lowest_y, highest_y) = self.extent
+
+        flat = im.reshape(-1)
+        base = x * cols + y + lowest
+        corners = ws.get('ray_corners', offsets.shape, im.dtype)
+
+        if x + lowest_x >= 0 and x + highest_x <= rows - 2 and y + lowest_y \
+            >= 0 and y + highest_y <= cols - 2:
+            take(flat[base:], offsets, out=corners, mode='clip')
+            einsum('kij,kij->ij', corners, weights, out=vals)
+            return vals
+
+        # the pattern may reach off the image (where the clipped take
+        # gathers pixels that don't matter)
+        whole_x = self.whole_x + carry_x
+        whole_y = self.whole_y + carry_y
+        bad = (whole_x < -x) | (whole_x > rows - 2 - x) | (whole_y < -y) \
+            | (whole_y > cols - 2 - y)
+        take(flat, offsets + base, out=corners, mode='clip')
+        einsum('kij,kij->ij', corners, weights, out=vals)
+        vals[bad] = nan
+        return vals
+
+    def _weights(self, subpixel, cols):
+        ws = self.workspace
+        shape = self.rays.shape[0:2]
+
+        # the four pixels around each sample, by offset into the flattened
+        # image from the seed's whole pixel, shifted to be non-negative
+        if cols not in self.offsets:
+            if len(self.offsets) >= self.cache_size:
+                self.offsets.clear()
+            flat = self.whole_x * cols + self.whole_y
+            offsets = array([flat, flat + cols, flat + 1, flat + cols + 1])
+            lowest = offsets.min()
+            offsets -= lowest
+            self.offsets[cols] = (offsets, lowest)
+        (offsets, lowest) = self.offsets[cols]
+
+        # carry the fractional pixels of the samples that the seed's
+        # sub-pixel part pushes past a whole one
+        u = ws.get('ray_u', shape, float64)
+        add(self.fraction_x, subpixel[0], out=u)
+        carry_x = ws.get('ray_carry_x', shape, bool)
+        greater_equal(u, 1., out=carry_x)
+        subtract(u, carry_x, out=u)
+        v = ws.get('ray_v', shape, float64)
+        add(self.fraction_y, subpixel[1], out=v)
+        carry_y = ws.get('ray_carry_y', shape, bool)
+        greater_equal(v, 1., out=carry_y)
+        subtract(v, carry_y, out=v)
+
+        shifted = ws.get('ray_offsets', offsets.shape, offsets.dtype)
+        carry = ws.get('ray_carry', shape, offsets.dtype)
+        multiply(carry_x, cols, out=carry)
+        add(carry, carry_y, out=carry)
+        add(offsets, carry, out=shifted)
+
+        weights = ws.get('ray_weights', offsets.shape, float64)
+        (u_, v_) = (1 - u, 1 - v)
+        multiply(u_, v_, out=weights[0])
+        multiply(u, v_, out=weights[1])
+        multiply(u_, v, out=weights[2])
+        multiply(u, v, out=weights[3])
+
+        return (shifted, weights, carry_x, carry_y, lowest)
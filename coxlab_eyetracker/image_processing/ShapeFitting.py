@@ -0,0 +1,512 @@
+#
+#  ShapeFitting.py
+#  EyeTracker
+#
+#  Direct (non-iterative) circle and ellipse fits to the boundary points
+#  found by the starburst finder.
+#
+
+from numpy import *
+from Workspace import *
+
+
+class ShapeFitter(object):
+    """ Fits circles and ellipses to N x 2 arrays of points, returning
+        (center, radius, err) as the starburst finder's fits always have.
+        A fit with no points (or a degenerate one) gives center (-1, -1),
+        radius 0 and infinite err; too few points for the shape gives the
+        centroid and the mean distance from it, with err 0.
+
+        Every fit is solved in closed form from the moments of the points
+        about their centroid, up to fourth order, which are gathered with a
+        single matrix product over storage held in a Workspace.  Each fit_*
+        method also has a batched form taking a stack of K point sets, as a
+        K x N x 2 array plus the number of valid points at the start of
+        each (or as a list of N x 2 arrays), and returning K centers, radii
+        and errs as arrays.
+
+        Circles:
+          fit_circle: Kasa's algebraic fit, minimizing the sum of squared
+            residuals of x^2 + y^2 + a x + b y + c = 0, which is linear in
+            (a, b, c).  The same fit the finder used to iterate to with
+            scipy.optimize.leastsq.
+          fit_circle_taubin: Taubin's fit, which normalizes the algebraic
+            residuals by their gradient, and so is much less biased toward
+            small circles when the points cover only part of the boundary.
+          For both, err is the sum of squared algebraic residuals.
+
+          fit_circle_ransac: Kasa's fit, made robust to outliers by RANSAC.
+            All of the random samples are drawn, fitted and scored at once.
+
+        Ellipses (both fall back to fit_circle when the points don't fit
+        an ellipse):
+          fit_ellipse: the least squares conic a x^2 + b x y + c y^2 + d x
+            + e y = 1, as the finder has always fitted it.
+          fit_ellipse_direct: Fitzgibbon's ellipse-specific fit, in the
+            numerically stable form of Halir and Flusser; the radius is the
+            semi-major axis and err the sum of squared radial distances of
+            the points from the ellipse.
+    """
+
+    def __init__(self, workspace=None, seed=None):
+        if workspace is None:
+            workspace = Workspace()
+        self.workspace = workspace
+
+        # the source of RANSAC's samples; give a seed for repeatable fits
+        self.random = random.RandomState(seed)
+
+    def begin_frame(self):
+        self.workspace.begin_frame()
+
+    def fit_circle(self, points):
+        return self._fit_one(self._circle_kasa, 4, points)
+
+    def fit_circle_taubin(self, points):
+        return self._fit_one(self._circle_taubin, 4, points)
+
+    def fit_circle_ransac(self, points, iterations=20, sample_size=8,
+                          inlier_threshold=0.05):
+        """ Fit circles to iterations random samples of sample_size points,
+            and take as inliers to each the points within inlier_threshold
+            times its radius of it (as well as the sample itself).  Each
+            hypothesis with more than half of the points as inliers is
+            refitted to them, and the best fit (by err), among these refits
+            and the fit to all the points, is returned.
+        """
+
+        if points is None or len(points) < sample_size:
+            return self.fit_circle(points)
+
+        points = asarray(points, dtype=float64)
+        n = len(points)
+
+        best = self.fit_circle(points)
+
+        # every hypothesis's sample: the start of a random permutation
+        order = self.random.rand(iterations, n).argsort(axis=1)
+        samples = order[:, 0:sample_size]
+        (centers, radii, errs) = self.fit_circles(points[samples])
+
+        # the distance of every point from every hypothesis
+        offsets = points[newaxis, :, :] - centers[:, newaxis, :]
+        distances = hypot(offsets[:, :, 0], offsets[:, :, 1])
+        distances -= radii[:, newaxis]
+        inliers = abs(distances) < inlier_threshold * radii[:, newaxis]
+        inliers[arange(iterations)[:, newaxis], samples] = True
+
+        counts = inliers.sum(axis=1)
+        consensus = counts > n // 2
+        if not consensus.any():
+            return best
+
+        # refit the hypotheses with consensus to their inliers, which are
+        # moved to the front of each row
+        rows = (~inliers[consensus]).argsort(axis=1, kind='mergesort')
+        (centers, radii, errs) = self.fit_circles(points[rows],
+                counts[consensus])
+
+        k = errs.argmin()
+        if errs[k] < best[2]:
+            best = (centers[k], float(radii[k]), float(errs[k]))
+        return best
+
+    def fit_ellipse(self, points):
+        return self._fit_one(self._ellipse_conic, 5, points)
+
+    def fit_ellipse_direct(self, points):
+        return self._fit_one(self._ellipse_direct, 5, points)
+
+    def fit_circles(self, point_sets, counts=None):
+        return self._fit_many(self._circle_kasa, 4, point_sets, counts)
+
+    def fit_circles_taubin(self, point_sets, counts=None):
+        return self._fit_many(self._circle_taubin, 4, point_sets, counts)
+
+    def fit_ellipses(self, point_sets, counts=None):
+        return self._fit_many(self._ellipse_conic, 5, point_sets, counts)
+
+    def fit_ellipses_direct(self, point_sets, counts=None):
+        return self._fit_many(self._ellipse_direct, 5, point_sets, counts)
+
+    def _fit_one(self, fit, min_points, points):
+        if points is None or len(points) == 0:
+            return (array([-1., -1.]), 0.0, inf)
+
+        points = asarray(points, dtype=float64)
+        (centroid, x, y, M) = self._moments(points)
+
+        if len(points) < min_points:
+            return (centroid, sqrt(x * x + y * y).mean(), 0.0)
+
+        with errstate(divide='ignore', invalid='ignore'):
+            (cx, cy, radius, err) = fit(M, x, y)
+
+        if not isfinite(cx + cy + radius):
+            return (array([-1., -1.]), 0.0, inf)
+
+        centroid[0] += cx
+        centroid[1] += cy
+        return (centroid, float(radius), float(err))
+
+    def _fit_many(self, fit, min_points, point_sets, counts=None):
+        ws = self.workspace
+
+        if not isinstance(point_sets, ndarray) or point_sets.ndim != 3:
+            # a list of point sets: pack them into one padded stack
+            point_sets = [asarray(p, dtype=float64).reshape(-1, 2)
+                          for p in point_sets]
+            counts = array([len(p) for p in point_sets], dtype=int)
+            packed = ws.get('fit_packed', (len(point_sets),
+                            maximum(counts.max(), 1), 2), float64)
+            for (k, p) in enumerate(point_sets):
+                packed[k, 0:len(p)] = p
+            point_sets = packed
+
+        (K, N) = point_sets.shape[0:2]
+        if counts is None:
+            counts = empty(K, dtype=int)
+            counts.fill(N)
+        counts = asarray(counts)
+
+        (centroids, x, y, valid, M) = self._batch_moments(point_sets, counts)
+
+        with errstate(divide='ignore', invalid='ignore'):
+            (cx, cy, radii, errs) = fit(M, x, y, valid)
+
+        centers = empty((K, 2))
+        centers[:, 0] = centroids[:, 0] + cx
+        centers[:, 1] = centroids[:, 1] + cy
+        radii = array(radii, dtype=float64)
+        errs = array(errs, dtype=float64)
+
+        few = counts < min_points
+        if few.any():
+            distances = where(valid, sqrt(x * x + y * y), 0.)
+            centers[few] = centroids[few]
+            radii[few] = distances[few].sum(axis=1) / maximum(counts[few], 1)
+            errs[few] = 0.
+
+        failed = ~(isfinite(radii) & isfinite(centers).all(axis=1)) & ~few
+        failed |= counts == 0
+        centers[failed] = -1.
+        radii[failed] = 0.
+        errs[failed] = inf
+
+        return (centers, radii, errs)
+
+    def _moments(self, points):
+        """ The centroid and centred coordinates of the points, and the 6 x 6
+            moments of the centred points: the sums of the pairwise products
+            of x^2, x y, y^2, x, y and 1
+        """
+
+        ws = self.workspace
+
+        terms = ws.get('fit_terms', (len(points), 6), float64)
+        centred = terms[:, 3:5]
+
+        centroid = points.sum(axis=0) / len(points)
+        subtract(points, centroid, centred)
+        multiply(terms[:, 3:4], centred, terms[:, 0:2])
+        multiply(terms[:, 4], terms[:, 4], terms[:, 2])
+        terms[:, 5] = 1.
+
+        M = ws.get('fit_moments', (6, 6), float64)
+        dot(terms.T, terms, out=M)
+
+        return (centroid, terms[:, 3], terms[:, 4], M)
+
+    def _batch_moments(self, point_sets, counts):
+        """ As _moments, for each of a stack of point sets, of which only the
+            first counts[k] points of set k are used
+        """
+
+        ws = self.workspace
+        (K, N) = point_sets.shape[0:2]
+
+        valid = ws.get('fit_valid', (K, N), bool)
+        less(arange(N), counts[:, newaxis], valid)
+
+        terms = ws.get('fit_batch_terms', (K, N, 6), float64)
+        centred = terms[:, :, 3:5]
+
+        centred.fill(0.)
+        copyto(centred, point_sets, where=valid[:, :, newaxis])
+        centroids = centred.sum(axis=1) / maximum(counts, 1)[:, newaxis]
+        subtract(centred, centroids[:, newaxis, :], centred)
+        multiply(centred, valid[:, :, newaxis], centred)
+
+        multiply(terms[:, :, 3:4], centred, terms[:, :, 0:2])
+        multiply(terms[:, :, 4], terms[:, :, 4], terms[:, :, 2])
+        terms[:, :, 5] = valid
+
+        M = ws.get('fit_batch_moments', (K, 6, 6), float64)
+        einsum('kni,knj->kij', terms, terms, out=M)
+
+        return (centroids, terms[:, :, 3], terms[:, :, 4], valid, M)
+
+    # The fits below take the moments M of one point set or a stack of them
+    # (6 x 6 or K x 6 x 6), and the centred coordinates of the points (N or
+    # K x N, with valid marking the real points of a stack), and return the
+    # center offset from the centroid, the radius and the err of each fit
+
+    def _sums(self, M):
+        """ The circle fits' moments, as sums over the centred points (with
+            z = x^2 + y^2): (n, sx, sy, sxx, sxy, syy, sxz, syz, sz, szz)
+        """
+
+        m = list(rollaxis(M.reshape(M.shape[0:-2] + (36, )), -1))
+        return (m[35], m[23], m[29], m[21], m[22], m[28], m[3] + m[15], m[4]
+                + m[16], m[5] + m[17], m[0] + 2 * m[2] + m[14])
+
+    def _algebraic_error(self, sums, a, b, c):
+        """ The sum of squared residuals of x^2 + y^2 + a x + b y + c over
+            the points
+        """
+
+        (n, sx, sy, sxx, sxy, syy, sxz, syz, sz, szz) = sums
+        err = szz + a * a * sxx + b * b * syy + c * c * n + 2 * (a * sxz + b
+                * syz + c * sz + a * b * sxy + a * c * sx + b * c * sy)
+
+        # (which rounding can leave slightly negative)
+        return maximum(err, 0.)
+
+    def _circle_kasa(self, M, x=None, y=None, valid=None):
+        sums = self._sums(M)
+        (n, sx, sy, sxx, sxy, syy, sxz, syz, sz, szz) = sums
+
+        # the normal equations, given that the points are centred
+        det = sxx * syy - sxy * sxy
+        a = (sxy * syz - syy * sxz) / det
+        b = (sxy * sxz - sxx * syz) / det
+        c = -sz / n
+
+        cx = -a / 2
+        cy = -b / 2
+        radius = sqrt(cx * cx + cy * cy - c)
+
+        return (cx, cy, radius, self._algebraic_error(sums, a, b, c))
+
+    def _circle_taubin(self, M, x=None, y=None, valid=None):
+        sums = self._sums(M)
+        (n, sx, sy, sxx, sxy, syy, sxz, syz, sz, szz) = sums
+        (mxx, mxy, myy, mxz, myz, mzz) = (sxx / n, sxy / n, syy / n, sxz / n,
+                syz / n, szz / n)
+
+        mz = mxx + myy
+        cov_xy = mxx * myy - mxy * mxy
+        var_z = mzz - mz * mz
+
+        # the characteristic polynomial, whose smallest root gives the fit
+        # (after Chernov's implementation)
+        a3 = 4 * mz
+        a2 = -3 * mz * mz - mzz
+        a1 = var_z * mz + 4 * cov_xy * mz - mxz * mxz - myz * myz
+        a0 = mxz * (mxz * myy - myz * mxy) + myz * (myz * mxx - mxz * mxy) \
+            - var_z * cov_xy
+
+        root = self._smallest_root(a0, a1, a2, a3)
+
+        det = 2 * (root * root - root * mz + cov_xy)
+        cx = (mxz * (myy - root) - myz * mxy) / det
+        cy = (myz * (mxx - root) - mxz * mxy) / det
+        radius = sqrt(cx * cx + cy * cy + mz)
+
+        return (cx, cy, radius, self._algebraic_error(sums, -2 * cx, -2
+                * cy, -mz))
+
+    def _smallest_root(self, a0, a1, a2, a3):
+        """ The smallest root of a0 + a1 x + a2 x^2 + a3 x^3, by Newton's
+            method from zero (for Taubin's fit, whose polynomial it
+            approaches monotonically).  A step that doesn't reduce the
+            polynomial means the data are degenerate, and the root is taken
+            to be zero.
+        """
+
+        if ndim(a0) == 0:
+            # one fit: iterate on plain floats
+            (a0, a1, a2, a3) = (float(a0), float(a1), float(a2), float(a3))
+            (root, value) = (0., a0)
+            for i in range(20):
+                slope = a1 + root * (2 * a2 + 3 * a3 * root)
+                if not slope:
+                    return 0.
+                new_root = root - value / slope
+                if abs(new_root - root) <= 1e-12 * abs(new_root):
+                    return new_root
+                new_value = a0 + new_root * (a1 + new_root * (a2 + new_root
+                        * a3))
+                if not abs(new_value) < abs(value):
+                    return 0.
+                (root, value) = (new_root, new_value)
+            return root
+
+        root = zeros_like(a0)
+        value = a0
+        active = isfinite(a0)
+        for i in range(20):
+            slope = a1 + root * (2 * a2 + 3 * a3 * root)
+            new_root = where(active, root - value / slope, root)
+            converged = active & (abs(new_root - root) <= 1e-12
+                                  * abs(new_root))
+            new_value = a0 + new_root * (a1 + new_root * (a2 + new_root * a3))
+            diverged = active & ~converged & ~(abs(new_value) < abs(value))
+
+            root = where(diverged, 0., new_root)
+            value = new_value
+            active = active & ~(converged | diverged)
+            if not active.any():
+                break
+        return root
+
+    def _ellipse_conic(self, M, x, y, valid=None):
+        ws = self.workspace
+
+        A = self._solve(M[..., 0:5, 0:5], M[..., 0:5, 5:6])[..., 0]
+
+        # The xy coefficient is never used: the center and radius are those
+        # of the axis-aligned ellipse.  (The fit this replaces did try to
+        # rotate the ellipse into alignment first, but the rotation angle
+        # it computed was 1 / 2 * arctan(...), which is always zero.)
+        (a, c, d, e) = (A[..., 0], A[..., 2], A[..., 3], A[..., 4])
+        is_ellipse = a * c > 0
+
+        flip = sign(a)
+        (a, c, d, e) = (flip * a, flip * c, flip * d, flip * e)
+
+        cx = -d / 2 / a
+        cy = -e / 2 / c
+        F = 1 + d * d / (4 * a) + e * e / (4 * c)
+        axis_x = sqrt(F / a)
+        axis_y = sqrt(F / c)
+        radius = maximum(axis_x, axis_y)
+
+        # the radial error as the original fit computed it: at angle t from
+        # the center, it took the ellipse to lie at
+        # axis_x axis_y / sqrt((axis_y cos t)^2 + axis_x sin(t)^2)
+        (dx, dy, r, r_fit) = ws.get('fit_scratch', (4, ) + x.shape, float64)
+        subtract(x, cx[..., newaxis], dx)
+        subtract(y, cy[..., newaxis], dy)
+        hypot(dx, dy, r)
+
+        dx *= dx
+        dx *= (axis_y * axis_y)[..., newaxis]
+        dy *= dy
+        dy *= axis_x[..., newaxis]
+        add(dx, dy, r_fit)
+        sqrt(r_fit, r_fit)
+        divide((axis_x * axis_y)[..., newaxis], r_fit, r_fit)
+        r_fit -= 1.
+        r_fit *= r
+        r_fit *= r_fit
+        err = self._sum_valid(r_fit, valid)
+
+        return self._circle_unless(is_ellipse, M, (cx, cy, radius, err))
+
+    def _ellipse_direct(self, M, x, y, valid=None):
+        ws = self.workspace
+
+        # Halir and Flusser's partitioning of the scatter matrix into its
+        # quadratic and linear parts
+        S1 = M[..., 0:3, 0:3]
+        S2 = M[..., 0:3, 3:6]
+        S3 = M[..., 3:6, 3:6]
+
+        T = -self._solve(S3, swapaxes(S2, -1, -2))
+        R = S1 + einsum('...ij,...jk->...ik', S2, T)
+
+        # premultiplied by the inverse of the constraint matrix
+        C = empty(R.shape)
+        C[..., 0, :] = R[..., 2, :] / 2
+        C[..., 1, :] = -R[..., 1, :]
+        C[..., 2, :] = R[..., 0, :] / 2
+
+        solvable = isfinite(C).all(axis=(-2, -1))
+        if not solvable.all():
+            C[~solvable] = identity(3)
+        vectors = linalg.eig(C)[1].real
+
+        # the eigenvector satisfying the ellipse constraint 4ac - b^2 > 0
+        constraint = 4 * vectors[..., 0, :] * vectors[..., 2, :] \
+            - vectors[..., 1, :] ** 2
+        best = constraint.argmax(axis=-1)
+        chosen = arange(3) == best[..., newaxis]
+        is_ellipse = solvable & (constraint.max(axis=-1) > 0)
+
+        conic = empty(shape(best) + (6, ))
+        conic[..., 0:3] = einsum('...ij,...j->...i', vectors, chosen)
+        conic[..., 3:6] = einsum('...ij,...j->...i', T, conic[..., 0:3])
+        conic *= sign(conic[..., 0] + conic[..., 2])[..., newaxis]
+        (a, b, c, d, e, f) = [conic[..., i] for i in range(6)]
+
+        den = b * b - 4 * a * c
+        cx = (2 * c * d - b * e) / den
+        cy = (2 * a * e - b * d) / den
+
+        # about its center, the conic is a x^2 + b x y + c y^2 = -g
+        g = a * cx * cx + b * cx * cy + c * cy * cy + d * cx + e * cy + f
+        smallest = (a + c) / 2 - sqrt(((a - c) / 2) ** 2 + (b / 2) ** 2)
+        radius = sqrt(-g / smallest)
+        is_ellipse = is_ellipse & (g < 0)
+
+        # the radial error: in the direction of each point, the ellipse lies
+        # sqrt(-g / q) times as far from the center, where q is the
+        # quadratic part of the conic at the point
+        (dx, dy, r, q) = ws.get('fit_scratch', (4, ) + x.shape, float64)
+        subtract(x, cx[..., newaxis], dx)
+        subtract(y, cy[..., newaxis], dy)
+        hypot(dx, dy, r)
+
+        multiply(dx, dx, q)
+        q *= a[..., newaxis]
+        dx *= dy
+        dx *= b[..., newaxis]
+        q += dx
+        dy *= dy
+        dy *= c[..., newaxis]
+        q += dy
+
+        divide(-g[..., newaxis], q, q)
+        sqrt(q, q)
+        q -= 1.
+        q *= r
+        q *= q
+        err = self._sum_valid(q, valid)
+
+        return self._circle_unless(is_ellipse, M, (cx, cy, radius, err))
+
+    def _solve(self, A, b):
+        """ Solve A x = b (or each of a stack of such systems), with NaNs
+            for any that are singular
+        """
+
+        try:
+            return linalg.solve(A, b)
+        except linalg.LinAlgError:
+            x = empty(b.shape)
+            x.fill(nan)
+            if A.ndim > 2:
+                for k in range(len(A)):
+                    try:
+                        x[k] = linalg.solve(A[k], b[k])
+                    except linalg.LinAlgError:
+                        pass
+            return x
+
+    def _sum_valid(self, values, valid):
+        if valid is None:
+            return values.sum(axis=-1)
+        return where(valid, values, 0.).sum(axis=-1)
+
+    def _circle_unless(self, is_ellipse, M, ellipse):
+        """ The ellipse fits, with circles fitted to the point sets that
+            aren't ellipses
+        """
+
+        if is_ellipse.all():
+            return ellipse
+
+        circle = self._circle_kasa(M)
+        return tuple(where(is_ellipse, e, c) for (e, c) in zip(ellipse,
+                     circle))
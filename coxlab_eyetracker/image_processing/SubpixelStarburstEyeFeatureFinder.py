@@ -12,12 +12,12 @@ from numpy import *
 # from EdgeDetection import *
 from stopwatch import *
 from EyeFeatureFinder import *
-from scipy.weave import inline
-# from scipy.weave import converters
 import scipy.optimize
 from coxlab_eyetracker.util import *
 
-from WovenBackend import *
+from ImageProcessingBackend import *
+from ShapeFitting import *
+from RaySampling import *
 
 
 class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
@@ -25,7 +25,8 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
     def __init__(self, **kwargs):
         self.parameters_updated = False
 
-        self.backend = WovenBackend()
+        self.backend = make_backend(kwargs.get('backend', 'woven'))
+        self.tuned_shape = None
 
         self.shortcut_sobel = kwargs.get('shortcut_sobel', None)
 
@@ -51,11 +52,45 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
 
         self.ray_sampling_method = kwargs.get('ray_sampling_method', 'interp')
 
+        # use the backend's compiled ray search, where there is one
+        self.native_ray_search = kwargs.get('native_ray_search', True)
+
+        # compute the gradient only over the windows of the frame that the
+        # rays can reach, plus roi_sobel_margin pixels (enough for the
+        # bilinear samples and the Sobel kernel to see the same pixels as
+        # over the whole frame); the gradient is computed roi_sobel_slack
+        # pixels further, so that it usually also covers the second,
+        # refined, pupil starburst (and, shared through a gradient_cache,
+        # a reseed of the same frame)
+        self.roi_sobel = kwargs.get('roi_sobel', True)
+        self.roi_sobel_margin = kwargs.get('roi_sobel_margin', 3)
+        self.roi_sobel_slack = kwargs.get('roi_sobel_slack', 4)
+
+        # a GradientCache shared with the other stages analyzing the same
+        # frames (see FrugalCompositeEyeFeatureFinder), if any
+        self.gradient_cache = kwargs.get('gradient_cache', None)
+
+        # 'circle_least_squares', 'circle_taubin',
+        # 'circle_least_squares_ransac', 'ellipse_least_squares' or
+        # 'ellipse_direct' (see ShapeFitting)
         self.fitting_algorithm = kwargs.get('fitting_algorithm',
                 'ellipse_least_squares')
 
+        # RANSAC: the number of random samples, the points in each, and the
+        # distance from a sample's circle (as a fraction of its radius) of
+        # the points it counts as inliers; give a seed for repeatable fits
+        self.ransac_iterations = kwargs.get('ransac_iterations', 20)
+        self.ransac_sample_size = kwargs.get('ransac_sample_size', 8)
+        self.ransac_inlier_threshold = kwargs.get('ransac_inlier_threshold',
+                0.05)
+        self.workspace = Workspace()
+        self.fitter = ShapeFitter(self.workspace, kwargs.get('ransac_seed',
+                                  None))
+
         self.pupil_rays = None
         self.cr_rays = None
+        self.pupil_sampler = None
+        self.cr_sampler = None
 
         self.x_axis = 0
         self.y_axis = 1
@@ -82,10 +117,14 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
 
         if self.fitting_algorithm == 'circle_least_squares':
             self._fit_points = self._fit_circle_to_points_lstsq
+        elif self.fitting_algorithm == 'circle_taubin':
+            self._fit_points = self.fitter.fit_circle_taubin
         elif self.fitting_algorithm == 'circle_least_squares_ransac':
             self._fit_points = self._fit_circle_to_points_lstsq_ransac
         elif self.fitting_algorithm == 'ellipse_least_squares':
             self._fit_points = self._fit_ellipse_to_points
+        elif self.fitting_algorithm == 'ellipse_direct':
+            self._fit_points = self.fitter.fit_ellipse_direct
         else:
             self._fit_points = self._fit_mean_to_points
 
@@ -130,6 +169,10 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
             self.pupil_rays[r, :, self.y_axis] = self.pupil_ray_sampling \
                 * sin(ray_angle)
 
+        # sampling tables for the ray patterns
+        self.cr_sampler = RaySampler(self.cr_rays, self.workspace)
+        self.pupil_sampler = RaySampler(self.pupil_rays, self.workspace)
+
         self.cr_boundary_points = None
         self.pupil_boundary_points = None
         self.cr_ray_starts = None
@@ -145,12 +188,19 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
 
         # print "sb"
 
-        use_weave = 0
-        if 'weave' in kwargs:
-            use_weave = kwargs['weave']
+        # 'weave' is the old name for the native switch
+        if kwargs.get('weave', self.native_ray_search):
+            find_ray_boundaries = self._find_ray_boundaries_native
+        else:
+            find_ray_boundaries = self._find_ray_boundaries
 
         # Clear the result
         self.result = None
+        if self.tuned_shape != image.shape:
+            self.backend.autotune(image)
+            self.tuned_shape = image.shape
+        self.backend.begin_frame()
+        self.workspace.begin_frame()
 
         features = {}
         if guess is not None and 'frame_number' in guess:
@@ -171,31 +221,49 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
 
         # image = double(image)
 
-        # compute the image gradient
-        if self.shortcut_sobel == None:
-            (image_grad_mag, image_grad_x, image_grad_y) = \
-                self.backend.sobel3x3(image)
+        # compute the image gradient, over the whole frame or just around
+        # the seeds
+        if self.shortcut_sobel is not None:
+            gradient = (self.shortcut_sobel, (0, image.shape[0], 0,
+                        image.shape[1]))
         else:
-            image_grad_mag = self.shortcut_sobel
+            gradient = None
+            if self.roi_sobel:
+                gradient = self._gradient_over(image,
+                        [self._ray_window(cr_guess, self.cr_ray_length,
+                         self.roi_sobel_slack), self._ray_window(pupil_guess,
+                         self.pupil_ray_length, self.roi_sobel_slack)],
+                        [self._ray_window(cr_guess, self.cr_ray_length),
+                         self._ray_window(pupil_guess,
+                         self.pupil_ray_length)])
+            if gradient is None:
+                gradient = self._gradient_over(image, None)
+
+        def search(gradient, seed, rays, cutoff_index, threshold, **kwargs):
+            # find_ray_boundaries, in the coordinates of the gradient's window
+            (image_grad_mag, window) = gradient
+            corner = array([window[0], window[2]], dtype=float)
+            if kwargs.get('exclusion_center') is not None:
+                kwargs['exclusion_center'] = kwargs['exclusion_center'] \
+                    - corner
+            boundaries = find_ray_boundaries(image_grad_mag, asarray(seed,
+                    dtype=float) - corner, rays, cutoff_index, threshold,
+                    **kwargs)
+            return asarray(boundaries, dtype=float).reshape(-1, 2) + corner
 
         # Do the heavy lifting
         # try:
-        if use_weave:
-            cr_boundaries = self._find_ray_boundaries_woven(image_grad_mag,
-                    cr_guess, self.cr_rays, self.cr_min_radius_ray_index,
-                    self.cr_threshold)
-        else:
-            cr_boundaries = self._find_ray_boundaries(image_grad_mag, cr_guess,
-                    self.cr_rays, self.cr_min_radius_ray_index,
-                    self.cr_threshold)
+        cr_boundaries = search(gradient, cr_guess, self.cr_rays,
+                               self.cr_min_radius_ray_index,
+                               self.cr_threshold)
 
         (cr_position, cr_radius, cr_err) = self._fit_points(cr_boundaries)
 
         # do a two-stage starburst fit for the pupil
         # stage 1, rough cut
         # self.pupil_min_radius_ray_index
-        pupil_boundaries = self._find_ray_boundaries(
-            image_grad_mag,
+        pupil_boundaries = search(
+            gradient,
             pupil_guess,
             self.pupil_rays,
             self.pupil_min_radius_ray_index,
@@ -211,8 +279,18 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
         minimum_pupil_guess = round(0.5 * pupil_radius
                                     / self.pupil_ray_sample_spacing)
 
-        pupil_boundaries = self._find_ray_boundaries(
-            image_grad_mag,
+        # the refined seed may have moved the rays out of the window
+        if self.roi_sobel and self.shortcut_sobel is None:
+            window = self._ray_window(pupil_position, self.pupil_ray_length)
+            if window is None or not self._window_within(window, gradient[1],
+                    image.shape):
+                gradient = self._gradient_over(image,
+                        [self._ray_window(pupil_position,
+                         self.pupil_ray_length, self.roi_sobel_slack)],
+                        [window]) or self._gradient_over(image, None)
+
+        pupil_boundaries = search(
+            gradient,
             pupil_position,
             self.pupil_rays,
             minimum_pupil_guess,
@@ -224,13 +302,6 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
         (pupil_position, pupil_radius, pupil_err) = \
             self._fit_points(pupil_boundaries)
 
-#            if(False and use_weave):
-#                pupil_boundaries = self._find_ray_boundaries_woven(image_grad_mag, pupil_guess, self.pupil_rays, self.pupil_min_radius_ray_index, self.pupil_threshold, exclusion_center=array(cr_position), exclusion_radius= 1.2 * cr_radius)
-#            else:
-#                pupil_boundaries = self._find_ray_boundaries(image_grad_mag, pupil_guess, self.pupil_rays, self.pupil_min_radius_ray_index, self.pupil_threshold, exclusion_center=array(cr_position), exclusion_radius= 1.2 * cr_radius)
-#
-#            pupil_position, pupil_radius, pupil_err = self._fit_points(pupil_boundaries)
-
         # except Exception, e:
         #    print "Error analyzing image: %s" % e.message
         #     formatted = formatted_exception()
@@ -276,6 +347,86 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
 
         self.result = features
 
+    def _ray_window(self, seed, ray_length, slack=0):
+        """ The window (top, bottom, left, right) of the frame that rays of
+            ray_length cast from seed (or from within slack pixels of it)
+            can sample, with roi_sobel_margin pixels around it, or None if
+            seed isn't a position.  Windows for the same ray_length and
+            slack are all the same size, so that the gradient's storage
+            and the ray sampling tables can be reused from frame to frame
+        """
+
+        if seed is None or size(seed) < 2:
+            return None
+        seed = asarray(seed, dtype=float)[0:2]
+        if not isfinite(seed).all():
+            return None
+
+        reach = int(ceil(ray_length + self.roi_sobel_margin + slack))
+        (top, left) = (int(floor(seed[0])) - reach, int(floor(seed[1]))
+                       - reach)
+        return (top, top + 2 * reach + 2, left, left + 2 * reach + 2)
+
+    def _window_within(self, window, region, shape):
+        """ Whether window, clipped to a frame of the given shape, lies
+            within region
+        """
+
+        return maximum(window[0], 0) >= region[0] and minimum(window[1],
+                shape[0]) <= region[1] and maximum(window[2], 0) \
+            >= region[2] and minimum(window[3], shape[1]) <= region[3]
+
+    def _gradient_over(self, image, windows, needed=None):
+        """ The gradient magnitude over the bounding box of windows, clipped
+            to the frame, and that box (top, bottom, left, right); None if
+            a window is missing or the box is empty (or, if windows is None,
+            over the whole frame).  If the gradient_cache already has the
+            gradient over the bounding box of the needed windows, that is
+            used instead
+        """
+
+        region = self._bounding_box(image.shape, windows)
+        if region is None:
+            return None
+
+        if self.gradient_cache is not None and needed is not None:
+            box = self._bounding_box(image.shape, needed)
+            found = box and self.gradient_cache.find(image, box)
+            if found:
+                return (found[0][0], found[1])
+
+        if self.gradient_cache is not None:
+            (image_grad_mag, image_grad_x, image_grad_y) = \
+                self.gradient_cache.gradient(image, self.backend, region)
+            return (image_grad_mag, region)
+
+        (top, bottom, left, right) = region
+        crop = image[top:bottom, left:right]
+        if crop.shape != image.shape:
+            crop = ascontiguousarray(crop)
+        (image_grad_mag, image_grad_x, image_grad_y) = \
+            self.backend.sobel3x3(crop)
+        return (image_grad_mag, region)
+
+    def _bounding_box(self, shape, windows):
+        """ The bounding box of windows, clipped to a frame of the given
+            shape (or the whole frame, if windows is None); None if a window
+            is missing or the box is empty
+        """
+
+        if windows is None:
+            return (0, shape[0], 0, shape[1])
+        if None in windows:
+            return None
+
+        bounds = array(windows)
+        box = (maximum(bounds[:, 0].min(), 0), minimum(bounds[:, 1].max(),
+               shape[0]), maximum(bounds[:, 2].min(), 0), minimum(bounds[:,
+               3].max(), shape[1]))
+        if box[0] >= box[1] or box[2] >= box[3]:
+            return None
+        return box
+
     def get_result(self):
         """ Get the result of a previous call to analyze_image.
             This call is separate from analyze_image so that analysis
@@ -296,6 +447,78 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
             cutoff_index -- the index along zero_referenced_rays below which we are sure that we are
                                     still within the feature.  Used to normalize threshold.
             threshold -- the threshold to cross, expressed in standard deviations across the ray samples
+
+            Keyword arguments:
+            exclusion_center, exclusion_radius -- drop boundary points within exclusion_radius of exclusion_center
+
+            Returns an N x 2 array of boundary points, at most one per ray
+        """
+
+        # get the values from the image at each of the points
+        if self.ray_sampling_method == 'interp':
+            vals = self._ray_sampler(zero_referenced_rays).sample(im,
+                    seed_point)
+        else:
+            vals = self._get_image_values(im, zero_referenced_rays[:, :,
+                    self.x_axis] + seed_point[self.x_axis],
+                    zero_referenced_rays[:, :, self.y_axis]
+                    + seed_point[self.y_axis])
+
+        cutoff_index = int(cutoff_index)
+
+        if cutoff_index != 0:
+            inner_vals = vals[:, 0:cutoff_index]
+            inner_vals = inner_vals[~isnan(inner_vals)]
+            normalized_threshold = threshold * std(inner_vals) \
+                + mean(inner_vals)
+        else:
+            normalized_threshold = threshold * std(vals) + mean(vals)
+
+        vals_slope = hstack((2 * ones([vals.shape[0], 1]), diff(vals, 1)))
+        vals_slope[isnan(vals_slope)] = 0
+
+        cutoff_index = max(cutoff_index, 0)
+        if cutoff_index >= vals.shape[1]:
+            return zeros((0, 2))
+
+        # scanning each ray outward from the cutoff, the boundary is the
+        # sample before the first non-rising one at or after the first
+        # sample above threshold (samples off the image never cross)
+        with errstate(invalid='ignore'):
+            crossed = vals[:, cutoff_index:] > normalized_threshold
+        crossed = logical_or.accumulate(crossed, axis=1)
+        boundary = crossed & (vals_slope[:, cutoff_index:] <= 0)
+
+        found = boundary.any(axis=1)
+        rays = nonzero(found)[0]
+        samples = boundary[rays].argmax(axis=1) + cutoff_index - 1
+
+        boundary_points = zero_referenced_rays[rays, samples] \
+            + asarray(seed_point, dtype=float)[0:2]
+
+        exclusion_center = kwargs.get('exclusion_center', None)
+        if exclusion_center is not None and size(exclusion_center) == 2:
+            exclusion_radius = kwargs['exclusion_radius']
+            offsets = boundary_points - asarray(exclusion_center, dtype=float)
+            keep = sqrt((offsets ** 2).sum(axis=1)) > exclusion_radius
+            boundary_points = boundary_points[keep]
+
+        return boundary_points
+
+    def _find_ray_boundaries_loop(self, im, seed_point, zero_referenced_rays,
+                                  cutoff_index, threshold, **kwargs):
+        """ The original ray-by-ray version of _find_ray_boundaries, returning
+            a list of points; kept as a reference for test_ray_boundaries
+
+            Find where a set off rays crosses a threshold in an image
+
+            Arguments:
+            im -- An image (usually a gradient magnitude image) in which crossing will be found
+            seed_point -- the origin from which rays will be projected
+            zero_referenced_rays -- the set of rays (starting at zero) to sample.  nrays x ray_sampling x image_dimension
+            cutoff_index -- the index along zero_referenced_rays below which we are sure that we are
+                                    still within the feature.  Used to normalize threshold.
+            threshold -- the threshold to cross, expressed in standard deviations across the ray samples
         """
 
         boundary_points = []
@@ -363,7 +586,7 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
             exclusion_radius = kwargs['exclusion_radius']
 
             for bp in boundary_points:
-                if exclusion_center == None or linalg.norm(exclusion_center
+                if exclusion_center is None or linalg.norm(exclusion_center
                         - bp) > exclusion_radius:
                     final_boundary_points.append(bp)
             return final_boundary_points
@@ -371,141 +594,34 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
 
             return boundary_points
 
-    # #@clockit
-    def _find_ray_boundaries_woven(self, im, seed_point, zero_referenced_rays,
-                                   cutoff_index, threshold, **kwargs):
-        """ Find where a set off rays crosses a threshold in an image
-
-            Arguments:
-            im -- An image (usually a gradient magnitude image) in which crossing will be found
-            seed_point -- the origin from which rays will be projected
-            zero_referenced_rays -- the set of rays (starting at zero) to sample.  nrays x ray_sampling x image_dimension
-            cutoff_index -- the index along zero_referenced_rays below which we are sure that we are
-                                    still within the feature.  Used to normalize threshold.
-            threshold -- the threshold to cross, expressed in standard deviations across the ray samples
+    def _find_ray_boundaries_native(self, im, seed_point,
+                                    zero_referenced_rays, cutoff_index,
+                                    threshold, **kwargs):
+        """ _find_ray_boundaries, using the backend's compiled ray search if
+            it has one (only bilinear ray sampling is compiled)
         """
 
-        assert False
-
-        if 'exclusion_center' in kwargs:
-            exclusion_center = kwargs['exclusion_center']
-        else:
-            exclusion_center = None
-
-        if 'exclusion_radius' in kwargs:
-            exclusion_radius = kwargs['exclusion_radius']
-        else:
-            exclusion_radius = None
-
-        # create appropriately-centered rays
-        rays_x = zero_referenced_rays[:, :, self.x_axis] \
-            + seed_point[self.x_axis]
-        rays_y = zero_referenced_rays[:, :, self.y_axis] \
-            + seed_point[self.y_axis]
-
-        # get the values from the image at each of the points
-        vals = self._get_image_values(im, rays_x, rays_y)
-
-        # We will return up to n_rays return indices
-        returned_points = -1 * ones([zero_referenced_rays.shape[0], 2])
-        # n_returned_points = 0
+        boundary_points = None
+        if self.ray_sampling_method == 'interp':
+            boundary_points = self.backend.find_ray_boundaries(im,
+                    seed_point, zero_referenced_rays, cutoff_index,
+                    threshold, kwargs.get('exclusion_center', None),
+                    kwargs.get('exclusion_radius', None))
+
+        if boundary_points is None:
+            return self._find_ray_boundaries(im, seed_point,
+                    zero_referenced_rays, cutoff_index, threshold, **kwargs)
+        return boundary_points
 
-        vals_slope = hstack((2 * ones([vals.shape[0], 1]), diff(vals, 1)))
-        vals_slope[where(isnan(vals_slope))] = 0
-        if not vals_slope.flags['C_CONTIGUOUS']:
-            vals_slope = vals_slope.copy()
-
-        code = \
-            """
-
-            // Get some array sizes
-
-            int n_rays = Nrays_x[0];
-            int n_ray_samples = Nrays_x[1];
-
-
-            // Compute normalization factors
-            int n_vals = 0;
-            double mean_val = 0;
-            double var_val = 0;
-            double old_mean = 0;
-            double old_var = 0;
-
-
-            // See Knuth TAOCP vol 2, 3rd edition, page 232
-            // via http://www.johndcook.com/standard_deviation.html
-            for(int r=0; r < n_rays; r++){
-                for(int s=0; s < cutoff_index; s++){
-                    int index = r*n_ray_samples + s;
-                    double val = vals[index];
-                    if(val != NAN){
-                        n_vals++;
-                        if(n_vals == 1){
-                            old_mean = mean_val = val;
-                            old_var = 0.0;
-                        } else {
-                            mean_val = old_mean + (val - old_mean)/n_vals;
-                            var_val = old_var + (val - old_mean) * (val - mean_val);
-
-                            old_mean = mean_val;
-                            old_var = var_val;
-                        }
-                    }
-                }
-            }
-
-            double std_val = sqrt(var_val/(n_vals-1));
-
-            double normalized_threshold = std_val * threshold + mean_val;
-
-            for(int r=0; r < n_rays; r++){
-                short crossed = 0;
-                for(int s=cutoff_index; s < n_ray_samples; s++){
-                    int index = r*n_ray_samples + s;
-                    double val = vals[index];
-
-                    if(val == NAN){
-                        break; // end of ray
-                    }
-
-                    if(val > normalized_threshold){
-                        crossed = 1;
-
-                    }
-
-                    if(crossed && vals_slope[index] <= 0){
-
-                        returned_points[n_returned_points*2 + 0] = rays_x[r*n_ray_samples + s-1];
-                        returned_points[n_returned_points*2 + 1] = rays_y[r*n_ray_samples + s-1];
-                        n_returned_points++;
-                        break;
-                    }
-                }
-            }
+    def _ray_sampler(self, rays):
+        """ The RaySampler for a ray pattern: the finder's own, for its own
+            patterns, or else a new one
         """
 
-        # inline(code_test, [n_returned_points])
-
-        inline(code, [
-            'vals',
-            'vals_slope',
-            'rays_x',
-            'rays_y',
-            'cutoff_index',
-            'threshold',
-            'n_returned_points',
-            'returned_points',
-            ])
-        boundary_points = []
-
-        for p in range(0, returned_points.shape[0]):
-            if returned_points[p, 0] != -1.:
-                bp = returned_points[p, :]
-                if exclusion_center == None or linalg.norm(exclusion_center
-                        - bp) > exclusion_radius:
-                    boundary_points.append(bp)
-
-        return boundary_points
+        for sampler in (self.cr_sampler, self.pupil_sampler):
+            if sampler is not None and sampler.rays is rays:
+                return sampler
+        return RaySampler(rays, self.workspace)
 
     def _get_image_values_nearest(self, im, x_, y_):
         """ Sample an image at a set of x and y coordinates, using nearest neighbor interpolation.
@@ -564,12 +680,13 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
         """
 
         # trim out-of-bounds elements
-        bad_elements = where((x < 0) | (x >= im.shape[0] - 1) | (y < 0) | (y
-                             >= im.shape[1] - 1))
+        bad_elements = (x < 0) | (x >= im.shape[0] - 1) | (y < 0) | (y
+                >= im.shape[1] - 1)
 
         # for now, put in zeros so that the computation doesn't fail
-        x[bad_elements] = 0
-        y[bad_elements] = 0
+        # (leaving the caller's coordinates alone)
+        x = where(bad_elements, 0, x)
+        y = where(bad_elements, 0, y)
 
         vals = zeros(x.shape)
         floor_x = floor(x).astype(int)
@@ -596,7 +713,7 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
         """ Fit the center and radius of a set of points using the mean and std of the point cloud
         """
 
-        if points == None or len(points) == 0:
+        if points is None or len(points) == 0:
             return (array([-1., -1.]), 0.0, Inf)
 
         center = mean(points, 0)
@@ -609,12 +726,27 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
 
         return (center, radius, 0.0)
 
-    # ##@clockit
     def _fit_circle_to_points_lstsq(self, points):
+        """ Fit a circle algebraicly to a set of points, by linear least squares
+        """
+
+        return self.fitter.fit_circle(points)
+
+    def _fit_ellipse_to_points(self, points):
+        """ Fit an (axis-aligned) ellipse to a set of points, by linear least
+            squares, falling back to a circle if they don't fit an ellipse
+        """
+
+        return self.fitter.fit_ellipse(points)
+
+    # The original fits, for reference: _fit_circle_to_points_lstsq iterated
+    # to its fit with scipy.optimize.leastsq, and _fit_ellipse_to_points
+    # inverted the normal equations.  See test_fits
+    def _fit_circle_to_points_lstsq_iterative(self, points):
         """ Fit a circle algebraicly to a set of points, using least squares optimization
         """
 
-        if points == None or len(points) == 0:
+        if points is None or len(points) == 0:
             # print "_fit_circle_to_points_lstsq: no boundary points, bailing: ", points
             return (array([-1., -1.]), 0.0, Inf)
 
@@ -648,10 +780,9 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
         # print(err)
         return (center_fit, radius_fit, err)
 
-    # ##@clockit
-    def _fit_ellipse_to_points(self, points):
+    def _fit_ellipse_to_points_inverse(self, points):
 
-        if points == None or len(points) == 0:
+        if points is None or len(points) == 0:
             # print "_fit_ellipse_to_points_lstsq: no boundary points, bailing"
             return (array([-1., -1.]), 0.0, Inf)
 
@@ -752,15 +883,24 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
         elif test == 0:
 
             #print 'Error in ellipse fitting: parabola found instead of ellipse'
-            return self._fit_circle_to_points_lstsq(points)
+            return self._fit_circle_to_points_lstsq_iterative(points)
             #return (array([-1., -1.]), 0.0, Inf)
         elif test < 0:
             #print 'Error in ellipse fitting: hyperbola found instead of ellipse'
-            return self._fit_circle_to_points_lstsq(points)
+            return self._fit_circle_to_points_lstsq_iterative(points)
             #return (array([-1., -1.]), 0.0, Inf)
 
-    # ##@clockit
     def _fit_circle_to_points_lstsq_ransac(self, points):
+        """ Fit a circle to a set of points robustly, by RANSAC, with all of
+            the random samples fitted and scored at once
+        """
+
+        return self.fitter.fit_circle_ransac(points, self.ransac_iterations,
+                self.ransac_sample_size, self.ransac_inlier_threshold)
+
+    # The original RANSAC loop, for reference.  See test_fits
+    # ##@clockit
+    def _fit_circle_to_points_lstsq_ransac_loop(self, points):
         max_iter = 20
         min_consensus = 8
         good_fit_consensus = round(len(points) / 2)
@@ -820,9 +960,324 @@ class SubpixelStarburstEyeFeatureFinder(EyeFeatureFinder):
         return err
 
 
+def test_ray_boundaries():
+    """ Check _find_ray_boundaries against the original ray-by-ray loop, and
+        the compiled ray searches of the backends that load against both,
+        and the ray sampling tables against sampling the rays directly;
+        time them all
+    """
+
+    import os
+    import time
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    trials = 200
+
+    ff = SubpixelStarburstEyeFeatureFinder(backend='vanilla')
+
+    native = []
+    for backend_name in ['woven', 'numba']:
+        try:
+            backend = make_backend(backend_name, fallback=None)
+        except Exception, e:
+            print 'Skipping %s backend: %s' % (backend_name, e)
+            continue
+        native.append((backend_name.capitalize(), backend))
+
+    # a dark disc with a bright spot off-center, plus the bundled snapshots
+    # (the disc is given some texture: on flat regions, the thresholds
+    # would hang on rounding error)
+    (yy, xx) = mgrid[0:120, 0:160]
+    synthetic = 200. - 150. * (hypot(yy - 60., xx - 80.) < 20.)
+    synthetic[hypot(yy - 55., xx - 86.) < 4.] = 255.
+    synthetic += random.RandomState(0).normal(0., 2., synthetic.shape)
+    images = [('synthetic', synthetic.astype(float32))]
+    for name in ['Snapshot_test.bmp', 'Snapshot.bmp', 'Snapshot2.bmp']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        images.append((name, im.astype(float32)))
+
+    for (name, im) in images:
+        (mag, x, y) = ff.backend.sobel3x3(im)
+        center = array(im.shape, dtype=float) / 2.
+
+        cases = []
+        for offset in [(0., 0.), (5.5, -3.25), (-12., 7.)]:
+            seed = center + array(offset)
+            cases.append((seed, ff.cr_rays, ff.cr_min_radius_ray_index,
+                          ff.cr_threshold, {}))
+            cases.append((seed, ff.pupil_rays, ff.pupil_min_radius_ray_index,
+                          ff.pupil_threshold,
+                          {'exclusion_center': seed + 3.,
+                           'exclusion_radius': 6.}))
+            cases.append((seed, ff.pupil_rays, 0, ff.pupil_threshold, {}))
+
+        # a seed just off the image, from which rays come onto it already
+        # above threshold, so that some boundaries are off the image too
+        cases.append((array([-3., 40.]), ff.pupil_rays,
+                     ff.pupil_min_radius_ray_index, ff.pupil_threshold, {}))
+
+        searches = [('Vectorized', ff._find_ray_boundaries)]
+        for (label, backend) in native:
+            def search(im, seed, rays, cutoff, threshold, backend=backend,
+                       **kwargs):
+                return backend.find_ray_boundaries(im, seed, rays, cutoff,
+                        threshold, kwargs.get('exclusion_center', None),
+                        kwargs.get('exclusion_radius', None))
+            searches.append((label, search))
+
+        print name, im.shape
+
+        # seeds near and past the edges of the image too
+        seeds = [seed for (seed, rays, cutoff, threshold, kwargs) in cases]
+        seeds += [array([1.5, 2.25]), array(im.shape) - (0.5, 3.75),
+                  array([-4., 10.])]
+        max_difference = 0.
+        for seed in seeds:
+            for rays in (ff.cr_rays, ff.pupil_rays):
+                reference = ff._get_image_values_interp_faster(mag, rays[:, :
+                        , 0] + seed[0], rays[:, :, 1] + seed[1])
+                vals = ff._ray_sampler(rays).sample(mag, seed)
+                assert array_equal(isnan(vals), isnan(reference)), seed
+                valid = ~isnan(vals)
+                if valid.any():
+                    max_difference = maximum(max_difference, abs(vals[valid]
+                            - reference[valid]).max())
+        print '\tRay sampling max abs difference: %s' % max_difference
+
+        (seed, rays) = (cases[1][0], cases[1][1])
+        samplings = [('Sampling (direct)', lambda :
+                     ff._get_image_values_interp_faster(mag, rays[:, :, 0]
+                     + seed[0], rays[:, :, 1] + seed[1])),
+                     ('Sampling (tables)', lambda :
+                     ff._ray_sampler(rays).sample(mag, seed))]
+        for (label, f) in samplings:
+            tic = time.time()
+            for i in range(0, trials):
+                f()
+            print '\t%s: %f ms per call' % (label, 1000. * (time.time() - tic)
+                                             / trials)
+
+        off_image = 0
+        for (label, f) in searches:
+            max_difference = 0.
+            for (seed, rays, cutoff, threshold, kwargs) in cases:
+                reference = array(ff._find_ray_boundaries_loop(mag, seed,
+                                  rays, cutoff, threshold,
+                                  **kwargs)).reshape(-1, 2)
+                result = f(mag, seed, rays, cutoff, threshold, **kwargs)
+                assert result.shape == reference.shape, \
+                    (label, name, result.shape, reference.shape)
+                off_image += sum((reference < 0) | (reference
+                                 >= array(mag.shape) - 1))
+                if len(result) > 0:
+                    max_difference = maximum(max_difference,
+                                             abs(result - reference).max())
+                assert allclose(result, reference), (label, name, seed)
+            print '\t%s max abs difference: %s' % (label, max_difference)
+        assert off_image > 0, name
+
+        (seed, rays, cutoff, threshold, kwargs) = cases[1]
+        for (label, f) in [('Loop', ff._find_ray_boundaries_loop)] \
+            + searches:
+            tic = time.time()
+            for i in range(0, trials):
+                f(mag, seed, rays, cutoff, threshold, **kwargs)
+            print '\t%s: %f ms per call' % (label, 1000. * (time.time() - tic)
+                                             / trials)
+
+
+def test_roi_sobel():
+    """ Check that tracking with the gradient computed only around the seeds
+        finds the same features as with the gradient of the whole frame,
+        with seeds in the middle and near the edges of the bundled
+        snapshots; time both
+    """
+
+    import os
+    import time
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    trials = 50
+
+    for name in ['Snapshot.bmp', 'RatEye_snap12_zoom.jpg',
+                 'RatEye_snap6.tiff']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+        (rows, cols) = im.shape
+
+        finders = [('Whole frame', SubpixelStarburstEyeFeatureFinder(
+                   backend='vanilla', roi_sobel=False)), ('ROI',
+                   SubpixelStarburstEyeFeatureFinder(backend='vanilla'))]
+
+        guesses = []
+        for (pupil, cr) in [((0.5, 0.5), (0.47, 0.53)), ((0.1, 0.05), (0.1,
+                            0.08)), ((0.97, 0.9), (0.9, 0.97))]:
+            guesses.append({'pupil_position': array([pupil[0] * rows,
+                           pupil[1] * cols]) + 0.3, 'cr_position':
+                           array([cr[0] * rows, cr[1] * cols]) - 0.6})
+
+        print name, im.shape
+        max_difference = 0.
+        for guess in guesses:
+            results = []
+            for (label, ff) in finders:
+                ff.analyze_image(im, guess)
+                results.append(ff.get_result())
+            for key in ['cr_position', 'pupil_position', 'cr_radius',
+                        'pupil_radius']:
+                (a, b) = (asarray(results[0][key]), asarray(results[1][key]))
+                assert array_equal(isfinite(a), isfinite(b)), (key, a, b)
+                if isfinite(a).any():
+                    max_difference = maximum(max_difference, abs(a[isfinite(a)]
+                            - b[isfinite(b)]).max())
+        print '\tmax abs difference: %s' % max_difference
+
+        for (label, ff) in finders:
+            tic = time.time()
+            for i in range(0, trials):
+                ff.analyze_image(im, guesses[0])
+            print '\t%s: %f ms per frame' % (label, 1000. * (time.time()
+                    - tic) / trials)
+
+
+def test_fits():
+    """ Check the closed-form circle and ellipse fits against the original
+        iterative and matrix-inverting ones, and the batched fits against
+        the single ones, on noisy (partial) circles and ellipses, and the
+        batched RANSAC against the original loop on circles with outliers;
+        time them all
+    """
+
+    import time
+
+    ff = SubpixelStarburstEyeFeatureFinder(backend='vanilla')
+    fitter = ff.fitter
+    rng = random.RandomState(0)
+
+    point_sets = []
+    for i in range(0, 200):
+        n = rng.choice([0, 3, 4, 5, 8, 20, 40])
+        t = rng.uniform(0., rng.choice([pi, 2 * pi]), n)
+        axes = rng.uniform(5., 30., 2)
+        if i % 2:
+            axes[1] = axes[0]
+        phi = rng.uniform(0., pi)
+        (x, y) = (axes[0] * cos(t), axes[1] * sin(t))
+        points = array([x * cos(phi) - y * sin(phi), x * sin(phi) + y
+                       * cos(phi)]).T + rng.uniform(50., 150., 2)
+        points += rng.normal(0., 0.3, points.shape)
+        point_sets.append(points)
+
+    def relative_difference(a, b):
+        (a, b) = (asarray(a, dtype=float), asarray(b, dtype=float))
+        if not (isfinite(a).all() and isfinite(b).all()):
+            assert array_equal(isfinite(a), isfinite(b)), (a, b)
+            return 0.
+        return (abs(a - b) / maximum(1., abs(a))).max()
+
+    comparisons = [('Circle', ff._fit_circle_to_points_lstsq_iterative,
+                    fitter.fit_circle),
+                   ('Ellipse', ff._fit_ellipse_to_points_inverse,
+                    fitter.fit_ellipse)]
+    for (label, original, fit) in comparisons:
+        worst = zeros(3)
+        for points in point_sets:
+            (a, b) = (original(points), fit(points))
+            for i in range(0, 3):
+                worst[i] = maximum(worst[i], relative_difference(a[i], b[i]))
+        print '%s max relative difference (center, radius, err): %s' \
+            % (label, worst)
+
+    batches = [('fit_circle', fitter.fit_circles),
+               ('fit_circle_taubin', fitter.fit_circles_taubin),
+               ('fit_ellipse', fitter.fit_ellipses),
+               ('fit_ellipse_direct', fitter.fit_ellipses_direct)]
+    for (name, batch) in batches:
+        (centers, radii, errs) = batch(point_sets)
+        worst = 0.
+        for (k, points) in enumerate(point_sets):
+            (center, radius, err) = getattr(fitter, name)(points)
+            worst = maximum(worst, relative_difference(centers[k], center))
+            worst = maximum(worst, relative_difference(radii[k], radius))
+            worst = maximum(worst, relative_difference(errs[k], err))
+        print 'Batched %s max relative difference: %s' % (name, worst)
+
+    full = [p for p in point_sets if len(p) == 40]
+    stack = array(full)
+    timings = [('Circle (scipy.optimize.leastsq)',
+               ff._fit_circle_to_points_lstsq_iterative),
+               ('Circle (closed form)', fitter.fit_circle),
+               ('Circle (Taubin)', fitter.fit_circle_taubin),
+               ('Ellipse (inverse)', ff._fit_ellipse_to_points_inverse),
+               ('Ellipse (closed form)', fitter.fit_ellipse),
+               ('Ellipse (direct)', fitter.fit_ellipse_direct)]
+    print 'Per fit, %d points:' % stack.shape[1]
+    for (label, fit) in timings:
+        tic = time.time()
+        for points in full * 10:
+            fit(points)
+        print '\t%s: %f ms' % (label, 1000. * (time.time() - tic)
+                               / (10 * len(full)))
+    for (name, batch) in batches:
+        tic = time.time()
+        for i in range(0, 10):
+            batch(stack)
+        print '\tBatched %s (%d at once): %f ms' % (name, len(full), 1000.
+                * (time.time() - tic) / (10 * len(full)))
+
+    # circles with a quarter of their points thrown off them, as by
+    # eyelashes or a CR on the pupil's edge
+    circles = []
+    for i in range(0, 50):
+        t = rng.uniform(0., 2 * pi, 40)
+        center = rng.uniform(50., 150., 2)
+        radius = rng.uniform(5., 30.)
+        points = center + radius * array([cos(t), sin(t)]).T
+        points += rng.normal(0., 0.1, points.shape)
+        points[0:10] += rng.uniform(-0.5, 0.5, (10, 2)) * radius
+        circles.append((center, radius, points))
+
+    seeded = ShapeFitter(seed=0)
+    reseeded = ShapeFitter(seed=0)
+    ransacs = [('RANSAC (loop)', ff._fit_circle_to_points_lstsq_ransac_loop),
+               ('RANSAC (batched)', ff._fit_circle_to_points_lstsq_ransac)]
+    for (label, fit) in [('Circle (closed form)', fitter.fit_circle)] \
+        + ransacs:
+        worst = zeros(2)
+        for (center, radius, points) in circles:
+            (c, r, e) = fit(points)
+            worst = maximum(worst, [abs(c - center).max() / radius, abs(r
+                            - radius) / radius])
+        print '%s with outliers, max relative error (center, radius): %s' \
+            % (label, worst)
+    for (center, radius, points) in circles:
+        (a, b) = (seeded.fit_circle_ransac(points),
+                  reseeded.fit_circle_ransac(points))
+        assert array_equal(a[0], b[0]) and a[1:] == b[1:], (a, b)
+    print 'Seeded RANSAC repeatable'
+
+    print 'Per fit, %d points with outliers:' % len(circles[0][2])
+    for (label, fit) in ransacs:
+        tic = time.time()
+        for (center, radius, points) in circles:
+            fit(points)
+        print '\t%s: %f ms' % (label, 1000. * (time.time() - tic)
+                               / len(circles))
+
+
 # A test script to see stuff in action
 if __name__ == '__main__':
 
+    test_ray_boundaries()
+    test_roi_sobel()
+    test_fits()
+
     import PIL.Image
     from numpy import *
     from scipy import *
@@ -0,0 +1,140 @@
+#
+#  TilePool.py
+#  EyeTracker
+#
+#  Persistent worker threads for running compiled code (which releases the
+#  GIL) over tiles of an image in parallel.
+#
+
+import sys
+import atexit
+import weakref
+import threading
+import multiprocessing
+import Queue
+
+# threads per pool when none is given (None or 0: one per core); see
+# set_default_threads
+default_n_threads = None
+
+
+def set_default_threads(n_threads):
+    """ Set the number of threads of the pools created from now on (e.g.
+        from the image_processing_threads config setting); None or 0 uses
+        every core
+    """
+
+    global default_n_threads
+    default_n_threads = n_threads
+
+
+# the pools still open, to be closed before the interpreter shuts down
+# (under Python 2, threads still waiting then raise spurious errors)
+_open_pools = weakref.WeakSet()
+
+
+@atexit.register
+def _close_pools():
+    for pool in list(_open_pools):
+        pool.close()
+
+
+def _worker_loop(tasks):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        _run_task(task)
+
+
+def _run_task(task):
+    (function, item, done, errors) = task
+    try:
+        function(item)
+    except Exception:
+        errors.append(sys.exc_info())
+    done.release()
+
+
+class TilePool(object):
+    """ A fixed set of threads, started once and kept waiting for work, that
+        map() spreads the tiles of an operation over.  The calling thread
+        works on tiles too, so n_threads - 1 threads are started.
+
+        The work only runs in parallel if it releases the GIL (as the weave
+        code of WovenBackend does, in Py_BEGIN_ALLOW_THREADS).
+    """
+
+    def __init__(self, n_threads=None):
+        if n_threads is None:
+            n_threads = default_n_threads
+        if not n_threads:
+            n_threads = multiprocessing.cpu_count()
+        self.n_threads = max(1, int(n_threads))
+
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for t in range(0, self.n_threads - 1):
+            thread = threading.Thread(target=_worker_loop, args=(self.tasks,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        _open_pools.add(self)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.threads = []
+
+    def map(self, function, items):
+        """ Call function(item) for every item, on the pool's threads and on
+            the calling one, and return once all of them are done.  An
+            exception raised by any of the calls is raised again here.
+        """
+
+        items = list(items)
+        if len(self.threads) == 0 or len(items) < 2:
+            for item in items:
+                function(item)
+            return
+
+        done = threading.Semaphore(0)
+        errors = []
+        for item in items[1:]:
+            self.tasks.put((function, item, done, errors))
+        _run_task((function, items[0], done, errors))
+
+        # help with whatever is still queued before waiting on the rest
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except Queue.Empty:
+                break
+            if task is None:
+                self.tasks.put(None)
+                break
+            _run_task(task)
+
+        for item in items:
+            done.acquire()
+
+        if len(errors) > 0:
+            (exc_type, exc_value, exc_traceback) = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def row_tiles(self, rows, cols=1, min_tile_pixels=16384):
+        """ Split rows (of cols pixels each) into at most one tile per
+            thread, as a list of (start, end) row ranges; tiles are kept to
+            at least min_tile_pixels, so small images stay in one piece
+        """
+
+        n_tiles = min(self.n_threads, max(1, rows * cols // min_tile_pixels),
+                      max(1, rows))
+        bounds = [rows * t // n_tiles for t in range(0, n_tiles + 1)]
+        return [(bounds[t], bounds[t + 1]) for t in range(0, n_tiles)]
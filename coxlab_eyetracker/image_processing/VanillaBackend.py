@@ -1,12 +1,82 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from ImageProcessingBackend import *
+import scipy.signal
 from scipy.signal import sepfir2d, convolve2d
 from stopwatch import *
+import time
+import logging
+
+# scipy.fft (scipy >= 1.4) transforms single precision images without first
+# converting them to double precision; numpy.fft is used otherwise
+try:
+    import scipy.fft as fft_module
+except ImportError:
+    fft_module = fft
 
 
 class VanillaBackend(ImageProcessingBackend):
 
+    def __init__(self):
+        ImageProcessingBackend.__init__(self)
+
+        # how fast_radial_transform smooths the symmetry measure of each
+        # radius: 'sepfir' (a separable convolution per radius), 'fft'
+        # (see smooth_radial_fft), or 'auto' for whichever autotune found
+        # faster for the radii it was given, on images of that shape (or
+        # else on the last it was tuned on; sepfir until then)
+        self.smoothing = 'auto'
+        self.smoothing_method = 'sepfir'
+        self.smoothing_methods = {}
+
+        # the spectra of the Gaussians, by (shape, radii, dtype)
+        self.fft_kernels = {}
+
+    def autotune(self, example_im, **kwargs):
+        ImageProcessingBackend.autotune(self, example_im)
+        self.choose_smoothing(example_im, kwargs.get('radii', None))
+
+    def choose_smoothing(self, example_im, radii, alpha=10., trials=3):
+        """ Time fast_radial_transform over example_im with each way of
+            smoothing, and keep fft for 'auto' smoothing if it is clearly
+            (10%) the faster for radii
+        """
+
+        if radii is None or self.smoothing != 'auto':
+            return
+
+        timings = []
+        for method in ['sepfir', 'fft']:
+            self.fast_radial_transform(example_im, radii, alpha,
+                    smoothing=method)
+            best = inf
+            for i in range(0, trials):
+                tic = time.time()
+                self.fast_radial_transform(example_im, radii, alpha,
+                        smoothing=method)
+                best = minimum(best, time.time() - tic)
+            timings.append((best, method))
+
+        self.smoothing_method = 'sepfir'
+        if timings[1][0] < 0.9 * timings[0][0]:
+            self.smoothing_method = 'fft'
+        self.smoothing_methods[example_im.shape] = self.smoothing_method
+        logging.debug('Smoothing by %s (%s)' % (self.smoothing_method,
+                      ', '.join(['%s: %f ms' % (m, 1000. * t) for (t, m) in
+                      timings])))
+
+    def variants(self, operation):
+        if operation == 'fast_radial_transform':
+            return [{'smoothing': 'sepfir'}, {'smoothing': 'fft'}]
+        return ImageProcessingBackend.variants(self, operation)
+
+    def _smoothing_method(self, image, **kwargs):
+        method = kwargs.get('smoothing', self.smoothing)
+        if method == 'auto':
+            method = self.smoothing_methods.get(image.shape,
+                    self.smoothing_method)
+        return method
+
     def sobel3x3(self, im, **kwargs):
         if 'naive' in kwargs:
             return sobel3x3_naive(im)
@@ -36,35 +106,156 @@ class VanillaBackend(ImageProcessingBackend):
 
     # @clockit
     def separable_convolution2d(self, im, row, col, **kwargs):
-        print im.shape
-        print row.shape
-        print col.shape
-        return sepfir2d(array(im), row, col)
+        # sepfir2d convolves, whereas the compiled backends correlate; flip
+        # the kernels so that antisymmetric (e.g. Sobel) kernels give the same
+        # sign in every backend
+        im = array(im)
+        return sepfir2d(im, asarray(row)[::-1].astype(im.dtype),
+                        asarray(col)[::-1].astype(im.dtype))
 
     # borrowed with some translation from Peter Kovesi's fastradial.m
     def fast_radial_transform(self, image, radii, alpha, **kwargs):
+        if 'naive' in kwargs:
+            return self.fast_radial_transform_naive(image, radii, alpha,
+                                                    **kwargs)
+
+        (rows, cols) = image.shape
+        n_radii = len(radii)
+
+        (mag, imgx, imgy) = self.sobel3x3_cached(image, **kwargs)
+
+        # Normalise gradient values so that [imgx imgy] form unit
+        # direction vectors.
+        imgx = imgx / mag
+        imgy = imgy / mag
+
+        (y, x) = mgrid[0:rows, 0:cols]
+
+        # Stack the radii along a leading axis so that the coordinates of
+        # the 'positively' and 'negatively' affected pixels for every radius
+        # are computed in one go: n_radii x rows x cols
+        n = asarray(radii).astype(imgx.dtype).reshape(n_radii, 1, 1)
+
+        posx = clip(around(x + n * imgx), 0, cols - 1).astype(intp)
+        posy = clip(around(y + n * imgy), 0, rows - 1).astype(intp)
+        negx = clip(around(x - n * imgx), 0, cols - 1).astype(intp)
+        negy = clip(around(y - n * imgy), 0, rows - 1).astype(intp)
+
+        # Flatten into a single index space in which each radius owns its own
+        # rows x cols plane, so that all of the O/M votes can be accumulated
+        # with one bincount per image instead of a loop over pixels
+        plane_offsets = (arange(n_radii) * rows * cols).reshape(n_radii, 1, 1)
+        pos_index = (plane_offsets + posy * cols + posx).ravel()
+        neg_index = (plane_offsets + negy * cols + negx).ravel()
+        n_bins = n_radii * rows * cols
+
+        O = bincount(pos_index, minlength=n_bins) - bincount(neg_index,
+                minlength=n_bins)
+
+        votes = tile(mag.ravel(), n_radii)
+        M = bincount(pos_index, votes, minlength=n_bins) \
+            - bincount(neg_index, votes, minlength=n_bins)
+
+        O.shape = (n_radii, rows, cols)
+        M.shape = (n_radii, rows, cols)
+
+        # Clamp Orientation projection matrix values to a maximum of
+        # +/-kappa,  but first set the normalization parameter kappa to the
+        # values suggested by Loy and Zelinski
+        kappa = where(asarray(radii) == 1, 8., 9.9).reshape(n_radii, 1, 1)
+        O = clip(O, -kappa, kappa)
 
+        # Unsmoothed symmetry measure at each radius value
+        F = (M / kappa * (abs(O) / kappa) ** alpha).astype(image.dtype)
+
+        if self._smoothing_method(image, **kwargs) == 'fft':
+            S = self.smooth_radial_fft(F, radii)
+            S /= n_radii  # Average
+            return S
+
+        S = zeros_like(image)
+
+        for r in range(0, n_radii):
+            n = radii[r]
+
+            gauss1d = self._gaussian_kernel(n)
+
+            S += self.separable_convolution2d(F[r], gauss1d, gauss1d)
+
+        S = S / n_radii  # Average
+
+        return S
+
+    def smooth_radial_fft(self, F, radii, out=None):
+        """ The sum over radii of each plane F[r] of an n_radii x rows x cols
+            stack convolved with the Gaussian of radii[r], as the sepfir
+            smoothing computes it (edges included), in the frequency
+            domain: the stack is forward-transformed in one go, multiplied
+            by the cached spectra of the Gaussians and summed, and the sum
+            transformed back once
+        """
+
+        (n_radii, rows, cols) = F.shape
+        (spectra, half, fft_shape) = self._fft_kernels((rows, cols), radii,
+                F.dtype)
+
+        padded = pad(F, ((0, 0), (half, half), (half, half)),
+                     _sepfir_padding())
+        transformed = fft_module.rfft2(padded, fft_shape)
+        transformed *= spectra
+        spectrum = transformed.sum(axis=0)
+        S = fft_module.irfft2(spectrum, fft_shape)[half:half + rows, half:half
+                                            + cols]
+
+        if out is None:
+            return S.astype(F.dtype)
+        out[...] = S
+        return out
+
+    def _fft_kernels(self, shape, radii, dtype):
+        # the spectra of the 2D Gaussians for radii (centred on the origin),
+        # for padding the images by half on every side and transforming
+        # them at fft_shape
+        key = (shape, tuple(radii), dtype.str)
+        if key in self.fft_kernels:
+            return self.fft_kernels[key]
+
+        gaussians = [self._gaussian_kernel(n).astype(dtype) for n in radii]
+        half = max([len(g) // 2 for g in gaussians])
+        fft_shape = tuple([_fft_size(n + 2 * half) for n in shape])
+
+        spectra = empty((len(radii), fft_shape[0], fft_shape[1] // 2 + 1),
+                        dtype=result_type(dtype, complex64))
+        kernel = zeros(fft_shape)
+        for (r, g) in enumerate(gaussians):
+            h = len(g) // 2
+            kernel[...] = 0.
+            kernel[0:len(g), 0:len(g)] = outer(g, g)
+            spectra[r] = fft.rfft2(roll(roll(kernel, -h, 0), -h, 1))
+
+        if len(self.fft_kernels) >= 4:
+            self.fft_kernels.clear()
+        self.fft_kernels[key] = (spectra, half, fft_shape)
+        return self.fft_kernels[key]
+
+    # Generate a Gaussian of size proportional to n to smooth and spread the
+    # symmetry measure of radius n
+    def _gaussian_kernel(self, n):
         gaussian_kernel_cheat = 1.
+        width = round(gaussian_kernel_cheat * n)
+        if mod(width, 2) == 0:
+            width += 1
+        return scipy.signal.gaussian(width, 0.25 * n)
 
-        (rows, cols) = image.shape
+    # The original pixel-by-pixel transform; kept as a reference for the
+    # vectorized version above
+    def fast_radial_transform_naive(self, image, radii, alpha, **kwargs):
 
-        use_cached_sobel = False
-        cached_mag = None
-        cached_x = None
-        cached_y = None
-        if 'cached_sobel' in kwargs:
-            (cached_mag, cached_x, cached_y) = kwargs['cached_sobel']
-            (sobel_rows, sobel_cols) = cached_sobel_mag.shape
+        gaussian_kernel_cheat = 1.
 
-            if sobel_rows == rows or sobel_cols == cols:
-                use_cached_sobel = True
+        (rows, cols) = image.shape
 
-        if use_cached_sobel:
-            mag = cached_mag
-            imgx = cached_x
-            imgy = cached_y
-        else:
-            (mag, imgx, imgy) = self.sobel3x3(image)
+        (mag, imgx, imgy) = self.sobel3x3_cached(image, **kwargs)
 
         # Normalise gradient values so that [imgx imgy] form unit
         # direction vectors.
@@ -115,6 +306,11 @@ class VanillaBackend(ImageProcessingBackend):
             negy[where(negy < 0)] = 0
             negy[where(negy > rows - 1)] = rows - 1
 
+            posx = posx.astype(int)
+            posy = posy.astype(int)
+            negx = negx.astype(int)
+            negy = negy.astype(int)
+
             for r in range(0, rows):
                 for c in range(0, cols):
                     O[posy[r, c], posx[r, c]] += 1
@@ -150,7 +346,7 @@ class VanillaBackend(ImageProcessingBackend):
     def find_minmax(self, image, **kwargs):
 
         # print "here (vanilla)"
-        if image == None:
+        if image is None:
             return ([0, 0], [0])
 
         min_coord = nonzero(image == min(image.ravel()))
@@ -162,3 +358,149 @@ class VanillaBackend(ImageProcessingBackend):
         # print max_coord
         return ([min_coord[0][0], min_coord[1][0]], [max_coord[0][0],
                 max_coord[1][0]])
+
+    def find_peaks(self, image, n_peaks=1, separation=1., region=None,
+                   subpixel=True, **kwargs):
+
+        if image is None:
+            return (None, None)
+
+        (rows, cols) = image.shape
+        if region is None:
+            region = (0, rows, 0, cols)
+        (top, bottom, left, right) = region
+        window = image[top:bottom, left:right]
+        (h, w) = window.shape
+
+        found = []
+        for sign in (-1., 1.):
+            values = sign * window.astype(float64)
+
+            # the local extrema: at least as strong as each neighbour within
+            # the region
+            padded = empty((h + 2, w + 2))
+            padded.fill(-inf)
+            padded[1:h + 1, 1:w + 1] = values
+            is_peak = ones((h, w), dtype=bool)
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    if dr != 0 or dc != 0:
+                        is_peak &= values >= padded[1 + dr:h + 1 + dr, 1
+                                + dc:w + 1 + dc]
+
+            (peak_rows, peak_cols) = nonzero(is_peak)
+            peaks = strongest_peaks(zip(peak_rows, peak_cols,
+                                    values[peak_rows, peak_cols]), n_peaks,
+                                    separation)
+
+            coords = array([(r + top, c + left) for (r, c, v) in peaks],
+                           dtype=float).reshape(-1, 2)
+            if subpixel:
+                coords = refine_peaks(image, coords, region)
+            found.append(coords)
+
+        return tuple(found)
+
+
+# the numpy.pad mode that extends an image as sepfir2d does past its edges
+_sepfir_mode = None
+
+
+def _sepfir_padding():
+    """ 'symmetric' if sepfir2d mirrors images about their edge pixels
+        (repeating them), or 'reflect' if about the edges themselves, as
+        scipy releases have done either way
+    """
+
+    global _sepfir_mode
+    if _sepfir_mode is None:
+        # (the kernel shifts the row right by one, bringing in the pixel
+        # just past its left edge)
+        edge = sepfir2d(array([[1., 2., 3., 4.]]), array([0., 0., 1.]),
+                        array([1.]))[0, 0]
+        _sepfir_mode = ('symmetric' if edge == 1. else 'reflect')
+    return _sepfir_mode
+
+
+def _fft_size(n):
+    """ The smallest 5-smooth number (of the form 2^a 3^b 5^c) that is at
+        least n, which FFTs handle quickly
+    """
+
+    size = n
+    while True:
+        m = size
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return size
+        size += 1
+
+
+def test_it():
+
+    import os
+    import time
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    im = asarray(PIL.Image.open(os.path.join(here, 'Snapshot.bmp')))
+    if im.ndim == 3:
+        im = mean(im, 2)
+    im = im.astype(float32)
+
+    radii = array([2, 4, 6, 9, 12, 15])
+    alpha = 10.
+    trials = 10
+
+    b = VanillaBackend()
+
+    tic = time.time()
+    S_naive = b.fast_radial_transform(im, radii, alpha, naive=True)
+    print 'Naive: ', time.time() - tic
+
+    S = b.fast_radial_transform(im, radii, alpha)
+    tic = time.time()
+    for i in range(0, trials):
+        S = b.fast_radial_transform(im, radii, alpha)
+    print 'Vectorized: ', (time.time() - tic) / trials
+
+    print 'Max abs difference: ', max(abs(S - S_naive).ravel())
+    print 'Min/max (naive): ', b.find_minmax(S_naive)
+    print 'Min/max (vectorized): ', b.find_minmax(S)
+
+    # smoothing in the frequency domain, for small and large radii
+    for radii in [array([2, 4, 6, 9, 12, 15]), arange(4, 64, 8)]:
+        for method in ['sepfir', 'fft']:
+            S = b.fast_radial_transform(im, radii, alpha, smoothing=method)
+            tic = time.time()
+            for i in range(0, trials):
+                S = b.fast_radial_transform(im, radii, alpha,
+                        smoothing=method)
+            print 'Radii up to %d, %s: ' % (max(radii), method), \
+                (time.time() - tic) / trials
+            if method == 'sepfir':
+                S_sepfir = S
+        difference = max(abs(S - S_sepfir).ravel()) \
+            / max(abs(S_sepfir).ravel())
+        print 'Max abs difference (relative): ', difference
+        assert difference < 1e-5
+
+        # edges included, for a stack that is far from smooth there
+        F = random.RandomState(0).normal(size=(len(radii), ) + im.shape)
+        F = F.astype(float32)
+        smoothed = sum([b.separable_convolution2d(F[r],
+                       b._gaussian_kernel(n), b._gaussian_kernel(n))
+                       for (r, n) in enumerate(radii)], axis=0)
+        difference = abs(b.smooth_radial_fft(F, radii) - smoothed).max() \
+            / abs(smoothed).max()
+        print 'Max abs difference, random stack (relative): ', difference
+        assert difference < 1e-5
+
+        b.autotune(im, radii=radii)
+        print 'Autotuned smoothing: ', b.smoothing_method
+
+
+if __name__ == '__main__':
+    test_it()
@@ -0,0 +1,101 @@
+#
+#  Workspace.py
+#  EyeTracker
+#
+#  A pool of reusable scratch storage for the image processing backends.
+#
+
+import numpy
+from numpy import *
+
+
+class Workspace(object):
+    """ Owns the intermediate buffers used by a backend, handing out the same
+        storage every time the same (name, shape, dtype) is asked for, so that
+        after the first frame no new arrays need to be allocated.
+
+        Call begin_frame() once per frame; bytes_allocated_last_frame then
+        reports how much new storage the previous frame needed (zero in the
+        steady state).  Storage that goes unused for max_idle_frames frames
+        (e.g. because the image shape changed) is released.
+    """
+
+    def __init__(self, max_idle_frames=100):
+
+        self.max_idle_frames = max_idle_frames
+
+        self.buffers = {}
+        self.constants = {}
+        self.last_used = {}
+
+        self.frame_count = 0
+        self.bytes_allocated = 0
+        self.bytes_allocated_this_frame = 0
+        self.bytes_allocated_last_frame = 0
+
+    def begin_frame(self):
+        self.bytes_allocated_last_frame = self.bytes_allocated_this_frame
+        self.bytes_allocated_this_frame = 0
+        self.frame_count += 1
+
+        stale = [key for (key, frame) in self.last_used.items()
+                 if self.frame_count - frame > self.max_idle_frames]
+        for key in stale:
+            (store, k) = key
+            del getattr(self, store)[k]
+            del self.last_used[key]
+
+    def get(self, name, shape, dtype, zero=False):
+        """ Return a buffer with the requested shape and dtype. The contents
+            are left over from the last time it was used, unless zero is set
+        """
+
+        key = (name, tuple(shape), numpy.dtype(dtype).str)
+
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = zeros(shape, dtype=dtype)
+            self._count(buf)
+            self.buffers[key] = buf
+        elif zero:
+            buf.fill(0)
+
+        self.last_used[('buffers', key)] = self.frame_count
+        return buf
+
+    def cached(self, key, builder):
+        """ Return a value computed once by builder() and reused thereafter;
+            for derived constants such as coordinate grids and kernels
+        """
+
+        value = self.constants.get(key)
+        if value is None:
+            value = builder()
+            if isinstance(value, ndarray):
+                self._count(value)
+            else:
+                for v in value:
+                    self._count(asarray(v))
+            self.constants[key] = value
+
+        self.last_used[('constants', key)] = self.frame_count
+        return value
+
+    def mgrid(self, shape):
+        """ Cached (y, x) pixel coordinate grids for an image of this shape
+        """
+
+        return self.cached(('mgrid', tuple(shape)), lambda: mgrid[0:shape[0],
+                           0:shape[1]])
+
+    def nbytes(self):
+        return sum([b.nbytes for b in self.buffers.values()])
+
+    def clear(self):
+        self.buffers.clear()
+        self.constants.clear()
+        self.last_used.clear()
+
+    def _count(self, arr):
+        self.bytes_allocated += arr.nbytes
+        self.bytes_allocated_this_frame += arr.nbytes
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from VanillaBackend import *
+from Workspace import *
+from TilePool import TilePool
 
 import scipy
 from scipy.weave import inline
@@ -8,22 +10,24 @@ from scipy.weave import inline
 
 class WovenBackend(VanillaBackend):
 
-    def __init__(self):
+    def __init__(self, n_threads=None):
         VanillaBackend.__init__(self)
 
         # reusable storage
         self.cached_shape = None
-        self.cached_gauss2d_fft = None
-        self.M = None
-        self.O = None
-        self.F = None
-        self.S = None
-        self.sepfir_firstpass = None
+        self.workspace = Workspace()
+
+        # threads that the weave code is run on, a tile of rows each (by
+        # default, as many as TilePool.default_n_threads)
+        self.pool = TilePool(n_threads)
+        self.compiled = set()
+
+        self.fused_transform = True
 
         self.type_string = 'float'
         self.autotuned = False
 
-    def autotune(self, example_im):
+    def autotune(self, example_im, **kwargs):
 
         self.dtype = example_im.dtype
         if self.dtype == float32:
@@ -34,32 +38,89 @@ class WovenBackend(VanillaBackend):
             self.type_string = 'double'
 
         # print self.type_string
-        # (re)initialize reusable storage
+        # reusable storage is handed out by the workspace as it is needed
         self.cached_shape = example_im.shape
-        self.cached_gauss2d_fft = None
-        self.M = zeros_like(example_im)
-        self.O = zeros_like(example_im)
-        self.F = zeros_like(example_im)
-        self.S = zeros_like(example_im)
-        self.sepfir_firstpass = zeros_like(example_im)
-        self.sepfir_result = zeros_like(example_im)
 
         self.autotuned = True
+        self.choose_smoothing(example_im, kwargs.get('radii', None))
         return
 
+    def begin_frame(self):
+        self.workspace.begin_frame()
+
+    def variants(self, operation):
+        if operation == 'fast_radial_transform':
+            return [dict(variant, fused=fused) for fused in (True, False)
+                    for variant in VanillaBackend.variants(self, operation)]
+        return VanillaBackend.variants(self, operation)
+
     def sobel3x3(self, image, **kwargs):
         return self.sobel3x3_separable(image)
 
+    def _inline_tiles(self, code, arg_names, tiles, variables):
+        """ Run code once for each (rstart, rend) row tile (numbered by tile)
+            on the thread pool, with the variables named in arg_names; the
+            first time a piece of code is seen (with arguments of those
+            types) its tiles are run one after the other instead, so that
+            weave compiles it only once
+        """
+
+        def run_tile(numbered_tile):
+            (tile, (rstart, rend)) = numbered_tile
+            local_dict = dict(variables, tile=tile, rstart=rstart, rend=rend)
+            inline(code, arg_names + ['tile', 'rstart', 'rend'],
+                   local_dict=local_dict, verbose=0)
+
+        signature = (code, ) + tuple([(type(variables[name]),
+                                      getattr(variables[name], 'dtype', None),
+                                      getattr(variables[name], 'ndim', None))
+                                     for name in arg_names])
+
+        numbered_tiles = list(enumerate(tiles))
+        if signature in self.compiled:
+            self.pool.map(run_tile, numbered_tiles)
+        else:
+            for numbered_tile in numbered_tiles:
+                run_tile(numbered_tile)
+            self.compiled.add(signature)
+
+    def _vote_bands(self, tiles, rows, cols, radii, planes):
+        """ The band of rows that the votes from each (rstart, rend) row tile
+            can land in (as far as the largest of radii beyond the tile,
+            within the frame), as int32 arrays of the first row of each band
+            and the row after its last, and the offset of each band's own
+            projection images (planes of them) in a flat buffer, with the
+            size of that buffer
+        """
+
+        # (and a row more, for the rounding of the votes' positions)
+        reach = int(ceil(max(radii))) + 1
+
+        bounds = array(tiles, dtype=int32).reshape(-1, 2)
+        band_start = maximum(bounds[:, 0] - reach, 0).astype(int32)
+        band_end = minimum(bounds[:, 1] + reach, rows).astype(int32)
+
+        sizes = (band_end - band_start) * cols * planes
+        band_offset = (cumsum(sizes) - sizes).astype(int32)
+        return (band_start, band_end, band_offset, int(sizes.sum()))
+
     # @clockit
     def sobel3x3_separable(self, image, **kwargs):
 
-        sobel_c = array([-1., 0., 1.]).astype(image.dtype)
-        sobel_r = array([1., 2., 1.]).astype(image.dtype)
+        ws = self.workspace
+
+        (sobel_c, sobel_r) = ws.cached(('sobel', image.dtype.str), lambda: \
+                (array([-1., 0., 1.]).astype(image.dtype), array([1., 2.,
+                 1.]).astype(image.dtype)))
 
-        imgx = self.separable_convolution2d(image, sobel_c, sobel_r)
-        imgy = self.separable_convolution2d(image, sobel_r, sobel_c)
+        imgx = self.separable_convolution2d(image, sobel_c, sobel_r,
+                out=ws.get('sobel_x', image.shape, image.dtype))
+        imgy = self.separable_convolution2d(image, sobel_r, sobel_c,
+                out=ws.get('sobel_y', image.shape, image.dtype))
 
-        mag = sqrt(imgx ** 2 + imgy ** 2) + 1e-16
+        mag = ws.get('sobel_mag', image.shape, image.dtype)
+        hypot(imgx, imgy, mag)
+        mag += 1e-16
 
         return (mag, imgx, imgy)
 
@@ -69,19 +130,20 @@ class WovenBackend(VanillaBackend):
         if not self.autotuned:
             self.autotune(image)
 
-        code = \
+        # the row pass is run over tiles of rows, and then the col pass (which
+        # reads the first pass of the neighbouring tiles too) over the same
+        # tiles
+
+        row_code = \
             """
             Py_BEGIN_ALLOW_THREADS
 
             #define __TYPE  %s
 
-            int h = Nimage[0];
             int w = Nimage[1];
 
             int image_r_stride = image_array->strides[0];
             int image_c_stride = image_array->strides[1];
-            int fp_r_stride = firstpass_array->strides[0];
-            int fp_c_stride = firstpass_array->strides[1];
 
             int row_width = Nrow[0];
             int row_halfwidth;
@@ -91,19 +153,11 @@ class WovenBackend(VanillaBackend):
                 row_halfwidth = row_width / 2;
             }
 
-            int col_width = Ncol[0];
-            int col_halfwidth;
-            if((col_width %% 2) == 0){
-                col_halfwidth = (col_width-1) / 2;
-            } else {
-                col_halfwidth = col_width / 2;
-            }
-
             int r_stride = firstpass_array->strides[0];
             int c_stride = firstpass_array->strides[1];
 
             // Apply the row kernel
-            for(int r = 0; r < h; r++){
+            for(int r = rstart; r < rend; r++){
                 for(int c = 0; c < w; c++){
                     int result_offset = r_stride * r + c_stride*c;
                     __TYPE *result_ptr = (__TYPE *)((char *)firstpass_array->data + result_offset);
@@ -124,13 +178,36 @@ class WovenBackend(VanillaBackend):
                 }
             }
 
+            Py_END_ALLOW_THREADS
+        """ \
+            % self.type_string
 
-            r_stride = result_array->strides[0];
-            c_stride = result_array->strides[1];
+        col_code = \
+            """
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+
+            int h = Nfirstpass[0];
+            int w = Nfirstpass[1];
+
+            int fp_r_stride = firstpass_array->strides[0];
+            int fp_c_stride = firstpass_array->strides[1];
+
+            int col_width = Ncol[0];
+            int col_halfwidth;
+            if((col_width %% 2) == 0){
+                col_halfwidth = (col_width-1) / 2;
+            } else {
+                col_halfwidth = col_width / 2;
+            }
+
+            int r_stride = result_array->strides[0];
+            int c_stride = result_array->strides[1];
 
             // Apply the col kernel
-            for(int c = 0; c < w; c++){
-                for(int r = 0; r < h; r++){
+            for(int r = rstart; r < rend; r++){
+                for(int c = 0; c < w; c++){
 
                     int result_offset = r_stride*r + c_stride*c;
                     __TYPE *result_ptr = (__TYPE *)((char *)result_array->data + result_offset);
@@ -151,13 +228,24 @@ class WovenBackend(VanillaBackend):
                     }
                 }
             }
+
             Py_END_ALLOW_THREADS
         """ \
             % self.type_string
 
-        firstpass = zeros_like(image)
-        result = zeros_like(image)
-        inline(code, ['image', 'row', 'col', 'firstpass', 'result'], verbose=0)
+        firstpass = self.workspace.get('sepfir_firstpass', image.shape,
+                                       image.dtype)
+        result = kwargs.get('out', None)
+        if result is None:
+            result = zeros_like(image)
+
+        tiles = self.pool.row_tiles(image.shape[0], image.shape[1])
+        variables = {'image': image, 'row': row, 'col': col,
+                     'firstpass': firstpass, 'result': result}
+        self._inline_tiles(row_code, ['image', 'row', 'firstpass'], tiles,
+                           variables)
+        self._inline_tiles(col_code, ['firstpass', 'col', 'result'], tiles,
+                           variables)
 
         return result
 
@@ -168,76 +256,68 @@ class WovenBackend(VanillaBackend):
         if not self.autotuned:
             self.autotune(image)
 
+        if kwargs.get('fused', self.fused_transform):
+            return self._fused_fast_radial_transform(image, radii, alpha,
+                    **kwargs)
+
         gaussian_kernel_cheat = 1.
-        reuse_storage = False
 
         use_spline_approximation = 0
         use_sep_fir = 0
-        use_fft_filter = 0
+        use_fft_filter = self._smoothing_method(image, **kwargs) == 'fft'
 
         (rows, cols) = image.shape
 
-        use_cached_sobel = False
-        cached_mag = None
-        cached_x = None
-        cached_y = None
-        if 'cached_sobel' in kwargs:
-            (cached_mag, cached_x, cached_y) = kwargs['cached_sobel']
-            (sobel_rows, sobel_cols) = cached_sobel_mag.shape
-
-            if sobel_rows == rows or sobel_cols == cols:
-                use_cached_sobel = True
-
-        if use_cached_sobel:
-            mag = cached_mag
-            imgx = cached_x
-            imgy = cached_y
-        else:
-            (mag, imgx, imgy) = self.sobel3x3(image)
+        (mag, imgx, imgy) = self.sobel3x3_cached(image, **kwargs)
+
+        ws = self.workspace
 
         # Normalise gradient values so that [imgx imgy] form unit
         # direction vectors.
-        imgx = imgx / mag
-        imgy = imgy / mag
+        imgx = divide(imgx, mag, ws.get('unit_x', image.shape, image.dtype))
+        imgy = divide(imgy, mag, ws.get('unit_y', image.shape, image.dtype))
 
-        Ss = list(radii)
+        (y, x) = ws.mgrid(image.shape)  # meshgrid(1:cols, 1:rows);
 
-        (y, x) = mgrid[0:rows, 0:cols]  # meshgrid(1:cols, 1:rows);
+        # storage for the coordinates of the affected pixels
+        (posx, posy, negx, negy) = ws.get('coordinates', (4, rows, cols),
+                float64)
 
-        # S_sub = zeros((rows,cols))
+        S = ws.get('S', image.shape, image.dtype, zero=True)  # the accumulated result
+        smoothed = ws.get('smoothed', image.shape, image.dtype)
 
-        if reuse_storage:
+        # smoothing in the frequency domain takes the F of every radius at
+        # once
+        if use_fft_filter:
+            F_stack = ws.get('F_stack', (len(radii), rows, cols),
+                             image.dtype, zero=True)
 
-            M = self.M  # Magnitude projection image
-            O = self.O  # Orientation projection image
-            F = self.F  # the result, prior to accumulation
-            S = self.S  # the accumulated result
-            self._fast_clear_array2d(S)
-        else:
-            M = zeros_like(image)
-            O = zeros_like(image)
-            F = zeros_like(image)
-            S = zeros_like(image)
+        # The orientation and magnitude projection images are voted into
+        # from a tile of rows at a time, but a vote can land up to n rows
+        # away, so each tile votes into projection images of its own,
+        # covering just the band of rows its votes can reach, which are
+        # summed afterwards
+        tiles = self.pool.row_tiles(rows, cols)
+        (band_start, band_end, band_offset, band_size) = \
+            self._vote_bands(tiles, rows, cols, radii, 1)
+
+        O = ws.get('O_partial', (band_size, ), image.dtype)  # Orientation projection images
+        M = ws.get('M_partial', (band_size, ), image.dtype)  # Magnitude projection images
 
         for r in range(0, len(radii)):
 
             n = radii[r]
 
-            if reuse_storage:
-                self._fast_clear_array2d(M)
-                self._fast_clear_array2d(O)
-                self._fast_clear_array2d(F)
-            else:
-                M = zeros_like(image)
-                O = zeros_like(image)
-                F = zeros_like(image)
+            F = ws.get('F', image.shape, image.dtype, zero=True)  # the result, prior to accumulation
+            if use_fft_filter:
+                F = F_stack[r]
 
             # Coordinates of 'positively' and 'negatively' affected pixels
-            posx = x + n * imgx
-            posy = y + n * imgy
+            add(x, multiply(imgx, n, posx), posx)
+            add(y, multiply(imgy, n, posy), posy)
 
-            negx = x - n * imgx
-            negy = y - n * imgy
+            subtract(x, multiply(imgx, n, negx), negx)
+            subtract(y, multiply(imgy, n, negy), negy)
 
             # Clamp Orientation projection matrix values to a maximum of
             # +/-kappa,  but first set the normalization parameter kappa to the
@@ -248,30 +328,27 @@ class WovenBackend(VanillaBackend):
 
             # Form the orientation and magnitude projection matrices
 
-            code = \
+            vote_code = \
                 """
             Py_BEGIN_ALLOW_THREADS
 
             #define __TYPE  %s
 
-            int rows = Nmag[0];
-            //int rstart = 0;
-            //int rend = rows;
-            int tile_size = rows / n_tiles;
-            int rstart = (tile) * tile_size;
-            int rend;
-            if(tile == n_tiles-1){
-                rend = rows;
-            } else {
-                rend = (tile+1) * tile_size - 1;
-            }
-
             int cols = Nmag[1];
-            int cstart = 0;
-            int cend = cols;
+
+            // this tile's projection images, of the rows of its band
+            int first_row = band_start[tile];
+            int end_row = band_end[tile];
+            __TYPE *O_tile = O + band_offset[tile];
+            __TYPE *M_tile = M + band_offset[tile];
+
+            for(int i = 0; i < (end_row - first_row) * cols; i++){
+                O_tile[i] = 0.0;
+                M_tile[i] = 0.0;
+            }
 
             for(int r = rstart; r < rend; r++){
-                for(int c = cstart; c < cend; c++){
+                for(int c = 0; c < cols; c++){
                     int index = r*cols + c;
 
                     int posx_ = round(posx[index]);
@@ -279,101 +356,83 @@ class WovenBackend(VanillaBackend):
                     int negx_ = round(negx[index]);
                     int negy_ = round(negy[index]);
 
+                    // (the band holds every row of the frame that the
+                    // tile's votes can reach)
                     if(posx_ < 0 || posx_ > cols-1 ||
-                       posy_ < 0 || posy_ > rows-1 ||
+                       posy_ < first_row || posy_ > end_row-1 ||
                        negx_ < 0 || negx_ > cols-1 ||
-                       negy_ < 0 || negy_ > rows-1){
+                       negy_ < first_row || negy_ > end_row-1){
                         continue;
                     }
 
-                    if(posx_ < 0) posx_ = 0;
-                    if(posx_ > cols-1) posx_ = cols-1;
-                    if(posy_ < 0) posy_ = 0;
-                    if(posy_ > rows-1) posy_ = rows-1;
-
-                    if(negx_ < 0) negx_ = 0;
-                    if(negx_ > cols-1) negx_ = cols-1;
-                    if(negy_ < 0) negy_ = 0;
-                    if(negy_ > rows-1) negy_ = rows-1;
-
-                    int pos_index = (int)posy_*cols + (int)posx_;
-                    int neg_index = (int)negy_*cols + (int)negx_;
+                    int pos_index = (posy_ - first_row)*cols + posx_;
+                    int neg_index = (negy_ - first_row)*cols + negx_;
 
-                    O[pos_index] += 1.0;
-                    O[neg_index] -= 1.0;
+                    O_tile[pos_index] += 1.0;
+                    O_tile[neg_index] -= 1.0;
 
-                    M[pos_index] += mag[index];
-                    M[neg_index] -= mag[index];
+                    M_tile[pos_index] += mag[index];
+                    M_tile[neg_index] -= mag[index];
                 }
             }
 
+            Py_END_ALLOW_THREADS
+            """ \
+                % self.type_string
+
+            F_code = \
+                """
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+
+            int n_tiles = Nband_start[0];
+            int cols = NF[1];
+
+            // the votes for each pixel, from the tiles whose bands hold it
             for(int r = rstart; r < rend; r++){
-                for(int c=cstart; c < cend; c++){
-                    int index = r*cols + c;
-                    __TYPE O_ = abs(O[index]);
+                for(int c = 0; c < cols; c++){
+                    __TYPE O_sum = 0.0;
+                    __TYPE M_sum = 0.0;
+                    for(int t = 0; t < n_tiles; t++){
+                        if(r < band_start[t] || r >= band_end[t]) continue;
+                        int index = band_offset[t] + (r - band_start[t])*cols + c;
+                        O_sum += O[index];
+                        M_sum += M[index];
+                    }
+
+                    __TYPE O_ = abs(O_sum);
                     if(O_ > kappa) O_ = kappa;
 
-                    F[index] = M[index]/kappa * pow(O_/kappa, alpha);
+                    F[r*cols + c] = M_sum/kappa * pow(O_/kappa, alpha);
                 }
             }
 
-
             Py_END_ALLOW_THREADS
             """ \
                 % self.type_string
 
-            multithreaded_weave = 0
-
-            def run_inline(tile, O, M, mag, posx, posy, negx, negy, kappa, F,
-                           alpha, n_tiles):
-                inline(code, [  # , type_converters=converters.blitz)
-                    'O',
-                    'M',
-                    'mag',
-                    'posx',
-                    'posy',
-                    'negx',
-                    'negy',
-                    'kappa',
-                    'F',
-                    'alpha',
-                    'n_tiles',
-                    'tile',
-                    ], verbose=0)
-
-            if multithreaded_weave:
-                n_tiles = 2
-                foreach(lambda t: run_inline(
-                        t,
-                        O,
-                        M,
-                        mag,
-                        posx,
-                        posy,
-                        negx,
-                        negy,
-                        kappa,
-                        F,
-                        alpha,
-                        n_tiles,
-                        ), range(0, n_tiles), 2)
-            else:
-                n_tiles = 1
-                tile = 0
-                inline(code, [
-                    'O',
-                    'M',
-                    'mag',
-                    'posx',
-                    'posy',
-                    'negx',
-                    'negy',
-                    'kappa',
-                    'F',
-                    'alpha',
-                    'n_tiles',
-                    'tile',
-                    ], verbose=0)
+            variables = {
+                'O': O,
+                'M': M,
+                'mag': mag,
+                'posx': posx,
+                'posy': posy,
+                'negx': negx,
+                'negy': negy,
+                'kappa': kappa,
+                'F': F,
+                'alpha': alpha,
+                'band_start': band_start,
+                'band_end': band_end,
+                'band_offset': band_offset,
+                }
+            self._inline_tiles(vote_code, ['O', 'M', 'mag', 'posx', 'posy',
+                               'negx', 'negy', 'band_start', 'band_end',
+                               'band_offset'], tiles, variables)
+            self._inline_tiles(F_code, ['O', 'M', 'kappa', 'F', 'alpha',
+                               'band_start', 'band_end', 'band_offset'],
+                               tiles, variables)
 
             # Generate a Gaussian of size proportional to n to smooth and spread
             # the symmetry measure.  The Gaussian is also scaled in magnitude
@@ -381,15 +440,23 @@ class WovenBackend(VanillaBackend):
             # A = fspecial('gaussian',[n n], 0.25*n) * n;
             # S = S + filter2(A,F);
 
-            if True:
-                width = round(gaussian_kernel_cheat * n)
-                if mod(width, 2) == 0:
-                    width += 1
-                gauss1d = scipy.signal.gaussian(width, 0.25
-                        * n).astype(image.dtype)
+            if use_fft_filter:
+                pass
+            elif True:
+
+                def gaussian_kernel():
+                    width = round(gaussian_kernel_cheat * n)
+                    if mod(width, 2) == 0:
+                        width += 1
+                    return scipy.signal.gaussian(width, 0.25
+                            * n).astype(image.dtype)
+
+                gauss1d = ws.cached(('gaussian', n, image.dtype.str),
+                                    gaussian_kernel)
                 # print gauss1d.shape
 
-                S += self.separable_convolution2d(F, gauss1d, gauss1d)
+                S += self.separable_convolution2d(F, gauss1d, gauss1d,
+                        out=smoothed)
             else:
                 S += F
 
@@ -403,7 +470,360 @@ class WovenBackend(VanillaBackend):
 
             S = self.separable_convolution2d(S, gauss1d, gauss1d)
 
-        S = S / len(radii)  # Average
+        if use_fft_filter:
+            self.smooth_radial_fft(F_stack, radii, out=S)
+
+        S /= len(radii)  # Average
+
+        return S
+
+    def _fused_fast_radial_transform(self, image, radii, alpha, **kwargs):
+        """ Compute the transform for all radii at once: a single sweep over
+            the pixels scatters the votes for every radius into stacked
+            (n_radii x rows x cols) buffers, and a single batched pass then
+            smooths each radius with its own Gaussian and accumulates S
+        """
+
+        gaussian_kernel_cheat = 1.
+
+        (rows, cols) = image.shape
+        n_radii = len(radii)
+        stacked_shape = (n_radii, rows, cols)
+
+        ws = self.workspace
+
+        (mag, imgx, imgy) = self.sobel3x3_cached(image, **kwargs)
+
+        def constants():
+            radii_ = asarray(radii).astype(float64)
+
+            # values of kappa suggested by Loy and Zelinski
+            kappas = where(radii_ == 1, 8., 9.9)
+
+            # O only ever holds whole vote counts, so (|O|/kappa)^alpha can
+            # be looked up rather than computed with pow() at every pixel
+            n_levels = int(ceil(max(kappas))) + 1
+            levels = minimum(arange(n_levels)[newaxis, :], kappas[:,
+                             newaxis])
+            orientation_lut = ((levels / kappas[:, newaxis])
+                               ** alpha).astype(image.dtype)
+
+            # Gaussians of size proportional to each n, packed into one table
+            widths = zeros(n_radii, dtype=int32)
+            for r in range(0, n_radii):
+                width = round(gaussian_kernel_cheat * radii_[r])
+                if mod(width, 2) == 0:
+                    width += 1
+                widths[r] = width
+            gauss_table = zeros((n_radii, max(widths)), dtype=image.dtype)
+            for r in range(0, n_radii):
+                gauss_table[r, 0:widths[r]] = \
+                    scipy.signal.gaussian(widths[r], 0.25 * radii_[r])
+
+            return (radii_, kappas, orientation_lut, widths, gauss_table)
+
+        (radii_, kappas, orientation_lut, widths, gauss_table) = \
+            ws.cached(('fused', tuple(radii), alpha, image.dtype.str),
+                      constants)
+
+        # The pixels are voted from a tile of rows at a time, into a stack of
+        # projection images of each tile's own, covering just the band of
+        # rows its votes can reach (see _vote_bands); the stacks are then
+        # summed, again a tile of rows at a time, into the symmetry measure
+        # F of each radius
+        tiles = self.pool.row_tiles(rows, cols)
+        n_tiles = len(tiles)
+        (band_start, band_end, band_offset, band_size) = \
+            self._vote_bands(tiles, rows, cols, radii, n_radii)
+
+        O = ws.get('fused_O', (band_size, ), image.dtype)  # Orientation projection images
+        M = ws.get('fused_M', (band_size, ), image.dtype)  # Magnitude projection images
+
+        # (a single tile's band is the whole frame, laid out as F is, so F
+        # can overwrite it)
+        if n_tiles == 1:
+            F = M.reshape(stacked_shape)
+        else:
+            F = ws.get('fused_F', stacked_shape, image.dtype)
+
+        vote_code = \
+            """
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+
+            int cols = Nmag[1];
+            int n_radii = Nradii_[0];
+
+            // this tile's stack of projection images, of the rows of its
+            // band
+            int first_row = band_start[tile];
+            int end_row = band_end[tile];
+            int band_plane = (end_row - first_row) * cols;
+            __TYPE *O_tile = O + band_offset[tile];
+            __TYPE *M_tile = M + band_offset[tile];
+
+            for(int i = 0; i < n_radii * band_plane; i++){
+                O_tile[i] = 0.0;
+                M_tile[i] = 0.0;
+            }
+
+            // Form the orientation and magnitude projection matrices
+            for(int r = rstart; r < rend; r++){
+                for(int c = 0; c < cols; c++){
+                    int index = r*cols + c;
+
+                    __TYPE mag_ = mag[index];
+                    __TYPE ux = imgx[index] / mag_;
+                    __TYPE uy = imgy[index] / mag_;
+
+                    for(int k = 0; k < n_radii; k++){
+                        __TYPE n = (__TYPE)radii_[k];
+
+                        int posx_ = round(c + (double)(n * ux));
+                        int posy_ = round(r + (double)(n * uy));
+                        int negx_ = round(c - (double)(n * ux));
+                        int negy_ = round(r - (double)(n * uy));
+
+                        // (the band holds every row of the frame that the
+                        // tile's votes can reach)
+                        if(posx_ < 0 || posx_ > cols-1 ||
+                           posy_ < first_row || posy_ > end_row-1 ||
+                           negx_ < 0 || negx_ > cols-1 ||
+                           negy_ < first_row || negy_ > end_row-1){
+                            continue;
+                        }
+
+                        int pos_index = k*band_plane + (posy_ - first_row)*cols + posx_;
+                        int neg_index = k*band_plane + (negy_ - first_row)*cols + negx_;
+
+                        O_tile[pos_index] += 1.0;
+                        O_tile[neg_index] -= 1.0;
+
+                        M_tile[pos_index] += mag_;
+                        M_tile[neg_index] -= mag_;
+                    }
+                }
+            }
+
+            Py_END_ALLOW_THREADS
+            """ \
+            % self.type_string
+
+        symmetry_code = \
+            """
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+
+            int n_tiles = Nband_start[0];
+            int n_radii = NF[0];
+            int rows = NF[1];
+            int cols = NF[2];
+            int plane = rows * cols;
+
+            // Unsmoothed symmetry measure, from the votes for each pixel of
+            // the tiles whose bands hold it (F may be the only tile's M;
+            // each pixel is then only read and written by the tile it is
+            // in)
+            int n_levels = Norientation_lut[1];
+            for(int k = 0; k < n_radii; k++){
+                __TYPE kappa = kappas[k];
+                __TYPE *lut = orientation_lut + k*n_levels;
+                for(int r = rstart; r < rend; r++){
+                    for(int c = 0; c < cols; c++){
+                        __TYPE O_sum = 0.0;
+                        __TYPE M_sum = 0.0;
+                        for(int t = 0; t < n_tiles; t++){
+                            if(r < band_start[t] || r >= band_end[t]) continue;
+                            int band_rows = band_end[t] - band_start[t];
+                            int index = band_offset[t] + (k*band_rows + r - band_start[t])*cols + c;
+                            O_sum += O[index];
+                            M_sum += M[index];
+                        }
+
+                        int O_ = (int)fabs(O_sum);
+                        if(O_ > n_levels - 1) O_ = n_levels - 1;
+
+                        F[k*plane + r*cols + c] = M_sum/kappa * lut[O_];
+                    }
+                }
+            }
+
+            Py_END_ALLOW_THREADS
+            """ \
+            % self.type_string
+
+        variables = {
+            'O': O,
+            'M': M,
+            'F': F,
+            'mag': mag,
+            'imgx': imgx,
+            'imgy': imgy,
+            'radii_': radii_,
+            'kappas': kappas,
+            'orientation_lut': orientation_lut,
+            'band_start': band_start,
+            'band_end': band_end,
+            'band_offset': band_offset,
+            }
+        self._inline_tiles(vote_code, ['O', 'M', 'mag', 'imgx', 'imgy',
+                           'radii_', 'band_start', 'band_end', 'band_offset'
+                           ], tiles, variables)
+        self._inline_tiles(symmetry_code, ['O', 'M', 'F', 'kappas',
+                           'orientation_lut', 'band_start', 'band_end',
+                           'band_offset'], tiles, variables)
+
+        S = ws.get('S', image.shape, image.dtype)
+
+        if self._smoothing_method(image, **kwargs) == 'fft':
+            self.smooth_radial_fft(F, radii, out=S)
+            S /= n_radii  # Average
+            return S
+
+        # the row pass of every radius (into its own plane of scratch) is
+        # done, a tile of rows at a time, before the col pass, which reads
+        # the rows of the neighbouring tiles too
+        scratch = ws.get('fused_scratch', stacked_shape, image.dtype)
+
+        smooth_row_code = \
+            """
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+
+            int n_radii = NF[0];
+            int rows = NF[1];
+            int cols = NF[2];
+            int table_width = Ngauss_table[1];
+            int plane = rows * cols;
+
+            for(int k = 0; k < n_radii; k++){
+                int width = widths[k];
+                int halfwidth;
+                if((width %% 2) == 0){
+                    halfwidth = (width-1) / 2;
+                } else {
+                    halfwidth = width / 2;
+                }
+
+                __TYPE *kernel = gauss_table + k*table_width;
+                __TYPE *F_k = F + k*plane;
+                __TYPE *scratch_k = scratch + k*plane;
+
+                // The kernel fits entirely inside the row for columns in
+                // [c_lo, c_hi); only the edges need reflecting
+                int c_lo = halfwidth;
+                int c_hi = cols - (width - 1 - halfwidth);
+                if(c_hi < c_lo) c_hi = c_lo;
+                if(c_lo > cols) c_lo = c_hi = cols;
+
+                // Apply the row kernel
+                for(int r = rstart; r < rend; r++){
+                    __TYPE *src = F_k + r*cols;
+                    __TYPE *dst = scratch_k + r*cols;
+
+                    for(int c = 0; c < cols; c++){
+                        dst[c] = 0.0;
+                    }
+
+                    // interior: one kernel tap at a time, so that the inner
+                    // loop runs straight along the row
+                    for(int j = 0; j < width; j++){
+                        __TYPE coef = kernel[j];
+                        __TYPE *shifted = src + j - halfwidth;
+                        for(int c = c_lo; c < c_hi; c++){
+                            dst[c] += coef * shifted[c];
+                        }
+                    }
+
+                    // edges
+                    for(int c = 0; c < cols; c++){
+                        if(c == c_lo) c = c_hi;
+                        if(c >= cols) break;
+
+                        __TYPE acc = 0.0;
+                        for(int j = 0; j < width; j++){
+                            int j_index = j - halfwidth + c;
+                            if(j_index < 0) j_index *= -1;  // reflect at boundaries
+                            if(j_index >= cols) j_index = cols - (j - halfwidth);
+                            acc += kernel[j] * src[j_index];
+                        }
+                        dst[c] = acc;
+                    }
+                }
+            }
+
+            Py_END_ALLOW_THREADS
+            """ \
+            % self.type_string
+
+        smooth_col_code = \
+            """
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+
+            int n_radii = Nscratch[0];
+            int rows = Nscratch[1];
+            int cols = Nscratch[2];
+            int table_width = Ngauss_table[1];
+            int plane = rows * cols;
+
+            for(int i = rstart*cols; i < rend*cols; i++){
+                S[i] = 0.0;
+            }
+
+            for(int k = 0; k < n_radii; k++){
+                int width = widths[k];
+                int halfwidth;
+                if((width %% 2) == 0){
+                    halfwidth = (width-1) / 2;
+                } else {
+                    halfwidth = width / 2;
+                }
+
+                __TYPE *kernel = gauss_table + k*table_width;
+                __TYPE *scratch_k = scratch + k*plane;
+
+                // Apply the col kernel, accumulating into S
+                for(int r = rstart; r < rend; r++){
+                    __TYPE *dst = S + r*cols;
+                    for(int j = 0; j < width; j++){
+                        int j_index = j - halfwidth + r;
+                        if(j_index < 0) j_index *= -1;  // reflect at boundaries
+                        if(j_index >= rows) j_index = rows - (j - halfwidth);
+
+                        __TYPE coef = kernel[j];
+                        __TYPE *src = scratch_k + j_index*cols;
+                        for(int c = 0; c < cols; c++){
+                            dst[c] += coef * src[c];
+                        }
+                    }
+                }
+            }
+
+            // Average
+            for(int i = rstart*cols; i < rend*cols; i++){
+                S[i] /= n_radii;
+            }
+
+            Py_END_ALLOW_THREADS
+            """ \
+            % self.type_string
+
+        variables = {
+            'S': S,
+            'F': F,
+            'scratch': scratch,
+            'gauss_table': gauss_table,
+            'widths': widths,
+            }
+        self._inline_tiles(smooth_row_code, ['F', 'scratch', 'gauss_table',
+                           'widths'], tiles, variables)
+        self._inline_tiles(smooth_col_code, ['S', 'scratch', 'gauss_table',
+                           'widths'], tiles, variables)
 
         return S
 
@@ -411,7 +831,7 @@ class WovenBackend(VanillaBackend):
         # print "Here (woven)"
         # print image
 
-        if image == None:
+        if image is None:
             return ([0, 0], [0])
 
         code = \
@@ -463,6 +883,409 @@ class WovenBackend(VanillaBackend):
 
         return (coordinates[0:2], coordinates[2:4])
 
+    def find_peaks(self, image, n_peaks=1, separation=1., region=None,
+                   subpixel=True, **kwargs):
+
+        if image is None:
+            return (None, None)
+
+        if region is None:
+            region = (0, image.shape[0], 0, image.shape[1])
+        (top, bottom, left, right) = [int(bound) for bound in region]
+
+        if n_peaks == 1:
+            # just the min and max (which are always peaks)
+            if top < bottom and left < right:
+                (min_coord, max_coord) = self.find_minmax(image[top:bottom,
+                        left:right])
+                minima = array([min_coord], dtype=float) + [top, left]
+                maxima = array([max_coord], dtype=float) + [top, left]
+            else:
+                (minima, maxima) = (zeros((0, 2)), zeros((0, 2)))
+        else:
+            if image.dtype == float32:
+                type_string = 'float'
+            elif image.dtype == float64:
+                type_string = 'double'
+            else:
+                image = image.astype(float64)
+                type_string = 'double'
+
+            support_code = \
+                """
+            // whether candidate i (row, col, strength) is weaker than j, or
+            // as strong and found later
+            static int ranks_below(double *heap, int i, int j){
+                if(heap[i*3 + 2] != heap[j*3 + 2]){
+                    return heap[i*3 + 2] < heap[j*3 + 2];
+                }
+                if(heap[i*3] != heap[j*3]){
+                    return heap[i*3] > heap[j*3];
+                }
+                return heap[i*3 + 1] > heap[j*3 + 1];
+            }
+
+            static void swap_rows(double *heap, int i, int j){
+                for(int k = 0; k < 3; k++){
+                    double t = heap[i*3 + k];
+                    heap[i*3 + k] = heap[j*3 + k];
+                    heap[j*3 + k] = t;
+                }
+            }
+
+            static void sift_down(double *heap, int i, int count){
+                while(1){
+                    int lowest = i;
+                    for(int child = 2*i + 1; child <= 2*i + 2; child++){
+                        if(child < count && ranks_below(heap, child, lowest)){
+                            lowest = child;
+                        }
+                    }
+                    if(lowest == i) return;
+                    swap_rows(heap, i, lowest);
+                    i = lowest;
+                }
+            }
+
+            // keep the strongest local extrema found so far in the first
+            // count of heap, with the weakest at the top
+            static int offer_candidate(double *heap, int n_candidates,
+                                       int count, int r, int c, double v){
+                if(count == n_candidates){
+                    // (as strong as the top, it was found later)
+                    if(v <= heap[2]) return count;
+                    heap[0] = r;
+                    heap[1] = c;
+                    heap[2] = v;
+                    sift_down(heap, 0, count);
+                    return count;
+                }
+
+                int i = count;
+                heap[i*3] = r;
+                heap[i*3 + 1] = c;
+                heap[i*3 + 2] = v;
+                while(i > 0 && ranks_below(heap, i, (i - 1) / 2)){
+                    swap_rows(heap, i, (i - 1) / 2);
+                    i = (i - 1) / 2;
+                }
+                return count + 1;
+            }
+
+            // ImageProcessingBackend.suppress_peaks, on the count
+            // candidates in heap into peaks; returns how many there are
+            static int suppress(double *heap, int count, double separation2,
+                                double *peaks, int n_peaks){
+                // (sorted strongest first, by taking the weakest off the
+                // top in turn)
+                for(int end = count - 1; end > 0; end--){
+                    swap_rows(heap, 0, end);
+                    sift_down(heap, 0, end);
+                }
+
+                int n = 0;
+                for(int i = 0; i < count && n < n_peaks; i++){
+                    int is_near = 0;
+                    for(int j = 0; j < n; j++){
+                        double dr = heap[i*3] - peaks[j*3];
+                        double dc = heap[i*3 + 1] - peaks[j*3 + 1];
+                        if(dr*dr + dc*dc < separation2){
+                            is_near = 1;
+                            break;
+                        }
+                    }
+                    if(!is_near){
+                        for(int k = 0; k < 3; k++){
+                            peaks[n*3 + k] = heap[i*3 + k];
+                        }
+                        n++;
+                    }
+                }
+                return n;
+            }
+            """
+
+            code = \
+                """
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+            #define PIXEL(r, c) ((double)*(__TYPE *)((char *)image_array->data + (r) * image_array->strides[0] + (c) * image_array->strides[1]))
+
+            int n_peaks = Nmaxima[0];
+            int n_candidates = Nmaximum_candidates[0];
+            double separation2 = separation * separation;
+            int n_minima = 0;
+            int n_maxima = 0;
+
+            // whether (r, c) is at least as strong (sign * value) as its
+            // neighbours in the region
+            #define IS_PEAK(r, c, sign, result) { \\
+                double v_ = (sign) * PIXEL(r, c); \\
+                result = 1; \\
+                for(int rr = (r > top ? r - 1 : r); rr < (r + 2 < bottom ? r + 2 : bottom); rr++){ \\
+                    for(int cc = (c > left ? c - 1 : c); cc < (c + 2 < right ? c + 2 : right); cc++){ \\
+                        if(!(v_ >= (sign) * PIXEL(rr, cc))) result = 0; \\
+                    } \\
+                } \\
+            }
+
+            // most rows lie within the weakest candidates kept (once there
+            // are n_candidates of them), which their max and min show, and
+            // aren't looked at any further
+            double lowest_max = -INFINITY;
+            double highest_min = INFINITY;
+            for(int r = top; r < bottom; r++){
+                double row_max = -INFINITY;
+                double row_min = INFINITY;
+                for(int c = left; c < right; c++){
+                    double v = PIXEL(r, c);
+                    if(v > row_max) row_max = v;
+                    if(v < row_min) row_min = v;
+                }
+                if(!(row_max > lowest_max || row_min < highest_min)){
+                    continue;
+                }
+
+                for(int c = left; c < right; c++){
+                    double v = PIXEL(r, c);
+                    int is_peak;
+                    if(v > lowest_max){
+                        IS_PEAK(r, c, 1., is_peak);
+                        if(is_peak){
+                            n_maxima = offer_candidate(maximum_candidates, n_candidates, n_maxima, r, c, v);
+                            if(n_maxima == n_candidates) lowest_max = maximum_candidates[2];
+                        }
+                    }
+                    if(v < highest_min){
+                        IS_PEAK(r, c, -1., is_peak);
+                        if(is_peak){
+                            n_minima = offer_candidate(minimum_candidates, n_candidates, n_minima, r, c, -v);
+                            if(n_minima == n_candidates) highest_min = -minimum_candidates[2];
+                        }
+                    }
+                }
+            }
+
+            // (and how many candidates there were, to tell if there may be
+            // more)
+            counts[2] = n_minima;
+            counts[3] = n_maxima;
+            n_minima = suppress(minimum_candidates, n_minima, separation2, minima, n_peaks);
+            n_maxima = suppress(maximum_candidates, n_maxima, separation2, maxima, n_peaks);
+
+            Py_END_ALLOW_THREADS
+
+            counts[0] = n_minima;
+            counts[1] = n_maxima;
+            """ \
+                % type_string
+
+            separation = float(separation)
+
+            # (row, col, strength) of each; with more candidates if too few
+            # of them were far enough apart and there may be more
+            minima = zeros((int(n_peaks), 3))
+            maxima = zeros((int(n_peaks), 3))
+            n_candidates = int(n_peaks) * candidates_per_peak
+            counts = zeros(4, dtype=int32)
+            while True:
+                minimum_candidates = zeros((n_candidates, 3))
+                maximum_candidates = zeros((n_candidates, 3))
+                inline(code, [
+                    'image',
+                    'top',
+                    'bottom',
+                    'left',
+                    'right',
+                    'separation',
+                    'minima',
+                    'maxima',
+                    'minimum_candidates',
+                    'maximum_candidates',
+                    'counts',
+                    ], support_code=support_code, headers=['<math.h>'],
+                    verbose=0)
+                if (counts[0] == n_peaks or counts[2] < n_candidates) \
+                    and (counts[1] == n_peaks or counts[3] < n_candidates):
+                    break
+                n_candidates *= more_candidates
+
+            minima = minima[0:counts[0], 0:2]
+            maxima = maxima[0:counts[1], 0:2]
+
+        if subpixel:
+            minima = refine_peaks(image, minima, region)
+            maxima = refine_peaks(image, maxima, region)
+        return (minima, maxima)
+
+    def find_ray_boundaries(self, im, seed_point, rays, cutoff_index,
+                            threshold, exclusion_center=None,
+                            exclusion_radius=None):
+        """ The starburst ray search in one GIL-free pass: each ray is
+            sampled (bilinearly) as it is scanned, the threshold is
+            normalized with a streaming mean and std of the samples inside
+            cutoff_index, and the exclusion zone is applied as points are
+            found.  Gives the same points as the Python version.
+        """
+
+        if im.dtype == float32:
+            type_string = 'float'
+        elif im.dtype == float64:
+            type_string = 'double'
+        else:
+            im = im.astype(float64)
+            type_string = 'double'
+
+        rays = ascontiguousarray(rays, dtype=float64)
+        seed = array(seed_point[0:2], dtype=float64)
+        cutoff_index = int(max(cutoff_index, 0))
+        threshold = float(threshold)
+
+        has_exclusion = int(exclusion_center is not None
+                            and size(exclusion_center) == 2)
+        if has_exclusion:
+            exclusion = array([exclusion_center[0], exclusion_center[1],
+                              exclusion_radius], dtype=float64)
+        else:
+            exclusion = zeros(3)
+
+        points = self.workspace.get('ray_boundaries', (rays.shape[0], 2),
+                                    float64)
+
+        code = \
+            """
+            int n_points = 0;
+
+            Py_BEGIN_ALLOW_THREADS
+
+            #define __TYPE  %s
+            #define PIXEL(r, c) ((double)*(__TYPE *)((char *)im_array->data + (r) * im_array->strides[0] + (c) * im_array->strides[1]))
+
+            int rows = Nim[0];
+            int cols = Nim[1];
+            int n_rays = Nrays[0];
+            int n_samples = Nrays[1];
+
+            // position of sample s along ray r, and the bilinearly
+            // interpolated image value there (NAN off the image)
+            #define POSITION(r, s, x, y) { \\
+                x = seed[0] + rays[((r) * n_samples + (s)) * 2]; \\
+                y = seed[1] + rays[((r) * n_samples + (s)) * 2 + 1]; \\
+            }
+            #define INSIDE(x, y) (x >= 0 && x < rows - 1 && y >= 0 && y < cols - 1)
+            #define SAMPLE(r, s, val) { \\
+                double x_, y_; \\
+                POSITION(r, s, x_, y_); \\
+                if(!INSIDE(x_, y_)){ \\
+                    val = NAN; \\
+                } else { \\
+                    int fx = (int)floor(x_), fy = (int)floor(y_); \\
+                    int cx = (int)ceil(x_), cy = (int)ceil(y_); \\
+                    double xf = 1 - (x_ - fx), yf = 1 - (y_ - fy); \\
+                    val = xf * yf * PIXEL(fx, fy) + (1 - xf) * yf * PIXEL(cx, fy) \\
+                          + xf * (1 - yf) * PIXEL(fx, cy) \\
+                          + (1 - xf) * (1 - yf) * PIXEL(cx, cy); \\
+                } \\
+            }
+
+            // mean and (population) std of the samples inside the cutoff,
+            // accumulated in one pass; see Knuth TAOCP vol 2, 3rd edition,
+            // page 232.  Off-image samples are skipped, except that with no
+            // cutoff every sample counts, and any off-image one leaves the
+            // threshold undefined (as NaNs do in the Python version)
+            int stats_samples = cutoff_index;
+            if(cutoff_index == 0){
+                stats_samples = n_samples;
+            }
+
+            long n_vals = 0;
+            int undefined = 0;
+            double mean_val = 0, m2 = 0;
+            for(int r = 0; r < n_rays; r++){
+                for(int s = 0; s < stats_samples; s++){
+                    double val;
+                    SAMPLE(r, s, val);
+                    if(val != val){
+                        if(cutoff_index == 0){
+                            undefined = 1;
+                        }
+                        continue;
+                    }
+                    n_vals++;
+                    double delta = val - mean_val;
+                    mean_val += delta / n_vals;
+                    m2 += delta * (val - mean_val);
+                }
+            }
+
+            if(n_vals > 0 && !undefined){
+                double normalized_threshold = threshold * sqrt(m2 / n_vals) + mean_val;
+
+                for(int r = 0; r < n_rays; r++){
+                    int crossed = 0;
+                    double previous = NAN;
+                    if(cutoff_index > 0){
+                        SAMPLE(r, cutoff_index - 1, previous);
+                    }
+
+                    for(int s = cutoff_index; s < n_samples; s++){
+                        double val;
+                        SAMPLE(r, s, val);
+
+                        double slope = (s == 0) ? 2.0 : val - previous;
+                        if(slope != slope){
+                            slope = 0;
+                        }
+                        previous = val;
+
+                        if(val > normalized_threshold){
+                            crossed = 1;
+                        }
+
+                        if(crossed && slope <= 0){
+                            // the boundary is the previous sample (which
+                            // may be off the image, if the ray came onto it
+                            // already above threshold)
+                            double bx, by;
+                            POSITION(r, s - 1, bx, by);
+
+                            if(has_exclusion){
+                                double dx = bx - exclusion[0];
+                                double dy = by - exclusion[1];
+                                if(sqrt(dx * dx + dy * dy) <= exclusion[2]){
+                                    break;
+                                }
+                            }
+
+                            points[n_points * 2] = bx;
+                            points[n_points * 2 + 1] = by;
+                            n_points++;
+                            break;
+                        }
+                    }
+                }
+            }
+
+            Py_END_ALLOW_THREADS
+
+            return_val = n_points;
+            """ \
+            % type_string
+
+        n_points = inline(code, [
+            'im',
+            'seed',
+            'rays',
+            'cutoff_index',
+            'threshold',
+            'has_exclusion',
+            'exclusion',
+            'points',
+            ], headers=['<math.h>'], verbose=0)
+
+        return points[0:n_points].copy()
+
     def _fast_clear_array2d(self, arr):
 
         code = \
@@ -652,3 +1475,103 @@ class WovenSSEBackend(WovenBackend):
         return result
 
 
+def test_threads():
+    """ Compare the transforms (fused and not) and convolutions computed on
+        one thread and on every core (or at least 8 threads, so that the
+        larger frames are split into several tiles), check that the fused
+        transform is the per-radius one, and time them
+    """
+
+    import os
+    import time
+    import multiprocessing
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    radii = array([2, 4, 6, 9, 12, 15])
+    alpha = 10.
+    trials = 20
+
+    serial_backend = WovenBackend(n_threads=1)
+    threaded_backend = WovenBackend(n_threads=max(8,
+                                    multiprocessing.cpu_count()))
+    gauss = scipy.signal.gaussian(9, 2.).astype(float32)
+
+    print 'threads: %d' % threaded_backend.pool.n_threads
+
+    for name in ['Snapshot_test.bmp', 'Snapshot.bmp', 'Snapshot2.bmp',
+                 'RatEye_snap6.tiff']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+
+        print name, im.shape
+
+        results = {}
+        for (label, b) in [('serial', serial_backend), ('threaded',
+                           threaded_backend)]:
+            b.autotune(im)
+            for fused in (True, False):
+                S = b.fast_radial_transform(im, radii, alpha, fused=fused)
+                tic = time.time()
+                for i in range(0, trials):
+                    S = b.fast_radial_transform(im, radii, alpha,
+                            fused=fused)
+                print '\t%s (fused=%s): %f s' % (label, fused, (time.time()
+                        - tic) / trials)
+                results[(label, fused)] = S.copy()
+            results[(label, 'sepfir')] = b.separable_convolution2d(im,
+                    gauss, gauss)
+
+        for variant in (True, False, 'sepfir'):
+            print '\t%s: max abs difference %g' % (variant,
+                    max(abs(results[('serial', variant)] - results[('threaded'
+                    , variant)]).ravel()))
+
+        for label in ('serial', 'threaded'):
+            (S_fused, S) = (results[(label, True)], results[(label, False)])
+            difference = max(abs(S_fused - S).ravel()) / max(abs(S).ravel())
+            print '\t%s: fused vs. per radius, max abs difference ' \
+                '(relative) %g' % (label, difference)
+            assert difference < 1e-5, (name, label, difference)
+
+
+def test_workspace():
+    """ Check that, once warmed up, the transforms (fused and not), on each
+        way of smoothing, allocate no new storage from frame to frame
+    """
+
+    import os
+    import PIL.Image
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    radii = array([2, 4, 6, 9, 12, 15])
+    alpha = 10.
+
+    for name in ['Snapshot.bmp', 'RatEye_snap6.tiff']:
+        im = asarray(PIL.Image.open(os.path.join(here, name)))
+        if im.ndim == 3:
+            im = mean(im, 2)
+        im = im.astype(float32)
+
+        for fused in (True, False):
+            for smoothing in ('sepfir', 'fft'):
+                b = WovenBackend()
+                for frame in range(0, 4):
+                    b.begin_frame()
+                    b.fast_radial_peaks(im, radii, alpha, n_peaks=3,
+                                        separation=max(radii), fused=fused,
+                                        smoothing=smoothing)
+                b.begin_frame()
+                assert b.workspace.bytes_allocated_last_frame == 0, \
+                    (name, fused, smoothing,
+                     b.workspace.bytes_allocated_last_frame)
+                print '%s (fused=%s, %s): %d bytes of storage, none new' \
+                    % (name, fused, smoothing, b.workspace.nbytes())
+
+
+if __name__ == '__main__':
+    test_threads()
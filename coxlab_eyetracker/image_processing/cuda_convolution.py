@@ -5,49 +5,47 @@ import numpy
 from numpy.random import rand
 from stopwatch import *
 import mako.template
+from AcceleratorRuntime import *
 
-class NoProgramToFreezeException (Exception):
-    def __str__(self):
-        return "No cl program to freeze"
+class CUDARuntime(object):
+    """ The device of a CUDA context, as a ProgramCache and BufferPool (see
+        AcceleratorRuntime) see it
+    """
 
-class KernelMustUseFloat32Exception (Exception):
-    def __str__(self):
-        return "This kernel only operates on float32 data"
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.device = ctx.get_device()
 
-class UnknownArrayShapeException (Exception):
-    def __str__(self):
-        return "Array shape unknown for OpenCL buffer object"
+    def device_key(self):
+        return (self.ctx, )
 
-# Helper functions for computing alignment...
-def int_div_up(a, b):
-    # Round a / b to nearest higher integer value
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return (a / b + 1) if (a % b != 0) else (a / b)
+    def device_name(self):
+        return 'CUDA %s %d.%d %d' % ((self.device.name(), )
+                                     + self.device.compute_capability()
+                                     + (cuda.get_driver_version(), ))
 
-def int_div_down(a, b):
-    # Round a / b to nearest lower integer value
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return a / b;
+    def build(self, source):
+        cubin = cuda_compiler.compile(source)
+        return (cuda.module_from_buffer(cubin), cubin)
 
-def int_align_up(a, b):
-    # Align a to nearest higher multiple of b
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return (a - a % b + b) if (a % b != 0) else a
+    def load(self, binary):
+        return cuda.module_from_buffer(binary)
 
-def int_align_down(a, b):
-    # Align a to nearest lower multiple of b
-    a = numpy.int32(a)
-    b = numpy.int32(b)
-    return a - a % b
+    def allocate(self, shape, dtype):
+        return cuda.mem_alloc(int(numpy.prod(shape))
+                              * numpy.dtype(dtype).itemsize)
 
+    def allocate_pinned(self, shape, dtype):
+        return cuda.pagelocked_empty(shape, dtype)
 
-class MetaKernel:
 
-    def __init__(self, ctx):    
-        self.cached_programs = {}
+class MetaKernel(AcceleratorKernel):
+
+    def __init__(self, ctx):
+        AcceleratorKernel.__init__(self, CUDARuntime(ctx))
+
+        # the shapes and types of allocations, by device address (so as not
+        # to keep buffers the pool lets go of alive)
         self.cached_shapes = {}
         self.cached_types = {}
         
@@ -55,21 +53,12 @@ class MetaKernel:
         #self.queue = queue
         #self.ctx = queue.get_info(cl.command_queue_info.CONTEXT)
         self.ctx = ctx
-        
-    def __call__(self, *args, **kwargs):
-        return
-    
-    def freeze(self):
-        if self.last_program == None:
-            raise NoProgramToFreezeException
-        self.frozen_program = self.last_program
-        
-    def thaw(self):
-        self.frozen_program = None
 
-    def cache_program(self, key, program):
-        self.cached_programs[key] = program
-        self.last_program = program
+    def buffer(self, name, shape, dtype=numpy.float32, cached=True):
+        buf = AcceleratorKernel.buffer(self, name, shape, dtype, cached)
+        self.cached_shapes[int(buf)] = shape
+        self.cached_types[int(buf)] = dtype
+        return buf
 
     #@clockit
     def transfer_to_device(self, buf):
@@ -79,13 +68,13 @@ class MetaKernel:
         buf_shape = None
         if(buf.__class__ == pycuda._driver.DeviceAllocation):
             buf_device = buf  # already on the device
-            buf_shape = self.cached_shapes.get(buf_device, None)
-            buf_type = self.cached_types.get(buf_device, None)
+            buf_shape = self.cached_shapes.get(int(buf_device), None)
+            buf_type = self.cached_types.get(int(buf_device), None)
         else:
             buf_device = cuda.mem_alloc(buf.nbytes)
             cuda.memcpy_htod(buf_device, buf)
-            self.cached_shapes[buf_device] = buf.shape
-            self.cached_types[buf_device] = buf.dtype
+            self.cached_shapes[int(buf_device)] = buf.shape
+            self.cached_types[int(buf_device)] = buf.dtype
             buf_shape = buf.shape
             buf_type = buf.dtype
 
@@ -97,8 +86,8 @@ class MetaKernel:
         self.ctx.push()
         if result_host is None:
             #print("Allocating result buffer")
-            shape = self.cached_shapes.get(result_device, None)
-            dtype = self.cached_types.get(result_device, None)
+            shape = self.cached_shapes.get(int(result_device), None)
+            dtype = self.cached_types.get(int(result_device), None)
             #print dtype
             result_host = numpy.zeros(shape, dtype=dtype)
         
@@ -292,10 +281,6 @@ class MetaKernel:
 class LocalMemorySeparableConvolutionKernel (MetaKernel):
     def __init__(self, ctx):
         MetaKernel.__init__(self, ctx)
-        self.cached_intermediate_buffers = {}
-        self.cached_result_buffers = {}
-        self.cached_row_kernels = {}
-        self.cached_col_kernels = {}
 
     ##@clockit   
     def build_program(self, dtype, im_shape, row_kernel_radius, row_kernel_radius_aligned, row_tile_width, col_kernel_radius, col_tile_width, col_tile_height, col_hstride):
@@ -483,13 +468,11 @@ class LocalMemorySeparableConvolutionKernel (MetaKernel):
         #print templated_code
         
         try:
-            program = cuda_compiler.SourceModule(templated_code)
+            program = self.cache_program((dtype, im_shape, row_kernel_radius, row_kernel_radius_aligned, row_tile_width, col_kernel_radius, col_tile_width, col_tile_height, col_hstride), templated_code)
         except Exception as e:
             print(e)
             exit()
 
-        self.cache_program((dtype, im_shape, row_kernel_radius, row_kernel_radius_aligned, row_tile_width, col_kernel_radius, col_tile_width, col_tile_height, col_hstride), program)
-
         return program
 
     @clockit
@@ -532,9 +515,8 @@ class LocalMemorySeparableConvolutionKernel (MetaKernel):
         
         #build_args = (im_shape, row_kernel_radius, row_kernel_radius_aligned, row_tile_width, col_kernel_radius, col_tile_width, col_tile_height, col_hstride
         build_args = (input_type, input_shape, row_kernel_radius, row_kernel_radius_aligned, row_tile_width, col_kernel_radius, col_tile_width, col_tile_height, col_hstride)
-        if build_args in self.cached_programs:
-            prg = self.cached_programs[build_args]
-        else:
+        prg = self.cached_program(build_args)
+        if prg is None:
             prg = self.build_program(*build_args)
 
         row_local_size = (row_kernel_radius_aligned + row_tile_width + row_kernel_radius, 1,1)
@@ -550,28 +532,13 @@ class LocalMemorySeparableConvolutionKernel (MetaKernel):
         #print col_global_size
 
         # a device buffer for the intermediate result
-        intermediate_dev = None
-        if (use_cached_buffers) and ((input_shape, input_type) in self.cached_intermediate_buffers):
-            intermediate_dev = self.cached_intermediate_buffers[(input_shape, input_type)]
-        else:
-            dummy = numpy.array([1], dtype=input_type)
-            intermediate_dev = cuda.mem_alloc(input_shape[0] * input_shape[1] * dummy.itemsize)
-            self.cached_intermediate_buffers[(input_shape, input_type)] = intermediate_dev
+        intermediate_dev = self.buffer('intermediate', input_shape, input_type, use_cached_buffers)
 
         # a device buffer for the result, if not already supplied
         result_dev = None
         if result is None or result.__class__ == numpy.ndarray:
             # need to make or repurpose a device buffer
-            if (use_cached_buffers) and ((input_shape, input_type) in self.cached_result_buffers):
-                result_dev  = self.cached_result_buffers[(input_shape, input_type)]
-                #print "Here"
-                #print(result_dev)
-            else:
-                dummy = numpy.array([1], dtype=input_type)
-                result_dev = cuda.mem_alloc(input_shape[0] * input_shape[1] * dummy.itemsize)
-                self.cached_result_buffers[(input_shape, input_type)] = result_dev
-                self.cached_shapes[result_dev] = input_shape
-                self.cached_types[result_dev] = input_type
+            result_dev = self.buffer('result', input_shape, input_type, use_cached_buffers)
         else:
             # assume that result is a device buffer already (possibly not a safe assumption)
             result_dev = result
@@ -617,19 +584,6 @@ class LocalMemorySeparableConvolutionKernel (MetaKernel):
         return result
 
 
-def gaussian_kernel(width = 17, sigma = 4.0):
-    assert width == numpy.floor(width),  'argument width should be an integer!'
-    radius = (width - 1)/2.0
-    x = numpy.linspace(-radius,  radius,  width)
-    x = numpy.float32(x)
-    sigma = numpy.float32(sigma)
-    filterx = x*x / (2 * sigma * sigma)
-    filterx = numpy.exp(-1 * filterx)
-    assert filterx.sum()>0,  'something very wrong if gaussian kernel sums to zero!'
-    filterx /= filterx.sum()
-    return filterx
-
-    
 if __name__ == "__main__":
     
     cuda.init()